@@ -0,0 +1,178 @@
+"""
+Localisation de secours par position des points d'accès (utilisée par server_geoloc.py).
+
+Au chargement, chaque point d'accès (MAC) reçoit une position estimée une seule fois :
+- barycentre des empreintes du relevé qui le voient, pondéré par le RSSI (plus le signal est fort,
+  plus l'empreinte est proche du routeur), étage compris ;
+- à défaut, sa position WiGLE (table ap_priors remplie par import_wigle.py), sans étage.
+Un scan coûte ensuite une recherche par dichotomie dans les MAC triées (comme wknn_engine.SortedMacIndex),
+puis un barycentre pondéré (ou un ajustement par moindres carrés) des routeurs connus.
+Table en tableaux numpy (24 octets par routeur) : peu de mémoire par processus, même avec beaucoup de positions WiGLE.
+Moins précis que le WKNN, mais fonctionne même quand aucune empreinte ne partage de routeur avec le scan.
+"""
+import math
+import sqlite3
+import numpy as np
+from lora_payload import mac_to_int
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+RSSI_WEIGHT_SCALE = 10.0   # Poids = 10 ** (rssi / RSSI_WEIGHT_SCALE) : +10 dBm = poids x10
+FIT_CENTROID = "centroid"  # Barycentre des routeurs
+FIT_LSQ = "lsq"            # Multilatération (distances déduites du RSSI), barycentre si impossible
+TX_POWER = -40.0           # RSSI (dBm) à 1 m d'un routeur, pour FIT_LSQ
+PATH_LOSS_EXPONENT = 3.0   # Atténuation en intérieur, pour FIT_LSQ
+MIN_ACCURACY = 10.0        # Incertitude minimum annoncée (m)
+SURVEY_CHUNK = 1 << 16     # Mesures traitées à la fois par survey_positions (taille des tableaux temporaires)
+
+METERS_PER_DEGREE = 111320
+
+# ==========================================
+# POSITIONS DES POINTS D'ACCÈS
+# ==========================================
+def survey_positions(index):
+    """
+    Position de chaque MAC du relevé : barycentre des empreintes qui la voient, pondéré par le RSSI.
+    Calculé en une passe sur l'index inversé de wknn_engine.FingerprintIndex, par paquets de colonnes
+    (chaque processus du serveur refait ce calcul au chargement : les tableaux temporaires restent petits).
+    Renvoie (macs uint64, positions (M, 3) lat, lon, étage)
+    """
+    if index is None or len(index) == 0 or len(index.mac_index) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros((0, 3))
+
+    n_cols = len(index.post_ptr) - 1
+    weight_sum = np.zeros(n_cols)
+    positions = np.zeros((n_cols, 3))
+    used = np.flatnonzero(np.diff(index.post_ptr) > 0)
+    for chunk in np.array_split(used, max(1, len(index.post_rows) // SURVEY_CHUNK)):
+        if len(chunk) == 0:
+            continue
+        # Mesures des colonnes du paquet (contiguës : les colonnes vides entre elles n'en ont pas)
+        lo, hi = index.post_ptr[chunk[0]], index.post_ptr[chunk[-1] + 1]
+        starts = index.post_ptr[chunk] - lo
+        weights = 10.0 ** (index.post_rssi[lo:hi].astype(np.float64) / RSSI_WEIGHT_SCALE)
+        weight_sum[chunk] = np.add.reduceat(weights, starts)
+        positions[chunk] = np.add.reduceat(weights[:, None] * index.coords[index.post_rows[lo:hi]], starts)
+    positions /= np.maximum(weight_sum, 1e-300)[:, None]
+
+    mac_index = index.mac_index
+    if hasattr(mac_index, "sorted_macs"): # SortedMacIndex (instantané)
+        macs, cols = mac_index.sorted_macs, mac_index.sorted_cols
+    else:
+        macs = np.fromiter(mac_index.keys(), dtype=np.uint64, count=len(mac_index))
+        cols = np.fromiter(mac_index.values(), dtype=np.int64, count=len(mac_index))
+    seen = weight_sum[cols] > 0
+    return macs[seen], positions[cols[seen]]
+
+def read_ap_priors(db_file):
+    """Positions WiGLE de la table ap_priors : liste (mac entière, lat, lon). Vide si la table n'existe pas."""
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute("SELECT mac, latitude, longitude FROM ap_priors WHERE latitude IS NOT NULL AND longitude IS NOT NULL").fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+    priors = []
+    for mac, lat, lon in rows:
+        try:
+            priors.append((mac_to_int(mac), lat, lon))
+        except ValueError:
+            continue
+    return priors
+
+# ==========================================
+# LOCALISATION
+# ==========================================
+class APLocator:
+    """
+    Table MAC (entier) -> (lat, lon, étage ou NaN si inconnu) et localisation d'un scan à partir de cette table.
+    Lecture seule après construction (comme FingerprintIndex) : un rechargement en crée une nouvelle.
+    """
+    def __init__(self, macs, positions, fit=FIT_CENTROID):
+        self.macs = macs            # MAC triées (uint64)
+        self.positions = positions  # (M, 3) lat, lon, étage de chaque MAC
+        self.fit = fit
+
+    @classmethod
+    def build(cls, index=None, priors=(), fit=FIT_CENTROID):
+        """Positions du relevé (index) complétées par les positions a priori (priors) des MAC absentes du relevé"""
+        survey_macs, survey_pos = survey_positions(index)
+        # Une MAC en double dans priors : la dernière l'emporte
+        priors = list(priors)[::-1]
+        prior_macs = np.array([mac for mac, _, _ in priors], dtype=np.uint64)
+        prior_pos = np.array([(lat, lon, np.nan) for _, lat, lon in priors], dtype=np.float64).reshape(-1, 3)
+        prior_macs, first = np.unique(prior_macs, return_index=True)
+        missing = ~np.isin(prior_macs, survey_macs)
+        macs = np.concatenate([survey_macs, prior_macs[missing]])
+        positions = np.concatenate([survey_pos, prior_pos[first[missing]]])
+        order = np.argsort(macs)
+        return cls(macs[order], positions[order], fit)
+
+    def __len__(self):
+        return len(self.macs)
+
+    def lookup(self, live_aps):
+        """Routeurs connus du scan {mac: rssi} : (positions (n, 3), rssi (n,))"""
+        if len(self.macs) == 0 or not live_aps:
+            return np.zeros((0, 3)), np.zeros(0)
+        macs = np.fromiter(live_aps.keys(), dtype=np.uint64, count=len(live_aps))
+        rssi = np.fromiter(live_aps.values(), dtype=np.float64, count=len(live_aps))
+        i = np.minimum(np.searchsorted(self.macs, macs), len(self.macs) - 1)
+        found = self.macs[i] == macs
+        return self.positions[i[found]], rssi[found]
+
+    def locate(self, live_aps):
+        """
+        Position du scan {mac: rssi} (mêmes champs que wknn_engine.wknn_estimate),
+        None si aucun routeur du scan n'a de position connue.
+        """
+        known, rssi = self.lookup(live_aps)
+        if len(known) == 0:
+            return None
+
+        positions = known[:, :2]
+        weights = 10.0 ** (rssi / RSSI_WEIGHT_SCALE)
+        weights /= weights.sum()
+        est_lat, est_lon = weights @ positions
+        if self.fit == FIT_LSQ and len(known) >= 3:
+            est_lat, est_lon = self._multilaterate(positions, rssi, weights, est_lat, est_lon)
+
+        # Étage : moyenne pondérée des routeurs dont l'étage est connu (relevé)
+        has_floor = ~np.isnan(known[:, 2])
+        floor_weight = float(weights[has_floor].sum())
+        est_floor = round(float(weights[has_floor] @ known[has_floor, 2]) / floor_weight) if floor_weight > 0 else None
+
+        # Incertitude : écart moyen (pondéré) entre les routeurs et le point estimé
+        cos_lat = math.cos(math.radians(est_lat))
+        d = np.hypot((positions[:, 0] - est_lat) * METERS_PER_DEGREE, (positions[:, 1] - est_lon) * METERS_PER_DEGREE * cos_lat)
+        return {
+            "lat": float(est_lat),
+            "lon": float(est_lon),
+            "floor": est_floor,
+            "accuracy": max(float(weights @ d), MIN_ACCURACY),
+            "details": [len(known)] # Pour debug : nombre de routeurs localisés
+        }
+
+    @staticmethod
+    def _multilaterate(positions, rssi, weights, lat0, lon0):
+        """
+        Moindres carrés linéarisés (repère local en mètres centré sur le barycentre) :
+        |p - p_i|² = r_i², r_i déduit du RSSI (modèle log-distance). Garde le barycentre si le
+        système est mal conditionné ou si la solution sort de la zone couverte par les routeurs.
+        """
+        cos_lat = math.cos(math.radians(lat0))
+        x = (positions[:, 1] - lon0) * METERS_PER_DEGREE * cos_lat
+        y = (positions[:, 0] - lat0) * METERS_PER_DEGREE
+        r = 10.0 ** ((TX_POWER - rssi) / (10.0 * PATH_LOSS_EXPONENT))
+        # Différence avec l'équation du routeur le plus fort : système linéaire en (x, y)
+        ref = int(np.argmax(rssi))
+        others = np.arange(len(x)) != ref
+        A = 2.0 * np.column_stack([x[others] - x[ref], y[others] - y[ref]])
+        b = (r[ref] ** 2 - r[others] ** 2) + (x[others] ** 2 + y[others] ** 2) - (x[ref] ** 2 + y[ref] ** 2)
+        sw = np.sqrt(weights[others])[:, None]
+        solution, _, rank, _ = np.linalg.lstsq(A * sw, b * sw[:, 0], rcond=None)
+        if rank < 2 or np.hypot(*solution) > max(np.hypot(x, y).max(), 1.0):
+            return lat0, lon0
+        return lat0 + solution[1] / METERS_PER_DEGREE, lon0 + solution[0] / (METERS_PER_DEGREE * cos_lat)
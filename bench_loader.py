@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# Comparaison des chargeurs de la base d'empreintes : temps de chargement et pic de mémoire (RSS)
+# Chaque chargeur tourne dans un processus séparé pour mesurer son propre pic de mémoire.
+# Exemple : python bench_loader.py database_wifi.json database_wifi_clean.json --scale 50
+
+LOADERS = ["json_legacy", "json_stream", "ndjson_stream"]
+
+def peak_rss_mb():
+    # ru_maxrss est en ko sous Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def load_legacy(path):
+    """Ancien chargeur : json.load de tout le fichier puis dictionnaires imbriqués par timestamp (MAC en texte)"""
+    from wknn_engine import build_index
+    with open(path, 'r') as f:
+        raw_data = json.load(f)
+    grouped = defaultdict(lambda: {'lat': 0, 'lon': 0, 'floor': 0, 'aps': {}})
+    for entry in raw_data:
+        ts = entry['timestamp']
+        grouped[ts]['lat'] = entry['latitude']
+        grouped[ts]['lon'] = entry['longitude']
+        grouped[ts]['floor'] = entry['floor']
+        grouped[ts]['aps'][entry['mac']] = entry['rssi']
+    return build_index(list(grouped.values()), list(grouped.keys()))
+
+def load_stream(path):
+    """Nouveau chargeur (server_geoloc.load_database) : lecture en flux vers IndexBuilder"""
+    import server_geoloc
+    server_geoloc.MODE_DB = server_geoloc.MODE_JSON
+    server_geoloc.DB_FILE = path
+    server_geoloc.CLEAN_DATABASE = False # même index que load_legacy (pas de lignes retirées)
+    server_geoloc.load_database()
+    return server_geoloc.fingerprint_index
+
+def run_one(loader, path):
+    """Exécuté dans le processus fils : affiche une ligne JSON avec les mesures"""
+    import numpy, wknn_engine, fingerprint_store  # imports hors mesure
+    if loader != "json_legacy":
+        import server_geoloc
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    index = load_legacy(path) if loader == "json_legacy" else load_stream(path)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"fingerprints": len(index), "macs": len(index.mac_index),
+                      "seconds": elapsed, "peak_rss_mb": peak_rss_mb() - rss_before}))
+
+def make_inputs(path, scale, workdir):
+    """Fichier JSON (éventuellement agrandi scale fois, timestamps décalés) + sa version NDJSON"""
+    with open(path, 'r') as f:
+        records = json.load(f)
+    if scale > 1:
+        span = max(r['timestamp'] for r in records) - min(r['timestamp'] for r in records) + 1
+        records = [dict(r, timestamp=r['timestamp'] + i * span) for i in range(scale) for r in records]
+    name = os.path.splitext(os.path.basename(path))[0]
+    json_path = os.path.join(workdir, f"{name}_x{scale}.json")
+    ndjson_path = os.path.join(workdir, f"{name}_x{scale}.ndjson")
+    with open(json_path, 'w') as f:
+        json.dump(records, f, indent=4)
+    with open(ndjson_path, 'w') as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+    return len(records), json_path, ndjson_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps de chargement et pic de mémoire des chargeurs JSON")
+    parser.add_argument("files", nargs="*", default=["database_wifi.json", "database_wifi_clean.json"])
+    parser.add_argument("--scale", type=int, default=1, help="agrandit chaque fichier N fois (timestamps décalés)")
+    parser.add_argument("--run", nargs=2, metavar=("LOADER", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(*args.run)
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'fichier':<32}{'lignes':>9}  {'chargeur':<15}{'empreintes':>11}{'temps (s)':>11}{'pic RSS (Mo)':>14}")
+        for path in args.files:
+            n_records, json_path, ndjson_path = make_inputs(path, args.scale, workdir)
+            for loader in LOADERS:
+                target = ndjson_path if loader == "ndjson_stream" else json_path
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", loader, target],
+                                     cwd=here, capture_output=True, text=True, check=True).stdout
+                result = json.loads(out.strip().splitlines()[-1])
+                print(f"{os.path.basename(json_path):<32}{n_records:>9}  {loader:<15}{result['fingerprints']:>11}"
+                      f"{result['seconds']:>11.3f}{result['peak_rss_mb']:>14.1f}")
+
+if __name__ == "__main__":
+    main()
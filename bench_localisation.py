@@ -0,0 +1,192 @@
+import argparse
+import json
+import math
+import random
+import sqlite3
+import time
+import numpy as np
+from wknn_engine import IndexBuilder, wknn_estimate, wknn_estimate_batch
+from fingerprint_store import iter_json_records
+from lora_payload import mac_to_int
+import fingerprint_cleaning
+
+# Banc d'essai de la localisation : précision et vitesse de wknn_engine (utilisé par server_geoloc.py)
+# Rejeu "leave-one-out" : chaque scan de la base (un timestamp) est retiré à tour de rôle
+# puis localisé avec toutes les autres empreintes, et comparé à sa position réelle.
+# Les bases agrandies (--scale) sont synthétiques : pour voir comment le calcul évolue avec N
+# (vitesse seulement : les copies d'un scan retiré restent dans la base, la précision n'y est pas mesurée).
+# --clean : mesure aussi chaque base après nettoyage automatique (fingerprint_cleaning.py), taille et précision avant/après.
+# Exemple : python bench_localisation.py database_wifi_clean.json database_wifi.db --scale 10 100
+
+DEFAULT_K = 5            # Comme K_NEIGHBORS dans server_geoloc.py
+MIN_QUERIES = 2000       # Requêtes de mesure de latence minimum (le rejeu est répété si la base est petite)
+METERS_PER_DEGREE = 111320
+TILE_SPACING = 200       # Mètres entre deux copies en disposition "tiled"
+
+def read_records(path):
+    """Lignes (timestamp, mac entière, rssi, latitude, longitude, floor) d'une base JSON/NDJSON ou SQLite"""
+    if path.endswith(".db"):
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute("SELECT timestamp, mac, rssi, latitude, longitude, floor FROM fingerprints ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        return [(ts, mac_to_int(mac), rssi, lat, lon, floor) for ts, mac, rssi, lat, lon, floor in rows]
+    return [(e['timestamp'], mac_to_int(e['mac']), e['rssi'], e['latitude'], e['longitude'], e['floor'])
+            for e in iter_json_records(path)]
+
+def synthesize(records, scale, layout, seed=0):
+    """
+    Base agrandie scale fois. La copie 0 est la base d'origine (mêmes numéros d'empreintes),
+    les autres copies ont des timestamps décalés et :
+    - "dense" : mêmes MAC, RSSI bruité (±4 dBm) et position décalée de quelques mètres
+      (relevés plus serrés du même bâtiment : toutes les copies sont candidates, pire cas pour l'index inversé)
+    - "tiled" : MAC différentes et position décalée de TILE_SPACING mètres par copie
+      (bâtiments voisins : le nombre de candidats par requête ne change pas)
+    """
+    if scale <= 1:
+        return list(records)
+    rng = random.Random(seed)
+    span = max(r[0] for r in records) - min(r[0] for r in records) + 1
+    out = list(records)
+    for copy in range(1, scale):
+        jitter = {}
+        for ts, mac, rssi, lat, lon, floor in records:
+            if layout == "dense":
+                # Même décalage pour toutes les lignes d'un scan
+                d_lat, d_lon = jitter.setdefault(ts, (rng.gauss(0, 3), rng.gauss(0, 3)))
+                rssi = min(-20, max(-100, rssi + rng.randint(-4, 4)))
+            else:
+                d_lat, d_lon = 0.0, copy * TILE_SPACING
+                mac = (mac ^ (copy * 0x9E3779B1)) & 0xFFFFFFFFFFFF
+            lat += d_lat / METERS_PER_DEGREE
+            lon += d_lon / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+            out.append((ts + copy * span, mac, rssi, lat, lon, floor))
+    return out
+
+def build(records):
+    builder = IndexBuilder()
+    for record in records:
+        builder.add(*record)
+    return builder.build()
+
+def clean(records):
+    """Lignes nettoyées comme au chargement par server_geoloc.py (hors routeurs mobiles, voir build_clean)"""
+    return list(fingerprint_cleaning.ScanCleaner().feed(records))
+
+def build_clean(records):
+    return fingerprint_cleaning.drop_spread_aps(build(records))[0]
+
+def row_scans(index, n_rows):
+    """Scans {mac: rssi} des n_rows premières empreintes (reconstruits depuis la matrice CSR)"""
+    macs = list(index.mac_index) # dans l'ordre des colonnes
+    scans = []
+    for row in range(n_rows):
+        a, b = index.indptr[row], index.indptr[row + 1]
+        scans.append({macs[col]: int(rssi) for col, rssi in zip(index.cols[a:b], index.rssi[a:b])})
+    return scans
+
+def error_meters(estimates, truth):
+    """Distance (m) entre positions estimées et réelles, tableaux (N, 2) lat, lon"""
+    d_lat = (estimates[:, 0] - truth[:, 0]) * METERS_PER_DEGREE
+    d_lon = (estimates[:, 1] - truth[:, 1]) * METERS_PER_DEGREE * np.cos(np.radians(truth[:, 0]))
+    return np.hypot(d_lat, d_lon)
+
+def replay(index, n_queries, k, accuracy=True):
+    """
+    Rejeu leave-one-out des n_queries premières empreintes : précision (si accuracy), latence et débit
+    """
+    scans = row_scans(index, n_queries)
+    rows = np.arange(n_queries)
+
+    # Précision (et débit par lots : toutes les requêtes en une passe)
+    start = time.perf_counter()
+    results = wknn_estimate_batch(index, scans, k, exclude=rows)
+    batch_seconds = time.perf_counter() - start
+    located = [i for i, r in enumerate(results) if r is not None]
+    estimates = np.array([[results[i]["lat"], results[i]["lon"]] for i in located]).reshape(-1, 2)
+    truth = index.coords[located, :2]
+    errors = error_meters(estimates, truth)
+    floor_ok = np.array([results[i]["floor"] == round(float(index.coords[i, 2])) for i in located])
+
+    # Latence requête par requête (comme un uplink)
+    repeat = max(1, -(-MIN_QUERIES // max(n_queries, 1)))
+    latencies = []
+    for _ in range(repeat):
+        for row, live_aps in enumerate(scans):
+            t = time.perf_counter()
+            wknn_estimate(index, live_aps, k, exclude=row)
+            latencies.append(time.perf_counter() - t)
+    latencies = np.array(latencies) * 1e6
+
+    def pct(values, q):
+        return float(np.percentile(values, q)) if len(values) else None
+
+    if not accuracy:
+        errors = floor_ok = np.array([])
+
+    return {
+        "fingerprints": len(index),
+        "macs": int((np.diff(index.post_ptr) > 0).sum()),
+        "measurements": len(index.cols),
+        "queries": n_queries,
+        "located": len(located),
+        "k": k,
+        "error_p50_m": pct(errors, 50),
+        "error_p95_m": pct(errors, 95),
+        "error_p99_m": pct(errors, 99),
+        "floor_accuracy": float(floor_ok.mean()) if len(floor_ok) else None,
+        "latency_p50_us": pct(latencies, 50),
+        "latency_p95_us": pct(latencies, 95),
+        "latency_p99_us": pct(latencies, 99),
+        "queries_per_second": len(latencies) / (latencies.sum() / 1e6),
+        "batch_queries_per_second": n_queries / batch_seconds if batch_seconds > 0 else float("nan"),
+    }
+
+def cell(value, width, spec):
+    """Case du tableau ("-" si la mesure n'a pas été faite)"""
+    return f"{'-' if value is None else format(value, spec):>{width}}"
+
+def print_row(name, result):
+    """Une ligne du tableau"""
+    print(f"{name:<44}{result['fingerprints']:>8}{result['macs']:>7}{result['measurements']:>9}"
+          f"{cell(result['error_p50_m'], 8, '.1f')}{cell(result['error_p95_m'], 7, '.1f')}{cell(result['error_p99_m'], 7, '.1f')}"
+          f"{cell(result['floor_accuracy'], 8, '.0%')}"
+          f"{result['latency_p50_us']:>11.0f}{result['latency_p95_us']:>8.0f}{result['latency_p99_us']:>8.0f}"
+          f"{result['queries_per_second']:>9.0f}{result['batch_queries_per_second']:>12.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Précision (leave-one-out) et vitesse de la localisation WKNN")
+    parser.add_argument("files", nargs="*", default=["database_wifi_clean.json", "database_wifi.db"])
+    parser.add_argument("--k", type=int, default=DEFAULT_K, help="nombre de voisins")
+    parser.add_argument("--scale", type=int, nargs="*", default=[], help="bases synthétiques agrandies N fois (ex: 10 100)")
+    parser.add_argument("--layout", choices=["dense", "tiled"], default="dense", help="disposition des copies synthétiques")
+    parser.add_argument("--json", action="store_true", help="une ligne JSON par mesure au lieu du tableau")
+    parser.add_argument("--clean", action="store_true", help="mesure aussi chaque base nettoyée (avant/après)")
+    parser.add_argument("--merge-families", action="store_true", help="avec --clean : fusionne les familles de BSSID")
+    args = parser.parse_args()
+    if args.merge_families:
+        fingerprint_cleaning.MERGE_BSSID_FAMILIES = True
+
+    if not args.json:
+        print(f"{'base':<44}{'N':>8}{'MAC':>7}{'mesures':>9}{'err p50/p95/p99 (m)':>22}{'étage':>8}"
+              f"{'latence p50/p95/p99 (µs)':>27}{'req/s':>9}{'lots req/s':>12}")
+    for path in args.files:
+        records = read_records(path)
+        # Base nettoyée : les requêtes rejouées sont aussi nettoyées (comme les scans live du serveur)
+        variants = [(path, records, build)]
+        if args.clean:
+            variants.append((f"{path} (nettoyée)", clean(records), build_clean))
+        for base, rows, build_index in variants:
+            for scale in [1] + args.scale:
+                index = build_index(synthesize(rows, scale, args.layout))
+                n_queries = len(build(rows)) # seules les empreintes d'origine sont rejouées
+                result = replay(index, n_queries, args.k, accuracy=scale == 1)
+                name = base if scale == 1 else f"{base} x{scale} ({args.layout})"
+                if args.json:
+                    print(json.dumps(dict(result, base=name)))
+                    continue
+                print_row(name, result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import time
+import server_geoloc
+
+# Construction de l'instantané binaire de la base d'empreintes (<base>.snap), chargé en mmap
+# au démarrage de server_geoloc.py. Le serveur le reconstruit aussi tout seul quand la base change.
+# --update : reprend l'instantané existant et n'y ajoute que les nouvelles lignes (utilisé par le serveur
+# lancé avec --workers, pour ne pas construire l'index dans un de ses processus)
+# Exemple : python build_snapshot.py database_wifi.db
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Construit l'instantané binaire d'une base d'empreintes")
+    parser.add_argument("db_file", nargs="?", default=server_geoloc.DB_FILE,
+                        help="database_wifi.db (SQLite) ou fichier .json / .ndjson")
+    parser.add_argument("--update", action="store_true",
+                        help="reprend l'instantané existant (même périmé) et n'ajoute que les nouvelles lignes")
+    args = parser.parse_args()
+
+    server_geoloc.DB_FILE = args.db_file
+    server_geoloc.MODE_DB = server_geoloc.MODE_SQL if args.db_file.endswith(".db") else server_geoloc.MODE_JSON
+
+    start = time.perf_counter()
+    signature = server_geoloc.db_signature()
+    added_rows = None
+    if args.update and server_geoloc.load_database_snapshot():
+        # Base inchangée (ou instantané déjà complété par un autre processus) : pas de réécriture
+        print(f"{server_geoloc.snapshot_file()} déjà à jour")
+        raise SystemExit(0)
+    if args.update and server_geoloc.load_database_snapshot(stale=True):
+        added_rows = server_geoloc.reload_database()
+    elif server_geoloc.MODE_DB == server_geoloc.MODE_JSON:
+        server_geoloc.load_database()
+    else:
+        server_geoloc.load_database_sql()
+    if server_geoloc.fingerprint_index is None:
+        raise SystemExit(f"Impossible de charger {args.db_file}")
+    server_geoloc.write_database_snapshot(signature, added_rows)
+    print(f"{server_geoloc.snapshot_file()} : {len(server_geoloc.fingerprint_index)} empreintes, "
+          f"{len(server_geoloc.fingerprint_index.mac_index)} MAC ({time.perf_counter() - start:.2f} s)")
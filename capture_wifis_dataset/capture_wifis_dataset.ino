@@ -12,9 +12,9 @@ const char* ssid = "iPhon de Alexcouille (2)";
 const char* password = "bahenfaitnon";
 
 //IP du serveur local
-const char* serverUrl = "http://172.20.10.8:8004/api/raw_scan";
+const char* serverUrl = "http://172.20.10.8:8004/api/scan";
 //serveur distant
-//const char* serverUrl = "http://vps-98cd652a.vps.ovh.net:8004/api/raw_scan";
+//const char* serverUrl = "http://vps-98cd652a.vps.ovh.net:8004/api/scan";
 
 uint32_t current_timestamp = 0;
 
@@ -51,18 +51,26 @@ void setup_wifi() {
   Serial.println("\nConnecté ! IP: " + WiFi.localIP().toString());
 }
 
-void sendViaHTTP(int index) {
+// envoi de tout le scan (n wifis) en une seule requête
+void sendScanViaHTTP(int n) {
   if(WiFi.status() != WL_CONNECTED) setup_wifi();
 
   HTTPClient http;
   http.begin(serverUrl);
   http.addHeader("Content-Type", "application/json");
 
-  StaticJsonDocument<200> doc;
+  DynamicJsonDocument doc(256 + 128*n);
   doc["timestamp"] = current_timestamp; // Le même timestamp pour tout le scan
-  doc["ssid"] = WiFi.SSID(index);
-  doc["mac"] = WiFi.BSSIDstr(index);
-  doc["rssi"] = WiFi.RSSI(index);
+  JsonArray networks = doc.createNestedArray("networks");
+  for (int i = 0; i < n; i++) {
+    // Filtre simple pour éviter les trucs bizarres
+    if(WiFi.SSID(i).length() > 0) {
+      JsonObject network = networks.createNestedObject();
+      network["ssid"] = WiFi.SSID(i);
+      network["mac"] = WiFi.BSSIDstr(i);
+      network["rssi"] = WiFi.RSSI(i);
+    }
+  }
 
   String requestBody;
   serializeJson(doc, requestBody);
@@ -91,13 +99,7 @@ void loop() {
       
       Serial.printf("%d réseaux trouvés. Envoi vers le serveur...\n", n);
 
-      for (int i = 0; i < n; i++) {
-         // Filtre simple pour éviter les trucs bizarres
-         if(WiFi.SSID(i).length() > 0) {
-            sendViaHTTP(i);
-            delay(20); //petit délai pour le serveur
-         }
-      }
+      sendScanViaHTTP(n); // une seule requête pour tout le scan
 
       WiFi.scanDelete();
       Serial.println("--- FIN DE L'ENVOI ---");
@@ -0,0 +1,173 @@
+"""
+Nettoyage automatique des empreintes (utilisé par server_geoloc.py, server_wifi_capture.py et bench_localisation.py).
+Remplace le tri à la main qui a donné database_wifi_clean.json :
+- MAC "locally administered" (bit 0x02 du premier octet) : partages de connexion des téléphones,
+  MAC aléatoires... qui bougent avec leur propriétaire. Retirées (comme le fait déjà scan.ino en LoRa).
+- Familles de BSSID : un routeur émet plusieurs réseaux (2.4/5 GHz, eduroam, invités...) sur des MAC
+  qui ne diffèrent que par les 2 derniers bits (ex: ...:60 à ...:63). Fusionnées en une seule MAC
+  (la première de la famille, RSSI le plus fort) : une colonne au lieu de quatre (voir MERGE_BSSID_FAMILIES).
+- Scans répétés : même position et mêmes réseaux avec les mêmes RSSI (scan renvoyé ou enregistré deux fois).
+- Points d'accès vus à des endroits trop éloignés les uns des autres (> MAX_AP_SPREAD) : routeurs
+  mobiles (bus, voiture), retirés de l'index compilé.
+Les lignes sont traitées en flux : un seul scan en mémoire à la fois.
+"""
+import math
+import numpy as np
+from wknn_engine import FingerprintIndex, METERS_PER_DEGREE
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+DROP_LOCALLY_ADMINISTERED = True
+# Désactivé par défaut : sur le relevé actuel la base est 38 % plus petite mais moins précise
+# (erreur p95 24 -> 30 m, étage 68 -> 59 %) : les routeurs à plusieurs BSSID pèsent plus lourd
+# dans la distance RSSI, et ce sont les plus fiables (infrastructure). À mesurer avec bench_localisation.py --merge-families
+MERGE_BSSID_FAMILIES = False
+BSSID_FAMILY_MASK = 0xFFFFFFFFFFFC  # MAC entière & masque = MAC de la famille
+DEDUP_SCANS = True
+MAX_AP_SPREAD = 300.0               # Mètres entre les empreintes extrêmes d'un même routeur (0 = pas de vérification)
+
+def settings():
+    """Réglages actuels (pour savoir si un instantané a été nettoyé de la même façon)"""
+    return {
+        "drop_locally_administered": DROP_LOCALLY_ADMINISTERED,
+        "merge_bssid_families": MERGE_BSSID_FAMILIES,
+        "dedup_scans": DEDUP_SCANS,
+        "max_ap_spread": MAX_AP_SPREAD
+    }
+
+# ==========================================
+# MAC
+# ==========================================
+def is_locally_administered(mac):
+    """MAC entière 0xAABBCCDDEEFF : bit 0x02 de AA"""
+    return bool((mac >> 40) & 0x02)
+
+def bssid_family(mac):
+    """MAC qui représente le routeur physique (elle-même si MERGE_BSSID_FAMILIES est désactivé)"""
+    return mac & BSSID_FAMILY_MASK if MERGE_BSSID_FAMILIES else mac
+
+def clean_scan(live_aps):
+    """
+    Scan {mac: rssi} nettoyé comme les empreintes (à appliquer aux scans live avant la comparaison) :
+    MAC locally administered retirées, une seule MAC par famille avec le RSSI le plus fort.
+    """
+    cleaned = {}
+    for mac, rssi in live_aps.items():
+        if DROP_LOCALLY_ADMINISTERED and is_locally_administered(mac):
+            continue
+        mac = bssid_family(mac)
+        if rssi > cleaned.get(mac, -1000):
+            cleaned[mac] = rssi
+    return cleaned
+
+# ==========================================
+# NETTOYAGE EN FLUX DES LIGNES
+# ==========================================
+class ScanCleaner:
+    """
+    Nettoyage des lignes (..., timestamp, mac entière, rssi, latitude, longitude, floor) avant IndexBuilder.
+    Les champs placés avant le timestamp (ex: id SQLite) sont conservés.
+    Les lignes d'un même scan doivent être consécutives (cas des bases JSON et SQLite) :
+    un scan n'est renvoyé qu'une fois complet, au début du suivant (ou à la fin des lignes).
+    Garde en mémoire une empreinte (hash) par scan déjà vu, pour retirer les doublons
+    lors des rechargements incrémentaux, et la dernière ligne lue (retirée ou non) dans last_row.
+    """
+    def __init__(self):
+        self.signatures = set()
+        self.last_row = None
+        self.stats = {"rows_in": 0, "rows_out": 0, "locally_administered": 0, "merged": 0,
+                      "scans": 0, "duplicate_scans": 0}
+
+    def feed(self, rows):
+        scan = []
+        for row in rows:
+            if scan and row[-6] != scan[0][-6]:
+                yield from self._flush(scan)
+                scan = []
+            scan.append(row)
+            self.last_row = row
+        if scan:
+            yield from self._flush(scan)
+
+    def _flush(self, scan):
+        stats = self.stats
+        stats["rows_in"] += len(scan)
+        stats["scans"] += 1
+        best = {} # MAC de la famille -> ligne au RSSI le plus fort
+        for row in scan:
+            mac, rssi = row[-5], row[-4]
+            if DROP_LOCALLY_ADMINISTERED and is_locally_administered(mac):
+                stats["locally_administered"] += 1
+                continue
+            family = bssid_family(mac)
+            kept = best.get(family)
+            if kept is not None:
+                stats["merged"] += 1
+                if kept[-4] >= rssi:
+                    continue
+            best[family] = row[:-5] + (family,) + row[-4:]
+        if not best:
+            return []
+
+        if DEDUP_SCANS:
+            # Position du scan (dernière ligne, comme IndexBuilder) + réseaux et RSSI
+            last = scan[-1]
+            signature = hash((last[-3], last[-2], last[-1], frozenset((mac, row[-4]) for mac, row in best.items())))
+            if signature in self.signatures:
+                stats["duplicate_scans"] += 1
+                return []
+            self.signatures.add(signature)
+
+        stats["rows_out"] += len(best)
+        return best.values()
+
+# ==========================================
+# NETTOYAGE DE L'INDEX COMPILÉ
+# ==========================================
+def column_macs(mac_index, cols):
+    """MAC des colonnes cols (dictionnaire MAC -> colonne, ou wknn_engine.SortedMacIndex)"""
+    if hasattr(mac_index, "sorted_macs"):
+        return set(mac_index.sorted_macs[np.isin(mac_index.sorted_cols, cols)].tolist())
+    cols = set(cols.tolist())
+    return {mac for mac, col in mac_index.items() if col in cols}
+
+def drop_spread_aps(index, max_spread=None, dropped_macs=()):
+    """
+    Retire de l'index les mesures des routeurs vus à des empreintes distantes de plus de max_spread mètres
+    (diagonale de la zone couverte). Les colonnes restent (vides) : les numéros de colonne ne changent pas.
+    Vérifié sur tout l'index à chaque (re)chargement. L'étendue n'est mesurée que sur les empreintes de l'index :
+    dropped_macs (MAC retirées aux chargements précédents) sont retirées à nouveau, sinon un routeur retiré
+    reviendrait avec les seules mesures d'un rechargement incrémental.
+    Renvoie (nouvel index, MAC retirées, celles de dropped_macs comprises).
+    """
+    max_spread = MAX_AP_SPREAD if max_spread is None else max_spread
+    if index is None or max_spread <= 0 or len(index.post_rows) == 0:
+        return index, set(dropped_macs)
+
+    # Étendue (lat, lon) des empreintes de chaque colonne, sur l'index inversé
+    starts = index.post_ptr[:-1]
+    used = np.diff(index.post_ptr) > 0
+    lat = index.coords[index.post_rows, 0]
+    lon = index.coords[index.post_rows, 1]
+    s = starts[used]
+    d_lat = (np.maximum.reduceat(lat, s) - np.minimum.reduceat(lat, s)) * METERS_PER_DEGREE
+    cos_lat = math.cos(math.radians(float(index.coords[:, 0].mean())))
+    d_lon = (np.maximum.reduceat(lon, s) - np.minimum.reduceat(lon, s)) * METERS_PER_DEGREE * cos_lat
+    spread = np.zeros(len(starts))
+    spread[used] = np.hypot(d_lat, d_lon)
+    dropped = spread > max_spread
+    for mac in dropped_macs:
+        col = index.mac_index.get(mac)
+        if col is not None:
+            dropped[col] = True
+    dropped_cols = np.flatnonzero(dropped & used)
+    dropped_macs = set(dropped_macs) | column_macs(index.mac_index, dropped_cols)
+    if len(dropped_cols) == 0:
+        return index, dropped_macs
+
+    keep = ~dropped[index.cols]
+    row_of = np.repeat(np.arange(len(index), dtype=np.int64), np.diff(index.indptr))
+    indptr = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_of[keep], minlength=len(index)), out=indptr[1:])
+    return FingerprintIndex(index.mac_index, indptr, index.cols[keep], index.rssi[keep], index.coords, index.keys), dropped_macs
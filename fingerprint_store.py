@@ -0,0 +1,126 @@
+import sqlite3
+import json
+import re
+
+# Stockage SQLite des empreintes WiFi (table "fingerprints")
+# Même schéma que database_wifi.db, lu par server_geoloc.py
+# Utilisé par server_wifi_capture.py (ajout des scans tagués) et migrate_json_to_sql.py (import des JSON)
+# + table "ap_priors" : position connue de chaque point d'accès (import_wigle.py)
+# + lecture en flux des fichiers JSON / NDJSON (server_geoloc.py en mode JSON)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS fingerprints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp INTEGER,
+        ssid TEXT,
+        mac TEXT,
+        rssi INTEGER,
+        latitude REAL,
+        longitude REAL,
+        floor INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_mac ON fingerprints (mac);
+    -- Un scan (timestamp) ne contient chaque MAC qu'une fois. Sert aussi d'index sur timestamp.
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_timestamp_mac ON fingerprints (timestamp, mac);
+    -- Position a priori des points d'accès (une ligne par MAC), ex: triangulée par WiGLE
+    CREATE TABLE IF NOT EXISTS ap_priors (
+        mac TEXT PRIMARY KEY,
+        ssid TEXT,
+        latitude REAL,
+        longitude REAL,
+        last_update TEXT,
+        source TEXT
+    );
+"""
+
+def connect(db_file, check_same_thread=True):
+    """
+    Ouvre (et crée si besoin) la base. Mode WAL : les lectures de server_geoloc.py
+    ne bloquent pas les écritures, et une coupure pendant une écriture ne corrompt pas la base.
+    check_same_thread=False : connexion partagée entre threads (l'appelant sérialise les écritures).
+    """
+    conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def insert_fingerprints(conn, records):
+    """
+    Ajoute des lignes {timestamp, ssid, mac, rssi, latitude, longitude, floor} en UNE transaction
+    (tout ou rien). Les couples (timestamp, mac) déjà présents sont ignorés.
+    Renvoie le nombre de lignes réellement ajoutées.
+    """
+    before = conn.total_changes
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO fingerprints (timestamp, ssid, mac, rssi, latitude, longitude, floor) "
+            "VALUES (:timestamp, :ssid, :mac, :rssi, :latitude, :longitude, :floor)",
+            records
+        )
+    return conn.total_changes - before
+
+def upsert_ap_priors(conn, records):
+    """
+    Ajoute ou met à jour des lignes {mac, ssid, latitude, longitude, last_update, source} en UNE transaction.
+    Une MAC déjà connue n'est remplacée que par une observation au moins aussi récente (last_update).
+    Renvoie le nombre de lignes ajoutées ou modifiées.
+    """
+    before = conn.total_changes
+    with conn:
+        conn.executemany(
+            "INSERT INTO ap_priors (mac, ssid, latitude, longitude, last_update, source) "
+            "VALUES (:mac, :ssid, :latitude, :longitude, :last_update, :source) "
+            "ON CONFLICT(mac) DO UPDATE SET ssid = excluded.ssid, latitude = excluded.latitude, "
+            "longitude = excluded.longitude, last_update = excluded.last_update, source = excluded.source "
+            "WHERE excluded.last_update >= COALESCE(ap_priors.last_update, '')",
+            records
+        )
+    return conn.total_changes - before
+
+_SKIP_SEPARATORS = re.compile(r'[\s,]*').match
+
+def iter_json_records(path, chunk_size=1 << 16):
+    """
+    Lecture en flux d'un fichier d'empreintes, enregistrement par enregistrement (mémoire constante) :
+    - .ndjson / .jsonl : un objet JSON par ligne
+    - sinon : tableau JSON [ {...}, {...} ] (format de database_wifi.json), lu par morceaux de chunk_size
+    """
+    if path.endswith((".ndjson", ".jsonl")):
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = ""
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            # On saute les blancs et les virgules entre deux enregistrements
+            pos = _SKIP_SEPARATORS(buffer, pos).end()
+            if pos < len(buffer):
+                if buffer[pos] == '[' and not started:
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    return
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                    yield record
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            elif eof:
+                return
+            # Enregistrement incomplet : on lit le morceau suivant (en oubliant ce qui est déjà lu)
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
@@ -1,11 +1,25 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
 import requests
-import csv
-import base64
+import fingerprint_store #base sqlite
+
+# Import des points d'accès connus de WiGLE dans la base SQLite (table ap_priors : position a priori de chaque MAC),
+# utilisable par server_geoloc.py.
+# - pagination avec le curseur "searchAfter" (plus de limite à 100 résultats)
+# - zone découpée en tuiles (récursivement si une tuile a trop de résultats), téléchargées en parallèle
+#   sans dépasser REQUESTS_PER_SECOND (et pause demandée par WiGLE en cas de réponse 429)
+# - progression sauvegardée dans CHECKPOINT_FILE : un import interrompu reprend où il s'était arrêté
+# Exemple : python import_wigle.py --bbox 48.8097 48.8175 1.8985 1.9222 --rate 1 --workers 4
 
 # === CONFIGURATION ===
-# Remplace par ta chaîne "Encoded for use" trouvée sur le site WiGLE
+# Variable d'environnement WIGLE_AUTH : ta chaîne "Encoded for use" trouvée sur le site WiGLE (Account)
 # Attention: Ne mets pas "Basic " devant, juste la chaîne
-WIGLE_AUTH = "QUlENDM2NDRhZmExN2MyYTYwYzBlNjIyYWNmNTk0OTY5YTU6Y2NmNDYwODRlMjc0N2E1OTVmMTc2ZjA0ZjMzYzI3MzQ" 
+WIGLE_AUTH = os.environ.get("WIGLE_AUTH", "")
 
 # Définis ta zone géographique (Exemple: Une zone à Paris)
 # Utilise boundingbox.klokantech.com pour trouver tes valeurs
@@ -20,73 +34,261 @@ LAT_MAX = 48.8175
 LON_MIN = 1.8985
 LON_MAX = 1.9222
 
-OUTPUT_FILE = "local_wifi_db_wigle.csv"
+WIGLE_URL = "https://api.wigle.net"   # --base-url pour un autre serveur (ex: serveur local de test)
+SEARCH_PATH = "/api/v2/network/search"
+DB_FILE = "database_wifi.db"          # base SQLite (même fichier que server_geoloc.py)
+CHECKPOINT_FILE = "import_wigle_checkpoint.json"
 
-def fetch_wigle_data():
-    url = "https://api.wigle.net/api/v2/network/search"
-    
-    headers = {
-        "Authorization": f"Basic {WIGLE_AUTH}",
-        "Accept": "application/json"
-    }
-    
-    # Paramètres de recherche
-    params = {
-        "onlymine": "false",       # Chercher dans toute la base
-        "latrange1": LAT_MIN,      # Latitude min
-        "latrange2": LAT_MAX,      # Latitude max
-        "longrange1": LON_MIN,     # Longitude min
-        "longrange2": LON_MAX,     # Longitude max
-        "freenet": "false",        # Tout type de réseau (pas que les gratuits)
-        "paynet": "false", 
-        "resultsPerPage": 100      # Max 100 par page pour la version gratuite de base
+RESULTS_PER_PAGE = 100      # Max 100 par page pour la version gratuite de base
+MAX_RESULTS_PER_TILE = 1000 # Au-delà (totalResults), la tuile est découpée en 4
+MIN_TILE_SIZE = 0.0005      # Degrés : on ne découpe plus en dessous (~50 m)
+REQUESTS_PER_SECOND = 1.0   # Débit max vers WiGLE (toutes tâches confondues)
+WORKERS = 4                 # Tuiles téléchargées en parallèle
+MAX_RETRIES = 5             # Essais par page (erreurs réseau, 429, 5xx)
+REQUEST_TIMEOUT = 30
+
+# === LIMITEUR DE DÉBIT ===
+class RateLimiter:
+    """Au plus `rate` requêtes par seconde, partagé entre les threads"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        """Plus aucune requête pendant `seconds` (WiGLE a répondu 429)"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+# === REPRISE ===
+def tile_key(tile):
+    return ",".join(f"{v:.7f}" for v in tile)
+
+class Checkpoint:
+    """
+    Progression de l'import (fichier JSON, réécrit de façon atomique) :
+    tuiles restantes avec leur curseur searchAfter, nombre de réseaux importés.
+    """
+    def __init__(self, path, bbox):
+        self.path = path
+        self.lock = threading.Lock()
+        state = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            if state.get("bbox") != list(bbox):
+                print(f"Reprise ignorée : {path} concerne une autre zone ({state.get('bbox')})")
+                state = None
+        if state is None:
+            state = {"bbox": list(bbox), "pending": {tile_key(bbox): {"tile": list(bbox), "cursor": None}}, "imported": 0, "pages": 0}
+        else:
+            print(f"Reprise : {len(state['pending'])} tuile(s) restante(s), {state['imported']} réseaux déjà importés")
+        self.state = state
+
+    def pending(self):
+        with self.lock:
+            return [(tuple(entry["tile"]), entry["cursor"]) for entry in self.state["pending"].values()]
+
+    def page_done(self, tile, cursor, imported):
+        """Page enregistrée en base : on avance le curseur de la tuile"""
+        with self.lock:
+            self.state["pending"][tile_key(tile)]["cursor"] = cursor
+            self.state["imported"] += imported
+            self.state["pages"] += 1
+            self._save()
+
+    def tile_done(self, tile, subtiles=()):
+        """Tuile finie (ou remplacée par ses sous-tuiles)"""
+        with self.lock:
+            del self.state["pending"][tile_key(tile)]
+            for sub in subtiles:
+                self.state["pending"][tile_key(sub)] = {"tile": list(sub), "cursor": None}
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# === CLIENT WIGLE ===
+class WigleError(Exception):
+    pass
+
+class WigleClient:
+    def __init__(self, base_url, auth, limiter):
+        self.url = base_url.rstrip("/") + SEARCH_PATH
+        self.limiter = limiter
+        self.local = threading.local() # une session HTTP par thread
+        self.headers = {"Authorization": f"Basic {auth}", "Accept": "application/json"}
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers.update(self.headers)
+        return self.local.session
+
+    def search(self, tile, cursor=None):
+        """Une page de résultats pour la tuile (lat_min, lat_max, lon_min, lon_max)"""
+        params = {
+            "onlymine": "false",       # Chercher dans toute la base
+            "latrange1": tile[0],      # Latitude min
+            "latrange2": tile[1],      # Latitude max
+            "longrange1": tile[2],     # Longitude min
+            "longrange2": tile[3],     # Longitude max
+            "freenet": "false",        # Tout type de réseau (pas que les gratuits)
+            "paynet": "false",
+            "resultsPerPage": RESULTS_PER_PAGE
+        }
+        if cursor is not None:
+            params["searchAfter"] = cursor
+
+        for attempt in range(MAX_RETRIES):
+            self.limiter.acquire()
+            try:
+                response = self._session().get(self.url, params=params, timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                print(f"Erreur réseau ({e}), nouvel essai")
+                time.sleep(2 ** attempt)
+                continue
+
+            if response.status_code == 200:
+                data = response.json()
+                if not data.get("success", False):
+                    raise WigleError(f"Erreur API : {data}")
+                return data
+            if response.status_code == 401:
+                raise WigleError("Erreur 401 : Authentification refusée. Vérifie ton token 'Encoded for use'.")
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = retry_after(response.headers.get("Retry-After"), 2 ** attempt)
+                print(f"Erreur HTTP {response.status_code}, pause de {delay:.0f} s")
+                self.limiter.pause(delay)
+                continue
+            raise WigleError(f"Erreur HTTP {response.status_code}")
+        raise WigleError(f"Abandon après {MAX_RETRIES} essais pour la tuile {tile}")
+
+def retry_after(value, default):
+    """Pause demandée par l'en-tête Retry-After (secondes ou date HTTP), default s'il est absent ou illisible"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+# === IMPORT ===
+def split_tile(tile):
+    """Découpe une tuile en 4"""
+    lat_min, lat_max, lon_min, lon_max = tile
+    lat_mid, lon_mid = (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+    return [(lat_min, lat_mid, lon_min, lon_mid), (lat_min, lat_mid, lon_mid, lon_max),
+            (lat_mid, lat_max, lon_min, lon_mid), (lat_mid, lat_max, lon_mid, lon_max)]
+
+def to_prior(net):
+    """Résultat WiGLE -> ligne de ap_priors (None si inutilisable)"""
+    if not net.get("netid") or net.get("trilat") is None or net.get("trilong") is None:
+        return None
+    return {
+        "mac": net["netid"].upper(),   # L'adresse MAC (BSSID), même format que la table fingerprints
+        "ssid": net.get("ssid"),       # Le nom du réseau
+        "latitude": net["trilat"],     # Position triangulée par WiGLE
+        "longitude": net["trilong"],
+        "last_update": net.get("lastupdt") or "",
+        "source": "wigle"
     }
 
+class Importer:
+    def __init__(self, client, db_file, checkpoint):
+        self.client = client
+        self.checkpoint = checkpoint
+        self.conn = fingerprint_store.connect(db_file, check_same_thread=False)
+        self.db_lock = threading.Lock() # une seule connexion SQLite partagée par les threads
+        self.stop = threading.Event()   # erreur dans une tuile : les autres s'arrêtent à la fin de leur page
+
+    def fetch_tile(self, tile, cursor):
+        """
+        Télécharge toutes les pages d'une tuile (en reprenant au curseur sauvegardé).
+        Renvoie les sous-tuiles à télécharger si la tuile a trop de résultats.
+        """
+        while not self.stop.is_set():
+            data = self.client.search(tile, cursor)
+            total = data.get("totalResults", 0)
+            if cursor is None and total > MAX_RESULTS_PER_TILE and min(tile[1] - tile[0], tile[3] - tile[2]) > MIN_TILE_SIZE:
+                subtiles = split_tile(tile)
+                self.checkpoint.tile_done(tile, subtiles)
+                print(f"Tuile {tile_key(tile)} : {total} réseaux, découpée en 4")
+                return subtiles
+
+            records = [prior for prior in map(to_prior, data.get("results", [])) if prior is not None]
+            with self.db_lock:
+                fingerprint_store.upsert_ap_priors(self.conn, records)
+            cursor = data.get("searchAfter")
+            self.checkpoint.page_done(tile, cursor, len(records))
+
+            if not cursor or not data.get("results"):
+                self.checkpoint.tile_done(tile)
+                return []
+        return [] # import arrêté : la tuile reprendra au curseur sauvegardé
+
+    def run(self, workers):
+        """
+        Télécharge toutes les tuiles en attente, WORKERS à la fois.
+        Une erreur (WigleError, interruption) arrête toutes les tuiles et ferme la base avant d'être renvoyée.
+        """
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            running = {pool.submit(self.fetch_tile, tile, cursor) for tile, cursor in self.checkpoint.pending()}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for sub in future.result():
+                        running.add(pool.submit(self.fetch_tile, sub, None))
+        finally:
+            self.stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.conn.close()
+        return self.checkpoint.state["imported"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Import des points d'accès WiGLE dans la table ap_priors")
+    parser.add_argument("--bbox", nargs=4, type=float, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"),
+                        default=[LAT_MIN, LAT_MAX, LON_MIN, LON_MAX])
+    parser.add_argument("--db", default=DB_FILE, help="base SQLite de destination")
+    parser.add_argument("--base-url", default=WIGLE_URL, help="adresse de l'API WiGLE")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="requêtes par seconde max")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="tuiles téléchargées en parallèle")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="fichier de reprise")
+    args = parser.parse_args()
+    if not WIGLE_AUTH:
+        raise SystemExit("Variable d'environnement WIGLE_AUTH absente : mettre la chaîne \"Encoded for use\" "
+                         "de son compte WiGLE (export WIGLE_AUTH=...)")
+
     print("Interrogation de WiGLE...")
+    checkpoint = Checkpoint(args.checkpoint, args.bbox)
+    importer = Importer(WigleClient(args.base_url, WIGLE_AUTH, RateLimiter(args.rate)), args.db, checkpoint)
     try:
-        response = requests.get(url, headers=headers, params=params)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if data["success"]:
-                results = data["results"]
-                count = len(results)
-                print(f"{count} réseaux trouvés !")
-                
-                # Sauvegarde en CSV
-                save_to_csv(results)
-            else:
-                print("Erreur API :", data)
-        elif response.status_code == 401:
-            print("Erreur 401 : Authentification refusée. Vérifie ton token 'Encoded for use'.")
-        else:
-            print(f"Erreur HTTP {response.status_code}")
-            
-    except Exception as e:
-        print(f"Erreur script : {e}")
-
-def save_to_csv(networks):
-    # On ne garde que ce qui est utile pour la géoloc
-    # netid = MAC Address
-    # ssid = Nom
-    # trilat/trilong = Position triangulée par WiGLE
-    
-    with open(OUTPUT_FILE, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        # En-têtes
-        writer.writerow(["mac", "ssid", "lat", "lon", "rssi_avg"])
-        
-        for net in networks:
-            writer.writerow([
-                net.get("netid"),    # L'adresse MAC (BSSID)
-                net.get("ssid"),     # Le nom du réseau
-                net.get("trilat"),   # Latitude connue
-                net.get("trilong"),  # Longitude connue
-                net.get("rssi")      # Signal moyen (pour info)
-            ])
-            
-    print(f"Base de données sauvegardée dans '{OUTPUT_FILE}'")
+        imported = importer.run(args.workers)
+    except WigleError as e:
+        print(f"{e}\nImport interrompu, relancer la même commande pour reprendre.")
+        raise SystemExit(1)
+    checkpoint.finish()
+    print(f"{imported} réseaux importés dans '{args.db}' (table ap_priors)")
 
 if __name__ == "__main__":
-    fetch_wigle_data()
\ No newline at end of file
+    main()
@@ -0,0 +1,137 @@
+"""
+Décodage des uplinks LoRa envoyés par scan/scan.ino et regroupement des trames d'un même scan.
+
+Un point d'accès = bloc de 7 octets : [MAC 6 octets][RSSI 1 octet signé]
+- FPort FPORT_MULTI_FRAME : en-tête de 2 octets [scan_id][index << 4 | nombre de trames],
+  puis les blocs. Un scan est découpé en plusieurs trames (7 APs max par trame).
+- Autres FPorts (ancien firmware) : pas d'en-tête, une trame = un scan complet.
+
+Les MAC sont gardées en entiers (48 bits) ; la conversion en texte "AA:BB:CC:DD:EE:FF"
+n'est faite qu'au besoin (mac_to_str).
+"""
+import struct
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+AP_RECORD = struct.Struct(">6sb")   # MAC (6 octets) + RSSI (int8)
+FPORT_MULTI_FRAME = 2               # FPort des trames avec en-tête (scan.ino : AT+PORT=2)
+HEADER_SIZE = 2
+
+# Regroupement : un scan incomplet est utilisé tel quel (avec les trames reçues) si
+# - le compteur de trames LoRa (fCnt) a avancé de plus de (nombre de trames + REASSEMBLY_FCNT_WINDOW)
+#   depuis sa première trame (trames perdues), ou a reculé de plus de REASSEMBLY_FCNT_WINDOW (redémarrage / join ;
+#   un petit recul vient de trames traitées dans le désordre : webhooks concurrents, UPLINK_WORKERS > 1)
+# - ou si sa première trame date de plus de REASSEMBLY_TIMEOUT secondes
+REASSEMBLY_FCNT_WINDOW = 4
+REASSEMBLY_TIMEOUT = 300.0
+
+# ==========================================
+# MAC
+# ==========================================
+def mac_to_int(mac_str):
+    """ "AA:BB:CC:DD:EE:FF" -> 0xAABBCCDDEEFF (ValueError si ce n'est pas une MAC) """
+    digits = mac_str.replace(":", "").replace("-", "")
+    if len(digits) != 12:
+        raise ValueError(f"MAC invalide : {mac_str}")
+    return int(digits, 16)
+
+def mac_to_str(mac):
+    """ 0xAABBCCDDEEFF -> "AA:BB:CC:DD:EE:FF" """
+    return mac.to_bytes(6, "big").hex(":").upper()
+
+# ==========================================
+# DÉCODAGE
+# ==========================================
+def decode_ap_blocks(raw_bytes):
+    """
+    Parsing des blocs de 7 octets (6 MAC + 1 RSSI) : [MAC1][RSSI1][MAC2][RSSI2]...
+    Renvoie un dictionnaire { mac entier: rssi }
+    Lève ValueError si la longueur n'est pas un multiple de 7 (payload tronqué).
+    """
+    if len(raw_bytes) % AP_RECORD.size:
+        raise ValueError(f"payload tronqué : {len(raw_bytes)} octets (pas un multiple de {AP_RECORD.size})")
+    return {int.from_bytes(mac, "big"): rssi for mac, rssi in AP_RECORD.iter_unpack(raw_bytes)}
+
+class LoraFrame:
+    """Une trame LoRa décodée (une partie d'un scan, ou un scan complet si count == 1)"""
+    __slots__ = ("scan_id", "index", "count", "fcnt", "networks", "timestamp")
+
+    def __init__(self, scan_id, index, count, fcnt, networks, timestamp):
+        self.scan_id = scan_id
+        self.index = index
+        self.count = count
+        self.fcnt = fcnt
+        self.networks = networks
+        self.timestamp = timestamp
+
+def decode_frame(raw_bytes, fport, fcnt, timestamp):
+    """
+    Décode une trame selon son FPort.
+    fcnt : compteur de trames LoRaWAN (None si inconnu), timestamp : heure de réception (secondes)
+    """
+    if fport != FPORT_MULTI_FRAME:
+        return LoraFrame(None, 0, 1, fcnt, decode_ap_blocks(raw_bytes), timestamp)
+
+    if len(raw_bytes) < HEADER_SIZE:
+        raise ValueError("trame sans en-tête")
+    scan_id = raw_bytes[0]
+    index, count = raw_bytes[1] >> 4, raw_bytes[1] & 0x0F
+    if count == 0 or index >= count:
+        raise ValueError(f"en-tête invalide : trame {index}/{count}")
+    return LoraFrame(scan_id, index, count, fcnt, decode_ap_blocks(raw_bytes[HEADER_SIZE:]), timestamp)
+
+# ==========================================
+# REGROUPEMENT DES TRAMES
+# ==========================================
+class ScanReassembler:
+    """
+    Regroupe les trames d'un même scan (un objet par appareil).
+    add() renvoie la liste des scans terminés : [(réseaux, timestamp, trames reçues, trames attendues)],
+    dans l'ordre des timestamps. Le timestamp d'un scan est celui de sa première trame reçue.
+    """
+    def __init__(self):
+        self.pending = {} # scan_id -> {"frames": {index: réseaux}, "count", "fcnt", "timestamp"}
+
+    def add(self, frame):
+        done = self.flush_stale(frame.fcnt, frame.timestamp)
+
+        if frame.count == 1:
+            done.append((frame.networks, frame.timestamp, 1, 1))
+        else:
+            entry = self.pending.get(frame.scan_id)
+            if entry is None or entry["count"] != frame.count:
+                if entry is not None: # scan_id réutilisé (compteur 8 bits) : l'ancien est terminé
+                    done.append(self._merge(self.pending.pop(frame.scan_id)))
+                entry = {"frames": {}, "count": frame.count, "fcnt": frame.fcnt, "timestamp": frame.timestamp}
+                self.pending[frame.scan_id] = entry
+            entry["frames"][frame.index] = frame.networks
+            if frame.fcnt is not None and (entry["fcnt"] is None or frame.fcnt < entry["fcnt"]):
+                entry["fcnt"] = frame.fcnt
+            entry["timestamp"] = min(entry["timestamp"], frame.timestamp)
+            if len(entry["frames"]) == entry["count"]:
+                done.append(self._merge(self.pending.pop(frame.scan_id)))
+
+        done.sort(key=lambda scan: scan[1])
+        return done
+
+    def flush_stale(self, fcnt, now):
+        """Sort les scans qui n'ont plus de chance d'être complétés (trames perdues)"""
+        done = []
+        for scan_id in list(self.pending):
+            entry = self.pending[scan_id]
+            lost = False
+            if fcnt is not None and entry["fcnt"] is not None:
+                # fCnt qui recule nettement : l'appareil a redémarré / refait un join
+                lost = (entry["fcnt"] - fcnt > REASSEMBLY_FCNT_WINDOW
+                        or fcnt - entry["fcnt"] >= entry["count"] + REASSEMBLY_FCNT_WINDOW)
+            if lost or now - entry["timestamp"] > REASSEMBLY_TIMEOUT:
+                done.append(self._merge(self.pending.pop(scan_id)))
+        return done
+
+    @staticmethod
+    def _merge(entry):
+        networks = {}
+        for index in sorted(entry["frames"]):
+            networks.update(entry["frames"][index])
+        return networks, entry["timestamp"], len(entry["frames"]), entry["count"]
@@ -0,0 +1,152 @@
+"""
+Métriques du serveur au format texte Prometheus (exposées sur /metrics par server_geoloc.py).
+Compteurs, jauges et histogrammes de durée, sans dépendance externe.
+Chaque mesure coûte un verrou et quelques additions : négligeable devant un calcul WKNN.
+"""
+import bisect
+import threading
+import time
+import cProfile
+import io
+import pstats
+
+# Bornes des histogrammes de durée (secondes) : de 10 µs à 2,5 s
+DEFAULT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Toutes les métriques créées, dans l'ordre de création
+REGISTRY = []
+
+# ==========================================
+# MÉTRIQUES
+# ==========================================
+class Counter:
+    """Compteur qui ne fait qu'augmenter (ex: uplinks reçus)"""
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    """Valeur instantanée : fixée avec set(), ou lue à chaque export si une fonction est donnée"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.func = func
+        REGISTRY.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, self.func() if self.func is not None else self.value)]
+
+class Histogram:
+    """Répartition de durées (secondes) par tranches cumulées, plus somme et nombre"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # dernière case : au-delà de la dernière borne
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """with histogram.time(): ... mesure la durée du bloc"""
+        return Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{bound:g}"}}', cumulative))
+        cumulative += counts[-1]
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', cumulative))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", cumulative))
+        return samples
+
+class Timer:
+    """Chronomètre pour Histogram.time()"""
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+# ==========================================
+# EXPORT
+# ==========================================
+def render():
+    """Toutes les métriques au format texte Prometheus (version 0.0.4)"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ==========================================
+# PROFILAGE (à la demande)
+# ==========================================
+class RequestProfile:
+    """
+    Profil cProfile d'un bloc de code (une requête).
+    Le profileur n'est créé que pour les requêtes qui le demandent : aucun coût sinon.
+    """
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+        return False
+
+    def report(self, limit=20, sort="cumulative"):
+        """Les fonctions les plus coûteuses, en texte"""
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, path):
+        """Fichier .prof (lisible par pstats, snakeviz...)"""
+        self.profiler.dump_stats(path)
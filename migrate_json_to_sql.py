@@ -0,0 +1,31 @@
+import argparse
+import json
+import time
+import fingerprint_store
+
+# Import des bases JSON (database_wifi.json / database_wifi_clean.json) dans la base SQLite
+# Exemple : python migrate_json_to_sql.py database_wifi_clean.json --db database_wifi.db
+# Les lignes déjà présentes (même timestamp et même MAC) sont ignorées : on peut relancer sans doublons.
+
+def migrate(json_files, db_file):
+    conn = fingerprint_store.connect(db_file)
+    try:
+        for json_file in json_files:
+            start = time.perf_counter()
+            with open(json_file, 'r') as f:
+                records = json.load(f)
+            # ssid optionnel dans les vieux fichiers
+            for record in records:
+                record.setdefault("ssid", "")
+            added = fingerprint_store.insert_fingerprints(conn, records)
+            print(f"{json_file} : {added} lignes ajoutées, {len(records) - added} déjà présentes "
+                  f"({time.perf_counter() - start:.2f} s)")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import de fichiers JSON d'empreintes dans la base SQLite")
+    parser.add_argument("json_files", nargs="+", help="fichiers JSON à importer")
+    parser.add_argument("--db", default="database_wifi.db", help="base SQLite de destination")
+    args = parser.parse_args()
+    migrate(args.json_files, args.db)
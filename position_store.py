@@ -0,0 +1,145 @@
+import sqlite3
+import threading
+import math
+import numpy as np
+
+# Historique des positions calculées par server_geoloc.py (table "positions", fichier séparé des empreintes)
+# Une ligne par (appareil, scan) : une position recalculée pour le même scan remplace la précédente.
+# Écritures regroupées : append() ne fait que garder la position en mémoire, flush() les écrit
+# en une transaction (appelé périodiquement par le serveur, hors de la boucle asyncio).
+# Taille bornée par prune() : ancienneté max et nombre max de positions par appareil.
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS positions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        latitude REAL,
+        longitude REAL,
+        floor INTEGER,
+        accuracy REAL,
+        engine TEXT
+    );
+    -- Requêtes par appareil et plage de temps (et un seul point par scan)
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_device_timestamp ON positions (device, timestamp);
+    -- Nettoyage par ancienneté
+    CREATE INDEX IF NOT EXISTS idx_timestamp ON positions (timestamp);
+"""
+
+METERS_PER_DEGREE = 111320
+
+class PositionStore:
+    """Accès à la table positions, utilisable depuis plusieurs threads (une connexion, protégée par un verrou)"""
+    def __init__(self, db_file):
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Positions pas encore écrites : (appareil, timestamp) -> ligne (la dernière pour un même scan)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def append(self, device, position):
+        """Ajoute une position (dictionnaire d'algorithm_wknn), écrite au prochain flush()"""
+        row = (device, int(position["timestamp"]), position["lat"], position["lon"],
+               position.get("floor"), position.get("accuracy"), position.get("engine"))
+        with self.pending_lock:
+            self.pending[(device, row[1])] = row
+
+    def flush(self):
+        """Écrit les positions en attente en une transaction, renvoie leur nombre"""
+        with self.pending_lock:
+            rows, self.pending = list(self.pending.values()), {}
+        if not rows:
+            return 0
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO positions (device, timestamp, latitude, longitude, floor, accuracy, engine) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(device, timestamp) DO UPDATE SET latitude = excluded.latitude, longitude = excluded.longitude, "
+                "floor = excluded.floor, accuracy = excluded.accuracy, engine = excluded.engine",
+                rows
+            )
+        return len(rows)
+
+    def query(self, device, since=None, until=None, limit=500, cursor=None, descending=False):
+        """
+        Positions de l'appareil entre since et until (timestamps inclus), au plus limit,
+        dans l'ordre chronologique (ou inverse si descending).
+        cursor : next_cursor de la page précédente.
+        Renvoie (positions, next_cursor ou None si c'était la dernière page)
+        """
+        self.flush()
+        conditions = ["device = ?"]
+        params = [device]
+        if since is not None:
+            conditions.append("timestamp >= ?"); params.append(since)
+        if until is not None:
+            conditions.append("timestamp <= ?"); params.append(until)
+        if cursor is not None:
+            # Un seul point par (appareil, timestamp) : le timestamp suffit comme curseur
+            conditions.append("timestamp < ?" if descending else "timestamp > ?"); params.append(cursor)
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT timestamp, latitude, longitude, floor, accuracy, engine FROM positions "
+                f"WHERE {' AND '.join(conditions)} ORDER BY timestamp {'DESC' if descending else 'ASC'} LIMIT ?",
+                params
+            ).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        positions = [{"timestamp": ts, "lat": lat, "lon": lon, "floor": floor, "accuracy": accuracy, "engine": engine}
+                     for ts, lat, lon, floor, accuracy, engine in rows[:limit]]
+        return positions, next_cursor
+
+    def prune(self, max_age, max_per_device, now):
+        """Supprime les positions plus vieilles que max_age secondes et les plus anciennes au-delà de max_per_device"""
+        self.flush()
+        with self.lock, self.conn:
+            deleted = self.conn.execute("DELETE FROM positions WHERE timestamp < ?", (now - max_age,)).rowcount
+            for device, count in self.conn.execute(
+                    "SELECT device, count(*) FROM positions GROUP BY device HAVING count(*) > ?", (max_per_device,)).fetchall():
+                deleted += self.conn.execute(
+                    "DELETE FROM positions WHERE device = ? AND timestamp <= "
+                    "(SELECT timestamp FROM positions WHERE device = ? ORDER BY timestamp DESC LIMIT 1 OFFSET ?)",
+                    (device, device, max_per_device)
+                ).rowcount
+        return deleted
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+def simplify_track(positions, tolerance):
+    """
+    Simplification d'une trace (algorithme de Douglas-Peucker) : garde les points qui s'écartent
+    de plus de tolerance mètres de la trace simplifiée. Le premier et le dernier point sont toujours gardés.
+    """
+    if tolerance <= 0 or len(positions) <= 2:
+        return positions
+    lat0 = positions[0]["lat"]
+    y = np.array([p["lat"] for p in positions]) * METERS_PER_DEGREE
+    x = np.array([p["lon"] for p in positions]) * METERS_PER_DEGREE * math.cos(math.radians(lat0))
+    keep = np.zeros(len(positions), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        # Distance des points intermédiaires au segment [a, b]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        length2 = dx * dx + dy * dy
+        if length2 == 0:
+            dist = np.hypot(px, py)
+        else:
+            t = np.clip((px * dx + py * dy) / length2, 0, 1)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            keep[a + 1 + i] = True
+            stack.append((a, a + 1 + i))
+            stack.append((a + 1 + i, b))
+    return [p for p, k in zip(positions, keep) if k]
@@ -18,17 +18,24 @@ uint32_t timestamp = (uint32_t)time(NULL);  // timestamp (4 bytes)
 const char* ssid = "iPhon de Alexcouille (2)";
 const char* password = "bahenfaitnon";
 // serverurl : IP locale
-// const char* serverUrl = "http://172.20.10.8:8004/api/raw_scan";
+// const char* serverUrl = "http://172.20.10.8:8004/api/scan";
 // IP distante
-const char* serverUrl = "http://vps-98cd652a.vps.ovh.net:8004/api/raw_scan";
+const char* serverUrl = "http://vps-98cd652a.vps.ovh.net:8004/api/scan"; // scan complet en une requête
+
+// un scan est découpé en trames de 7 wifis max, envoyées sur le port LORA_PORT_MULTI
+// trame : [scan_id][index<<4 | nombre de trames] + 7 bytes par wifi ([MAC][RSSI])
+#define WIFI_PER_FRAME 7 // 2 + 7*7 = 51 octets, taille max d'un uplink en DR0 (EU868)
+#define MAX_FRAMES_PER_SCAN 2 // 14 wifis max par scan
+#define LORA_PORT_MULTI 2 // FPort des trames avec en-tête (le serveur regroupe les trames d'un même scan)
 
 typedef struct msg_lora_t{
-  uint8_t msg[49]; // 7 bytes par wifi * 7 wifis par message
+  uint8_t msg[2 + 7*WIFI_PER_FRAME]; // en-tête (2 bytes) + 7 bytes par wifi * 7 wifis par message
   int len;
 }msg_lora;
 
+uint8_t scan_id = 0; // identifiant du scan (compteur sur 8 bits), commun à toutes ses trames
 
-#define FIFO_SIZE 10 // 10 messages. define car utile pour savoir où arreter fifo_cpt
+#define FIFO_SIZE 20 // 20 messages (10 scans complets). define car utile pour savoir où arreter fifo_cpt
 msg_lora fifo_msg[FIFO_SIZE];
 
 int fifo_wr = 0; //où écrire
@@ -74,6 +81,9 @@ void setup(){
   if(TRANSMISSION_MODE == MODE_LORA){
     Serial.println("\n=== Scan WiFi + Envoi LoRaWAN ===");
     Serial2.println("AT+JOIN");
+    delay(100);
+    Serial2.print("AT+PORT=");
+    Serial2.println(LORA_PORT_MULTI);
     Serial.println("Setup LORA OK");
   }
   else{
@@ -170,20 +180,27 @@ void sendViaLoRa(int nb_wifi, int nb_total_wifi){
 
 ////////// ////////// ////////// //////////
 
-// Fonction pour envoyer en http
-void sendViaHTTP(int index){ // index du wifi dans la liste "WiFi" de la librairie
+// Fonction pour envoyer en http : tout le scan en une seule requête (n wifis de la librairie "WiFi")
+void sendScanViaHTTP(int n){
   if(WiFi.status() == WL_CONNECTED){
     HTTPClient http;
     http.begin(serverUrl);
     http.addHeader("Content-Type", "application/json");
 
-    // Crée un json pour le serveur
+    // Crée un json pour le serveur : {"timestamp", "device_id", "networks": [{"mac", "rssi", "ssid"}, ...]}
     // aussi envoi du ssid, pas nécessaire mais pratique pour du débug
-    StaticJsonDocument<200> doc;
+    DynamicJsonDocument doc(256 + 128*n);
     doc["timestamp"] = timestamp;
-    doc["mac"] = WiFi.BSSIDstr(index);
-    doc["rssi"] = WiFi.RSSI(index);
-    doc["ssid"] = WiFi.SSID(index);
+    doc["device_id"] = WiFi.macAddress(); // identifiant de l'appareil pour le suivi multi-appareils
+    JsonArray networks = doc.createNestedArray("networks");
+    for(int i=0; i<n; i++){
+      if(!(WiFi.BSSID(i)[0] & 0x02)){ // bit "locally administered" : partage de connexion, ignoré
+        JsonObject network = networks.createNestedObject();
+        network["mac"] = WiFi.BSSIDstr(i);
+        network["rssi"] = WiFi.RSSI(i);
+        network["ssid"] = WiFi.SSID(i);
+      }
+    }
 
     String requestBody;
     serializeJson(doc, requestBody);
@@ -277,7 +294,8 @@ void loop(){
     int n = WiFi.scanNetworks();
     if(n == 0) Serial.println("Aucun réseau trouvé");
     else{ // réseaux trouvés
-      int nb_wifi_vrai = (7 < n) ? 7 : n;
+      int nb_wifi_max = WIFI_PER_FRAME * MAX_FRAMES_PER_SCAN;
+      int nb_wifi_vrai = (nb_wifi_max < n) ? nb_wifi_max : n;
       uint8_t msg[7*nb_wifi_vrai];
 
       //trouver les nb_wifi_vrai wifis avec les rssis les plus grands, et les stocker dans le message
@@ -301,15 +319,23 @@ void loop(){
         i_prev_max = i_max;
         max = -128;
       }
-      if(TRANSMISSION_MODE == MODE_LORA) save_fifo(msg, 7 * nb_wifi_vrai);
+      if(TRANSMISSION_MODE == MODE_LORA){
+        // découpage du scan en trames de WIFI_PER_FRAME wifis, même scan_id pour toutes
+        int nb_frames = (nb_wifi_vrai + WIFI_PER_FRAME - 1) / WIFI_PER_FRAME;
+        uint8_t frame[2 + 7*WIFI_PER_FRAME];
+        for(int f=0; f<nb_frames; f++){
+          int nb_wifi_frame = nb_wifi_vrai - f*WIFI_PER_FRAME;
+          if(nb_wifi_frame > WIFI_PER_FRAME) nb_wifi_frame = WIFI_PER_FRAME;
+          frame[0] = scan_id;
+          frame[1] = (f << 4) | nb_frames;
+          memcpy(&frame[2], &msg[7*WIFI_PER_FRAME*f], 7*nb_wifi_frame);
+          save_fifo(frame, 2 + 7*nb_wifi_frame);
+        }
+        scan_id++;
+      }
       else{ //mode HTTP
         timestamp = (uint32_t)time(NULL);
-        for(int i=0; i<n; i++){
-           if(!(WiFi.BSSID(i)[0] & 0x02)){
-              sendViaHTTP(i);
-              delay(100);
-           }
-        }
+        sendScanViaHTTP(n); // une seule requête pour tout le scan
       }//fin mode http
       // affichage
       String time_str = getTimeString(); //jolie heure
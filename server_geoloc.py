@@ -1,16 +1,35 @@
 import uvicorn
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Query, Header
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response
+from pydantic import BaseModel, Field, ValidationError
+from typing import Dict, List, Literal, Optional
 import json
 import os
-import math
+import sys
 import time
-from collections import defaultdict, deque
+import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 import base64 #decode lora
 import logging #debug
 import sqlite3 #database sql
+import argparse #options de lancement (--workers)
+import subprocess #construction de l'instantané à part
+from datetime import datetime, timezone
+from wknn_engine import IndexBuilder, compute_distances, estimate_from_distances, locate_batch, has_candidates #calcul vectorisé
+from wknn_engine import save_snapshot, load_snapshot, read_snapshot_meta #instantané binaire
+from fingerprint_store import iter_json_records #lecture json en flux
+from lora_payload import decode_ap_blocks, decode_frame, mac_to_int, ScanReassembler #payload lora, MAC en entiers
+import metrics #métriques prometheus (/metrics)
+from metrics import Counter, Gauge, Histogram, RequestProfile
+from tracking import KalmanTracker, SEARCH_MAX_RADIUS #filtre de suivi par appareil
+from ap_locator import APLocator, read_ap_priors, FIT_CENTROID #localisation par position des routeurs
+import fingerprint_cleaning #nettoyage automatique des empreintes
+from fingerprint_cleaning import ScanCleaner, clean_scan, drop_spread_aps, bssid_family, is_locally_administered
+from position_store import PositionStore, simplify_track #historique des positions (sqlite)
+from session_store import MemorySessionStore, SqliteSessionStore #état des appareils (mémoire ou sqlite partagé)
 
 
 # Configuration logging : equivalent à print
@@ -33,11 +52,79 @@ DB_FILE = "database_wifi.db"
 MODE_JSON = "JSON"
 MODE_SQL = "SQL"
 MODE_DB = MODE_SQL
+DB_WATCH_INTERVAL = 0    # Secondes entre deux vérifications du fichier DB_FILE (0 = pas de surveillance)
+# Instantané binaire de la base compilée (DB_FILE + ".snap") : démarrage en mmap sans relire la base.
+# Reconstruit automatiquement quand DB_FILE a changé (ou avec : python build_snapshot.py)
+USE_SNAPSHOT = True
+# Nettoyage automatique des empreintes au chargement et des scans live (partages de connexion,
+# scans répétés, routeurs mobiles... réglages dans fingerprint_cleaning.py)
+CLEAN_DATABASE = True
+# Jeton pour les routes /api/admin/* (en-tête X-Admin-Token), pas de vérification si vide
+ADMIN_TOKEN = os.environ.get("GEOLOC_ADMIN_TOKEN", "")
 
 
 # --- Paramètres de l'Algorithme ---
-K_NEIGHBORS = 5          # Nombre de voisins à considérer (k-NN)
-HISTORY_SIZE = 100       # Nombre de positions passées à garder en mémoire
+K_NEIGHBORS = 5          # Nombre de voisins à considérer (k-NN), par défaut
+MAX_K_NEIGHBORS = 50     # Valeur maximale acceptée pour ?k= dans /api/get_position
+HISTORY_SIZE = 100       # Nombre de positions de la trace affichée sur la carte (chargées depuis /api/history)
+
+# --- Suivi des déplacements (filtre de Kalman par appareil, voir tracking.py) ---
+TRACKING_FILTER = True         # Lisse les positions successives de chaque appareil (False : positions WKNN brutes)
+POOR_MATCH_RMS = 50.0          # Écart RSSI moyen par routeur (dBm) au-delà duquel la recherche dans la zone prédite est jugée mauvaise
+SEARCH_WIDEN_FACTOR = 4.0      # Agrandissement de la zone de recherche quand la correspondance est mauvaise
+
+# --- Localisation par position des routeurs (voir ap_locator.py) ---
+AP_FALLBACK = True             # Scan sans routeur commun avec les empreintes : position déduite des routeurs connus
+AP_PREFILTER = False           # Sans zone prédite par le suivi : recherche WKNN d'abord autour de la position des routeurs
+AP_PREFILTER_RADIUS = 100.0    # Rayon (m) de cette zone (agrandie comme celle du suivi si la correspondance est mauvaise)
+AP_FIT = FIT_CENTROID          # Barycentre des routeurs (FIT_LSQ : multilatération)
+AP_PRIORS_DB = "database_wifi.db" # Base SQLite avec la table ap_priors (import_wigle.py), ignorée si absente
+
+# --- Historique des positions (base SQLite, voir position_store.py) ---
+HISTORY_DB = "positions.db"          # Séparée de la base d'empreintes
+HISTORY_FLUSH_INTERVAL = 1.0         # Secondes entre deux écritures groupées
+HISTORY_RETENTION = 30 * 24 * 3600   # Secondes : les positions plus anciennes sont supprimées
+HISTORY_MAX_PER_DEVICE = 100000      # Positions max gardées par appareil (les plus anciennes sont supprimées)
+HISTORY_PRUNE_INTERVAL = 3600.0      # Secondes entre deux suppressions
+HISTORY_PAGE_SIZE = 500              # Positions par page de /api/history, par défaut
+HISTORY_MAX_PAGE_SIZE = 5000         # Valeur maximale acceptée pour ?limit=
+
+# --- Suivi multi-appareils ---
+DEFAULT_DEVICE_ID = "esp32"    # Appareil des anciens envois sans identifiant (les ESP32 envoient leur MAC, TTN son device_id)
+DEVICE_IDLE_TIMEOUT = 3600.0   # Secondes sans données avant d'oublier un appareil
+MAX_DEVICES = 10000            # Nombre max d'appareils gardés en mémoire (les plus anciens sont supprimés)
+
+# --- Production : plusieurs processus (python server_geoloc.py --workers 4) ---
+# Chaque processus charge l'instantané de la base en mmap : une seule copie en mémoire, partagée par le système
+# (instantané construit avant le lancement des processus). L'état des appareils est dans SESSION_DB (SQLite WAL)
+# pour que n'importe quel processus puisse traiter n'importe quel appareil.
+WORKERS = int(os.environ.get("GEOLOC_WORKERS", "1"))   # Fixé par --workers (1 : tout en mémoire, rechargement du code)
+SESSION_DB = "sessions.db"
+SNAPSHOT_WATCH_INTERVAL = 2.0  # Secondes entre deux vérifications de l'instantané (reconstruit par un autre processus)
+STREAM_POLL_INTERVAL = 0.5     # Secondes entre deux lectures des dernières positions pour le flux temps réel
+
+# --- Flux temps réel (Server-Sent Events, /api/stream) ---
+STREAM_QUEUE_SIZE = 20         # Positions en attente max par page web (les plus anciennes sont jetées)
+STREAM_KEEPALIVE = 15.0        # Secondes entre deux messages de statut si aucune nouvelle position
+
+# --- File d'attente des uplinks TTN ---
+UPLINK_QUEUE_SIZE = 1000       # Uplinks en attente max (au-delà : refusés avec 503 et comptés dans "dropped")
+UPLINK_WORKERS = 4             # Nombre de traitements en parallèle (décodage + WKNN dans un pool de threads)
+
+# --- Scans HTTP complets (/api/scan) ---
+MAX_SCAN_NETWORKS = 255        # Nombre max de réseaux dans un scan
+# --- Scans HTTP réseau par réseau (/api/raw_scan, ancien firmware) ---
+RAW_SCAN_SETTLE = 1.0          # Secondes sans nouveau réseau avant de considérer le scan complet
+
+# --- Localisation par lots (/api/locate_batch) ---
+MAX_BATCH_SCANS = 100000       # Nombre max de scans par requête
+MAX_BATCH_WORKERS = 8          # Nombre max de processus de calcul par requête
+
+# --- Mesures (/metrics) et profilage ---
+# Profilage cProfile à la demande (?profile=1 ou en-tête X-Profile: 1), désactivé par défaut :
+# sans GEOLOC_PROFILING=1, aucun code de profilage n'est installé
+PROFILING = os.environ.get("GEOLOC_PROFILING", "") == "1"
+PROFILE_DIR = "profiles"       # Fichiers .prof des requêtes profilées
 
 # --- Mode de Communication ---
 MODE_WIFI = "WIFI"
@@ -48,22 +135,112 @@ CURRENT_MODE = MODE_LORA
 # 2. INITIALISATION & MÉMOIRE
 # ==========================================
 
-app = FastAPI(title="Traqueur de position ESP32")
+# Métriques exportées sur /metrics (voir metrics.py)
+DECODE_SECONDS = Histogram("geoloc_uplink_decode_seconds", "Décodage d'un uplink LoRa (JSON TTN + payload)")
+SCORING_SECONDS = Histogram("geoloc_wknn_scoring_seconds", "Calcul des distances RSSI avec les empreintes candidates")
+TOPK_SECONDS = Histogram("geoloc_wknn_topk_seconds", "Sélection des k plus proches voisins et moyenne pondérée")
+SERIALIZE_SECONDS = Histogram("geoloc_response_serialization_seconds", "Sérialisation JSON des réponses et des messages SSE")
+UPLINK_LAG_SECONDS = Histogram("geoloc_uplink_lag_seconds", "Temps entre la réception d'un webhook TTN et la fin de son traitement")
+UPLINKS_TOTAL = Counter("geoloc_uplinks_total", "Webhooks TTN reçus")
+UPLINKS_DROPPED = Counter("geoloc_uplinks_dropped_total", "Webhooks TTN refusés (file pleine)")
+UPLINKS_PROCESSED = Counter("geoloc_uplinks_processed_total", "Webhooks TTN traités")
+DECODE_ERRORS = Counter("geoloc_decode_errors_total", "Webhooks TTN illisibles (JSON, payload absent ou tronqué)")
+INVALID_MAC_ROWS = Counter("geoloc_invalid_mac_rows_total", "Lignes de la base ignorées au chargement (MAC illisible)")
+PROCESSING_ERRORS = Counter("geoloc_uplink_processing_errors_total", "Webhooks TTN décodés mais en erreur au calcul de position")
+WIFI_SCANS_TOTAL = Counter("geoloc_wifi_networks_total", "Réseaux reçus en mode WiFi (/api/raw_scan et /api/scan)")
+HTTP_SCANS_TOTAL = Counter("geoloc_http_scans_total", "Scans complets reçus en une requête (/api/scan)")
+POSITIONS_TOTAL = Counter("geoloc_positions_total", "Positions calculées pour un nouveau scan")
+CALIBRATING_TOTAL = Counter("geoloc_calibrating_total", "Scans sans correspondance dans la base (statut calibrating)")
+OFFLINE_TOTAL = Counter("geoloc_offline_responses_total", "Réponses offline envoyées aux pages web")
+SEARCH_RADIUS_METERS = Histogram("geoloc_search_radius_meters", "Rayon de la zone de recherche retenue autour de la position prédite",
+                                 buckets=(25, 50, 100, 200, 400, 800, 1600, SEARCH_MAX_RADIUS))
+SEARCH_WIDENED = Counter("geoloc_search_widened_total", "Zones de recherche agrandies (correspondance mauvaise)")
+SEARCH_FULL = Counter("geoloc_search_full_total", "Recherches dans toute la base (pas de prédiction, ou zone trop grande)")
+AP_FALLBACK_TOTAL = Counter("geoloc_ap_fallback_total", "Positions calculées par position des routeurs (aucune empreinte en commun)")
+
+class TimedJSONResponse(JSONResponse):
+    """Réponse JSON par défaut, avec mesure de la sérialisation"""
+    def render(self, content):
+        with SERIALIZE_SECONDS.time():
+            return super().render(content)
+
+app = FastAPI(title="Traqueur de position ESP32", default_response_class=TimedJSONResponse)
 templates = Jinja2Templates(directory="templates")
 
-# Base de données des empreintes (chargée au démarrage)
-#C'est une liste de dictionnaires : chaque élément contient la position géographique,
-#et un dictionnaire du type mac:rssi
-fingerprint_db = []
+# Base de données des empreintes (chargée au démarrage), compilée en matrice creuse numpy
+# + index inversé MAC -> empreintes (voir wknn_engine.py).
+# Jamais modifiée sur place : un rechargement construit un nouvel index puis remplace la référence,
+# les calculs en cours gardent donc une base cohérente.
+fingerprint_index = None
+# Dernière ligne chargée, pour ne relire que les ajouts (id SQLite en mode SQL, timestamp en mode JSON)
+db_last_rowid = 0
+db_last_timestamp = 0
+# Nettoyage en flux des lignes lues (garde les scans déjà vus, pour les rechargements incrémentaux)
+scan_cleaner = ScanCleaner()
+# Routeurs mobiles retirés de l'index (voir drop_spread_aps), retirés à nouveau à chaque rechargement incrémental
+spread_dropped_macs = set()
+# Position de chaque routeur (relevé + WiGLE), reconstruite à chaque chargement de la base (voir ap_locator.py)
+ap_locator = None
+
+# État de suivi de chaque appareil (un buffer, une date de màj et une dernière position par ESP32)
+class DeviceSession:
+    def __init__(self, device_id):
+        self.device_id = device_id
+        # Buffer du dernier scan
+        # Structure : { MAC (entier 0xAABBCCDDEEFF): RSSI, ... }
+        self.wifi_buffer = {}
+        self.last_buffer_update = 0
+        # Heure (envoyée par l'ESP32) du scan dans le buffer : les réseaux d'un même scan ont la même
+        self.buffer_timestamp = None
+        # Réseaux reçus dans le buffer depuis le dernier calcul (mode HTTP réseau par réseau, voir finish_scan)
+        self.scan_pending = False
+        # Position calculée une seule fois à la réception du scan, servie telle quelle aux pages web
+        # Structure : { k: position }, vidé à chaque nouveau scan (k = K_NEIGHBORS calculé d'office)
+        self.positions = {}
+        self.scan_timestamp = 0
+        # Réseaux du scan de cette position (le buffer peut déjà contenir le début du scan suivant)
+        self.scan_networks = {}
+        # Incrémenté à chaque modification du buffer : un calcul lancé sur un buffer
+        # qui a changé depuis est ignoré (un calcul plus récent est en cours)
+        self.scan_seq = 0
+        # Dernière position calculée (l'historique est dans position_store, voir /api/history)
+        self.last_position = None
+        # Trames LoRa en attente des autres trames du même scan
+        self.reassembler = ScanReassembler()
+        # Filtre de suivi : lisse les positions et prédit où chercher le prochain scan
+        self.tracker = KalmanTracker()
+        self.last_search_radius = None
+
+# Sessions par identifiant d'appareil (TTN end_device_ids.device_id ou device_id HTTP), ouvert au démarrage :
+# dans le processus, ou dans SESSION_DB quand plusieurs processus se partagent les appareils (voir session_store.py)
+session_store = None
+# Thread des modifications de sessions en mode partagé (transactions SQLite hors de la boucle asyncio)
+session_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+
+# File d'attente des webhooks TTN (créée au démarrage, dans la boucle asyncio) :
+# le webhook est acquitté tout de suite, le décodage et le calcul sont faits par les workers
+uplink_queue = None
+# Pool de threads pour les calculs (décodage, WKNN) : la boucle asyncio reste libre pour les pages web
+compute_executor = ThreadPoolExecutor(max_workers=UPLINK_WORKERS, thread_name_prefix="wknn")
+# Retards de traitement de la file (voir /api/ingest_stats), les compteurs sont dans les métriques
+ingest_stats = {"lag_last": 0.0, "lag_max": 0.0, "lag_total": 0.0}
 
-# Buffer pour le mode WiFi (car l'ESP32 envoie les réseaux un par un)
-# Structure : { "MAC_ADDRESS": RSSI, ... }
-current_wifi_buffer = {}
-last_buffer_update = 0
+# Historique des positions de tous les appareils (ouvert au démarrage)
+position_store = None
 
-# Historique des positions calculées
-# On utilise 'deque' pour limiter automatiquement la taille (FIFO)
-position_history = deque(maxlen=HISTORY_SIZE)
+# Pages web abonnées au flux de positions : { device_id: set(asyncio.Queue) }
+# Indépendant des sessions : on peut s'abonner à un appareil avant son premier uplink
+stream_subscribers = defaultdict(set)
+
+# Jauges lues à chaque export de /metrics
+Gauge("geoloc_fingerprints", "Empreintes dans la base chargée", lambda: len(fingerprint_index) if fingerprint_index is not None else 0)
+Gauge("geoloc_macs", "Adresses MAC connues dans la base chargée", lambda: len(fingerprint_index.mac_index) if fingerprint_index is not None else 0)
+Gauge("geoloc_located_aps", "Routeurs de position connue (relevé + WiGLE)", lambda: len(ap_locator) if ap_locator is not None else 0)
+Gauge("geoloc_active_devices", "Appareils suivis (sessions gardées)", lambda: len(session_store) if session_store is not None else 0)
+Gauge("geoloc_offline_devices", "Appareils suivis sans données récentes",
+      lambda: len(session_store) - session_store.count_updated_since(time.time() - offline_timeout()) if session_store is not None else 0)
+Gauge("geoloc_uplink_queue_depth", "Webhooks TTN en attente de traitement", lambda: uplink_queue.qsize() if uplink_queue is not None else 0)
+Gauge("geoloc_stream_subscribers", "Pages web abonnées au flux de positions", lambda: sum(len(queues) for queues in stream_subscribers.values()))
 
 # Modèle de données reçu depuis l'ESP32 (Mode WiFi)
 class WifiScanData(BaseModel):
@@ -71,39 +248,105 @@ class WifiScanData(BaseModel):
     ssid: str
     mac: str
     rssi: int
+    device_id: str = DEFAULT_DEVICE_ID
+
+# Un réseau d'un scan complet (Mode WiFi, /api/scan)
+class ScanNetwork(BaseModel):
+    mac: str
+    rssi: int
+    ssid: str = ""
+
+# Un scan complet envoyé en une seule requête (Mode WiFi, /api/scan)
+class ScanBatch(BaseModel):
+    timestamp: int
+    device_id: str = DEFAULT_DEVICE_ID
+    networks: List[ScanNetwork] = Field(..., max_length=MAX_SCAN_NETWORKS)
+
+# Un scan à relocaliser : payload LoRa brut (frm_payload en base64) ou dictionnaire MAC -> RSSI
+class BatchScan(BaseModel):
+    payload: Optional[str] = None
+    aps: Optional[Dict[str, int]] = None
+    timestamp: Optional[int] = None
+
+class LocateBatchRequest(BaseModel):
+    scans: List[BatchScan] = Field(..., max_length=MAX_BATCH_SCANS)
+    k: int = Field(K_NEIGHBORS, ge=1, le=MAX_K_NEIGHBORS)
+    workers: int = Field(1, ge=1, le=MAX_BATCH_WORKERS)
 
 # ==========================================
 # 3. FONCTIONS
 # ==========================================
 
+def read_json_rows(min_timestamp=0):
+    """
+    Lignes du fichier JSON (ou NDJSON) dont le timestamp est > min_timestamp, lues en flux :
+    tuples (timestamp, mac entière, rssi, latitude, longitude, floor). Les lignes à MAC illisible sont ignorées.
+    """
+    invalid = 0
+    try:
+        for entry in iter_json_records(DB_FILE):
+            if entry['timestamp'] > min_timestamp:
+                try:
+                    mac = mac_to_int(entry['mac'])
+                except ValueError:
+                    invalid += 1
+                    continue
+                yield (entry['timestamp'], mac, entry['rssi'], entry['latitude'], entry['longitude'], entry['floor'])
+    finally:
+        count_invalid_macs(invalid)
+
+def read_sql_rows(min_rowid=0):
+    """
+    Lignes de la table fingerprints dont l'id est > min_rowid, lues au fur et à mesure (pas de fetchall) :
+    tuples (id, timestamp, mac entière, rssi, latitude, longitude, floor). Les lignes à MAC illisible sont ignorées.
+    """
+    invalid = 0
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, timestamp, mac, rssi, latitude, longitude, floor FROM fingerprints WHERE id > ? ORDER BY id",
+                       (min_rowid,))
+        for rowid, timestamp, mac, rssi, lat, lon, floor in cursor:
+            try:
+                mac = mac_to_int(mac)
+            except ValueError:
+                invalid += 1
+                continue
+            yield (rowid, timestamp, mac, rssi, lat, lon, floor)
+    finally:
+        conn.close()
+        count_invalid_macs(invalid)
+
+def count_invalid_macs(invalid):
+    """Compte les lignes ignorées par read_json_rows / read_sql_rows (une ligne de log par lecture)"""
+    if invalid:
+        INVALID_MAC_ROWS.inc(invalid)
+        logger.info(f"{invalid} lignes ignorées dans {DB_FILE} : MAC invalide")
+
 def load_database():
     """
     Charge le fichier JSON et regroupe les scans par timestamp.
     Cela crée des 'Empreintes' complètes pour la comparaison.
+    Le fichier est lu en flux et rangé directement dans l'index compilé (mémoire constante par ligne).
     """
-    global fingerprint_db
+    global fingerprint_index, db_last_timestamp, scan_cleaner, spread_dropped_macs
     if not os.path.exists(DB_FILE):
         logger.info(f"Erreur : Fichier {DB_FILE} introuvable.")
         return
 
     try:
-        with open(DB_FILE, 'r') as f:
-            raw_data = json.load(f)
-        
         # Regroupement : Un timestamp = Une position unique (Lat/Lon/Etage)
-        # dictionnaire avec lat,lon,etage, avec dedans un autre dict pour mac:rssi, pour chaque rssi
-        grouped = defaultdict(lambda: {'lat': 0, 'lon': 0, 'floor': 0, 'aps': {}})
-        
-        for entry in raw_data:
-            ts = entry['timestamp']
-            grouped[ts]['lat'] = entry['latitude']
-            grouped[ts]['lon'] = entry['longitude']
-            grouped[ts]['floor'] = entry['floor']
-            # On stocke les MACs et RSSI dans un sous-dictionnaire
-            grouped[ts]['aps'][entry['mac']] = entry['rssi']
-
-        fingerprint_db = list(grouped.values())
-        logger.info(f"Base de données chargée : {len(fingerprint_db)} points de référence.")
+        builder = IndexBuilder()
+        scan_cleaner = ScanCleaner()
+        spread_dropped_macs = set()
+        last_timestamp = 0
+        for row in clean_rows(read_json_rows()):
+            builder.add(*row)
+            last_timestamp = max(last_timestamp, row[0])
+
+        fingerprint_index = clean_index(builder.build())
+        db_last_timestamp = max(last_timestamp, last_read_row(0))
+        logger.info(f"Base de données chargée : {len(fingerprint_index)} points de référence.")
         
     except Exception as e:
         logger.info(f"Erreur lors du chargement de la BDD : {e}")
@@ -112,278 +355,1151 @@ def load_database_sql():
     """
     Charge les données depuis SQLite et les structure pour l'algorithme WKNN.
     """
-    global fingerprint_db
+    global fingerprint_index, db_last_rowid, scan_cleaner, spread_dropped_macs
     
     if not os.path.exists(DB_FILE):
         print(f"Erreur : Base de données SQLite {DB_FILE} introuvable.")
         return
 
     try:
-        # Connexion SQL
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # On récupère tout. 
-        cursor.execute("SELECT timestamp, mac, rssi, latitude, longitude, floor FROM fingerprints")
-        rows = cursor.fetchall()
-        
-        conn.close()
+        # Regroupement des données par timestamp, directement dans l'index compilé
+        builder = IndexBuilder()
+        scan_cleaner = ScanCleaner()
+        spread_dropped_macs = set()
+        last_rowid = 0
+        for row in clean_rows(read_sql_rows()):
+            # row est un tuple : (0:id, 1:ts, 2:mac, 3:rssi, 4:lat, 5:lon, 6:floor)
+            builder.add(*row[1:])
+            last_rowid = row[0]
 
-        # Regroupement des données (Reconstruction de la structure pour l'algo)
-        grouped = defaultdict(lambda: {'lat': 0, 'lon': 0, 'floor': 0, 'aps': {}})
-        
-        for row in rows:
-            # row est un tuple : (0:ts, 1:mac, 2:rssi, 3:lat, 4:lon, 5:floor)
-            ts = row[0]
-            mac = row[1]
-            rssi = row[2]
-            
-            #remplissage infos de positions (écrasé à chaque fois)
-            grouped[ts]['lat'] = row[3]
-            grouped[ts]['lon'] = row[4]
-            grouped[ts]['floor'] = row[5]
-            
-            # Ajout du signal WiFi
-            grouped[ts]['aps'][mac] = rssi
-
-        fingerprint_db = list(grouped.values())
-        print(f"Base SQLite chargée : {len(fingerprint_db)} empreintes de référence.")
+        fingerprint_index = clean_index(builder.build())
+        db_last_rowid = max(last_rowid, last_read_row(0))
+        print(f"Base SQLite chargée : {len(fingerprint_index)} empreintes de référence.")
         
     except Exception as e:
         print(f"Erreur SQL lors du chargement : {e}")
 
+# --- Instantané binaire ---
+def snapshot_file():
+    return DB_FILE + ".snap"
+
+def db_signature():
+    """
+    Identifie le contenu de DB_FILE : taille + date de modification pour un JSON,
+    dernier id + nombre de lignes + sommes des colonnes pour SQLite (la date du fichier change à chaque checkpoint WAL).
+    """
+    if MODE_DB == MODE_JSON:
+        st = os.stat(DB_FILE)
+        return {"mode": MODE_JSON, "file": os.path.abspath(DB_FILE), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                "cleaning": cleaning_settings()}
+    max_id, count, sums = sql_content()
+    return {"mode": MODE_SQL, "file": os.path.abspath(DB_FILE), "max_id": max_id, "count": count, "sums": sums,
+            "cleaning": cleaning_settings()}
+
+def sql_content(max_id=None):
+    """
+    (dernier id, nombre de lignes, sommes des colonnes) de la table fingerprints, limitée aux id <= max_id.
+    Les sommes changent quand une ligne existante est modifiée (ex: position corrigée), pas seulement à l'ajout.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute(
+            "SELECT max(id), count(*), total(timestamp), total(rssi), total(latitude), total(longitude), total(floor) "
+            "FROM fingerprints WHERE id <= ?", (max_id if max_id is not None else 2 ** 63 - 1,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] or 0, row[1], list(row[2:])
+
+def appended_since(source):
+    """
+    La base n'a fait que grandir depuis l'instantané de signature source (même mode, même fichier, même nettoyage,
+    et en SQL lignes d'id <= source["max_id"] inchangées) : il suffit d'y ajouter les nouvelles lignes.
+    """
+    current = {"mode": MODE_DB, "file": os.path.abspath(DB_FILE), "cleaning": cleaning_settings()}
+    if any(source.get(key) != value for key, value in current.items()):
+        return False
+    if MODE_DB == MODE_JSON:
+        return True
+    if "sums" not in source:
+        return False # instantané d'avant les sommes de contrôle
+    _, count, sums = sql_content(source["max_id"])
+    return count == source["count"] and sums == source["sums"]
+
+# --- Nettoyage (voir fingerprint_cleaning.py) ---
+def cleaning_settings():
+    """Réglages du nettoyage, dans la signature de l'instantané : il est reconstruit s'ils changent"""
+    return fingerprint_cleaning.settings() if CLEAN_DATABASE else None
+
+def clean_rows(rows):
+    """Lignes lues nettoyées en flux (CLEAN_DATABASE)"""
+    return scan_cleaner.feed(rows) if CLEAN_DATABASE else rows
+
+def last_read_row(field):
+    """
+    Champ de la dernière ligne lue, même retirée par le nettoyage (0 si aucune) :
+    les lignes retirées ne sont pas relues au prochain rechargement.
+    """
+    return scan_cleaner.last_row[field] if CLEAN_DATABASE and scan_cleaner.last_row is not None else 0
+
+def clean_index(index):
+    """
+    Index compilé sans les routeurs vus à des endroits trop éloignés (CLEAN_DATABASE),
+    ni ceux déjà retirés aux chargements précédents (spread_dropped_macs)
+    """
+    global spread_dropped_macs
+    if not CLEAN_DATABASE:
+        return index
+    index, spread_dropped_macs = drop_spread_aps(index, dropped_macs=spread_dropped_macs)
+    stats = scan_cleaner.stats
+    logger.info(f"Nettoyage : {stats['rows_in'] - stats['rows_out']} lignes retirées sur {stats['rows_in']} "
+                f"({stats['locally_administered']} partages de connexion, {stats['merged']} BSSID fusionnés, "
+                f"{stats['duplicate_scans']} scans répétés), {len(spread_dropped_macs)} routeurs mobiles.")
+    return index
+
+def load_database_snapshot(stale=False):
+    """
+    Charge l'instantané s'il correspond au contenu actuel de DB_FILE (mmap, sans copie).
+    stale=True : accepte aussi un instantané périmé de la même base, si elle n'a eu que des ajouts depuis
+    (voir appended_since), à compléter avec reload_database (build_snapshot.py --update).
+    Renvoie False s'il est absent ou périmé.
+    """
+    global fingerprint_index, db_last_rowid, db_last_timestamp, spread_dropped_macs
+    path = snapshot_file()
+    meta = read_snapshot_meta(path)
+    if meta is None or not os.path.exists(DB_FILE):
+        return False
+    source, current = meta.get("source") or {}, db_signature()
+    if source != current and not (stale and appended_since(source)):
+        return False
+
+    # Instantané déjà nettoyé (mêmes réglages, voir db_signature) ; les scans qu'il contient ne sont pas
+    # connus de scan_cleaner : un doublon d'un de ces scans ajouté plus tard n'est pas détecté
+    fingerprint_index, meta = load_snapshot(path)
+    db_last_rowid = meta["last_rowid"]
+    db_last_timestamp = meta["last_timestamp"]
+    spread_dropped_macs = set(meta.get("spread_dropped_macs") or ())
+    logger.info(f"Instantané {path} chargé : {len(fingerprint_index)} empreintes de référence.")
+    return True
+
+def write_database_snapshot(signature, added_rows=None):
+    """
+    Écrit l'instantané de la base actuellement chargée (signature : db_signature() avant le chargement,
+    added_rows : lignes ajoutées à l'instantané précédent par build_snapshot.py --update)
+    """
+    path = snapshot_file()
+    save_snapshot(fingerprint_index, path, {
+        "source": signature,
+        "last_rowid": db_last_rowid,
+        "last_timestamp": db_last_timestamp,
+        "added_rows": added_rows,
+        "spread_dropped_macs": sorted(spread_dropped_macs)
+    })
+    logger.info(f"Instantané {path} écrit.")
+
+def load_fingerprints():
+    """
+    Chargement au démarrage : instantané s'il est à jour, sinon lecture complète
+    de la base (JSON ou SQL) puis écriture d'un nouvel instantané.
+    En mode partagé (WORKERS > 1), l'instantané est construit dans un processus à part (voir run_snapshot_builder).
+    """
+    if USE_SNAPSHOT:
+        try:
+            loaded = load_database_snapshot()
+            if not loaded and WORKERS > 1 and os.path.exists(DB_FILE):
+                # Base modifiée depuis le lancement (prepare_snapshot)
+                run_snapshot_builder()
+                loaded = load_database_snapshot()
+            if loaded:
+                load_ap_locator()
+                return
+            # Signature lue AVANT le chargement : des lignes ajoutées pendant le chargement
+            # rendront l'instantané périmé au prochain démarrage (jamais l'inverse)
+            signature = db_signature() if os.path.exists(DB_FILE) else None
+        except Exception as e:
+            logger.info(f"Erreur instantané, chargement complet : {e}")
+            signature = None
+
+    if(MODE_DB == MODE_JSON):
+        load_database()
+    else:
+        load_database_sql()
+
+    if USE_SNAPSHOT and signature is not None and fingerprint_index is not None:
+        try:
+            write_database_snapshot(signature)
+        except Exception as e:
+            logger.info(f"Erreur lors de l'écriture de l'instantané : {e}")
+
+    load_ap_locator()
+
+def run_snapshot_builder():
+    """
+    Mode partagé : instantané complété (ou construit) par build_snapshot.py --update, dans un processus à part :
+    l'index construit en mémoire pendant la lecture de la base ne reste dans aucun processus du serveur.
+    L'instantané est écrit de façon atomique : les processus qui l'ont déjà chargé gardent l'ancien.
+    """
+    subprocess.run([sys.executable, "build_snapshot.py", DB_FILE, "--update"], check=True,
+                   env=dict(os.environ, GEOLOC_WORKERS="1"))
+
+def prepare_snapshot():
+    """
+    Avant le lancement des processus (--workers) : instantané construit une seule fois s'il est absent ou périmé.
+    Chaque processus n'a plus qu'à le charger en mmap.
+    """
+    if not USE_SNAPSHOT or not os.path.exists(DB_FILE):
+        return
+    meta = read_snapshot_meta(snapshot_file())
+    if meta is not None and meta.get("source") == db_signature():
+        return
+    logger.info(f"Construction de l'instantané {snapshot_file()}...")
+    run_snapshot_builder()
+
+def refresh_from_snapshot():
+    """
+    Mode partagé (WORKERS > 1) : charge l'instantané s'il contient d'autres lignes que la base chargée
+    (reconstruit par un autre processus après un rechargement). Renvoie True s'il a été chargé.
+    """
+    meta = read_snapshot_meta(snapshot_file())
+    if meta is None or (meta.get("last_rowid"), meta.get("last_timestamp")) == (db_last_rowid, db_last_timestamp):
+        return False
+    if not load_database_snapshot():
+        return False
+    load_ap_locator()
+    return True
+
+def load_ap_locator():
+    """
+    Table des positions des routeurs : barycentres du relevé (base chargée)
+    complétés par les positions WiGLE de AP_PRIORS_DB.
+    """
+    global ap_locator
+    priors = []
+    if AP_PRIORS_DB and os.path.exists(AP_PRIORS_DB):
+        try:
+            priors = read_ap_priors(AP_PRIORS_DB)
+            if CLEAN_DATABASE:
+                priors = [(bssid_family(mac), lat, lon) for mac, lat, lon in priors if not is_locally_administered(mac)]
+        except Exception as e:
+            logger.info(f"Erreur lors de la lecture des positions WiGLE : {e}")
+    ap_locator = APLocator.build(fingerprint_index, priors, AP_FIT)
+    logger.info(f"Positions des routeurs : {len(ap_locator)} connues ({len(priors)} WiGLE).")
+
+def reload_database():
+    """
+    Rechargement incrémental : n'applique que les lignes ajoutées depuis le dernier chargement
+    (id SQLite > db_last_rowid, ou timestamp JSON > db_last_timestamp).
+    Le nouvel index est construit à côté de l'ancien puis remplace la référence en une fois.
+    Renvoie le nombre de lignes appliquées.
+    """
+    global fingerprint_index, db_last_rowid, db_last_timestamp
+
+    if WORKERS > 1 and USE_SNAPSHOT:
+        return reload_database_shared()
+    builder = IndexBuilder(fingerprint_index)
+    count = 0
+    last_rowid = db_last_rowid; last_timestamp = db_last_timestamp
+    if MODE_DB == MODE_JSON:
+        for row in clean_rows(read_json_rows(db_last_timestamp)):
+            builder.add(*row)
+            last_timestamp = max(last_timestamp, row[0])
+            count += 1
+        last_timestamp = max(last_timestamp, last_read_row(0))
+    else:
+        for row in clean_rows(read_sql_rows(db_last_rowid)):
+            builder.add(*row[1:])
+            last_rowid = row[0]
+            count += 1
+        last_rowid = max(last_rowid, last_read_row(0))
+
+    if count == 0 and fingerprint_index is not None:
+        db_last_rowid = last_rowid; db_last_timestamp = last_timestamp # lignes lues mais toutes retirées
+        return 0
+
+    # Remplacement atomique
+    fingerprint_index = clean_index(builder.build())
+    db_last_rowid = last_rowid; db_last_timestamp = last_timestamp
+    load_ap_locator()
+    logger.info(f"Base rechargée : {count} nouvelles lignes, {len(fingerprint_index)} empreintes.")
+    return count
+
+def reload_database_shared():
+    """
+    Rechargement en mode partagé (WORKERS > 1) : instantané complété par run_snapshot_builder puis chargé en mmap,
+    ici et dans les autres processus (watch_snapshot). Si un autre processus l'a déjà fait, on charge son instantané.
+    Renvoie le nombre de lignes appliquées (0 si c'était déjà fait, ou si la base n'a pas changé).
+    """
+    if refresh_from_snapshot():
+        return 0
+    if (read_snapshot_meta(snapshot_file()) or {}).get("source") == db_signature():
+        return 0 # rien de nouveau : l'instantané n'est pas réécrit
+    run_snapshot_builder()
+    if not refresh_from_snapshot():
+        return 0
+    logger.info(f"Base rechargée : {len(fingerprint_index)} empreintes.")
+    return (read_snapshot_meta(snapshot_file()) or {}).get("added_rows") or 0
+
+# Gestion des sessions par appareil
+def open_session_store():
+    """Sessions dans le processus, ou dans SESSION_DB si plusieurs processus (WORKERS > 1)"""
+    if WORKERS > 1:
+        return SqliteSessionStore(SESSION_DB, DeviceSession, DEVICE_IDLE_TIMEOUT, MAX_DEVICES)
+    return MemorySessionStore(DeviceSession, DEVICE_IDLE_TIMEOUT, MAX_DEVICES)
+
+def get_session(device_id):
+    """
+    Session de l'appareil, None si inconnu. En mode partagé c'est une copie :
+    pour la modifier, passer par update_session.
+    """
+    return session_store.get(device_id)
+
+async def update_session(device_id, change):
+    """
+    Applique change(session) à la session de l'appareil (créée si besoin, marquée comme la plus récente)
+    et renvoie son résultat. À appeler à chaque réception de données.
+    En mémoire : directement dans la boucle asyncio. En mode partagé : dans le thread des sessions
+    (transaction SQLite, les autres processus attendent la fin de change).
+    """
+    if not session_store.shared:
+        return session_store.update(device_id, change)
+    return await asyncio.get_running_loop().run_in_executor(session_executor, session_store.update, device_id, change)
+
+def offline_timeout():
+    """Secondes sans données avant d'être hors ligne"""
+    return 10.0 if CURRENT_MODE == MODE_WIFI else 35.0
+
+def is_offline(session):
+    """Hors ligne si pas de données depuis 10s (mode HTTP) ou 35s (mode LoRa)"""
+    return time.time() - session.last_buffer_update > offline_timeout()
+
 #Calcul de la position estimée
-def algorithm_wknn(live_aps):
+def algorithm_wknn(live_aps, k=K_NEIGHBORS, timestamp=None, region=None):
     """
     Algorithme Weighted k-Nearest Neighbors (k-NN Pondéré).
-    1. Compare le scan actuel avec toute la BDD.
-    2. Sélectionne les K points les plus ressemblants.
+    1. Compare le scan actuel avec les empreintes qui partagent au moins un routeur (index inversé, voir wknn_engine.py),
+       d'abord seulement celles proches de la position prédite (region), voir search_candidates.
+    2. Sélectionne les k points les plus ressemblants (sélection partielle, sans trier toute la base).
     3. Calcule une moyenne pondérée pour les coordonnées
+    Si aucune empreinte ne partage de routeur avec le scan : position déduite des routeurs connus (AP_FALLBACK).
+    Le champ "engine" indique le calcul utilisé : "wknn", "wknn_ap_prefilter" ou "ap_fallback".
     """
-    if not fingerprint_db or not live_aps:
+    index = fingerprint_index # référence gardée pendant tout le calcul (un rechargement la remplace)
+    if CLEAN_DATABASE:
+        live_aps = clean_scan(live_aps) # mêmes MAC que les empreintes nettoyées
+    if not live_aps:
         return None
 
-    distances = []
-
-    # 1, calcul de la "distance" entre la mesure et chaque point de la base de données:
-    # en faisant la somme de la différence carrée des rssi, puis en prenant la racine de ce nombre.
-    for fp in fingerprint_db:
-        dist_sq_sum = 0
-        match_count = 0
-        
-        for mac, rssi_live in live_aps.items():
-            # Si le routeur du live existe dans l'empreinte stockée
-            if mac in fp['aps']:
-                rssi_db = fp['aps'][mac]
-                # Différence au carré
-                dist_sq_sum += (rssi_live - rssi_db) ** 2
-                #nombre de points communs
-                match_count += 1
-            else:
-                # Pénalité si le routeur est manquant dans la base (100 dBm de différence = 100**2)
-                dist_sq_sum += 10000
-
-        # Si aucun routeur en commun, distance infinie
-        if match_count == 0:
-            final_dist = 1e9
+    locator = ap_locator if AP_FALLBACK or AP_PREFILTER else None
+    engine = "wknn"
+    estimated_pos = None
+    search_radius = None
+    if index is not None and len(index) > 0:
+        if AP_PREFILTER and region is None and locator is not None:
+            ap_pos = locator.locate(live_aps)
+            if ap_pos is not None:
+                region = (ap_pos["lat"], ap_pos["lon"], AP_PREFILTER_RADIUS)
+                engine = "wknn_ap_prefilter"
+        with SCORING_SECONDS.time():
+            candidates, dist, search_radius = search_candidates(index, live_aps, k, region)
+        if len(candidates) == 0 and AP_FALLBACK and locator is not None:
+            estimated_pos = locator.locate(live_aps)
+        if estimated_pos is None:
+            with TOPK_SECONDS.time():
+                estimated_pos = estimate_from_distances(index, candidates, dist, k)
         else:
-            final_dist = math.sqrt(dist_sq_sum)
-        
-        #stockage des distances pour chaque point de la base de donnée
-        distances.append({
-            "dist": final_dist,
-            "lat": fp['lat'],
-            "lon": fp['lon'],
-            "floor": fp['floor']
-        })
+            engine = "ap_fallback"
+    elif AP_FALLBACK and locator is not None:
+        # Pas (encore) d'empreintes : seulement les positions WiGLE
+        estimated_pos = locator.locate(live_aps)
+        engine = "ap_fallback"
+    if estimated_pos is None:
+        return None
+    if engine == "ap_fallback":
+        AP_FALLBACK_TOTAL.inc()
+        search_radius = None
 
-    # 2. Trouver les plus proches (je prends les K_NEIGHBORS plus proches,
-    # en soit on pourrait prendre tous les points mais cela ne serait pas forcément plus précis et
-    # serait plus couteux en calcul / temps)
-    
-    # Tri du plus petit écart au plus grand
-    distances.sort(key=lambda x: x["dist"])
-    k_nearest = distances[:K_NEIGHBORS]
-    
-    # 3. Calcul de la position estimée
-    weight_sum = 0
-    lat_sum = 0; lon_sum = 0; floor_sum = 0
-    
-    # Pour calculer l'incertitude géographique plus tard
-    coords_neighbors = [] 
+    # On ajoute l'heure du scan (ou du calcul si inconnue)
+    estimated_pos["timestamp"] = int(timestamp if timestamp is not None else time.time())
+    estimated_pos["search_radius"] = search_radius
+    estimated_pos["engine"] = engine
+    return estimated_pos
 
-    for item in k_nearest:
-        # Poids = Inverse de la distance ( +0.001 pour éviter division par zéro)
-        # donc si la distance est petite le poids est grand.
-        w = 1 / (item["dist"] + 0.001)
-        
-        lat_sum += item["lat"] * w
-        lon_sum += item["lon"] * w
-        floor_sum += item["floor"] * w
-        weight_sum += w
-        
-        coords_neighbors.append((item["lat"], item["lon"]))
-
-    if weight_sum == 0: return None
-
-    # Résultat final estimé
-    est_lat = lat_sum / weight_sum
-    est_lon = lon_sum / weight_sum
-    est_floor = round(floor_sum / weight_sum)
-
-    # 4. Calcul d'incertitude
-    # Par le calcul de l'écart avec les points connus : plus on est proches d'un point connu plus l'incertitude est faible
-    #(seulement sur les K_NEIGHBORS points plus proches), puis moyenne de ces écarts
-    uncertainty_score = 0
-    for n_lat, n_lon in coords_neighbors:
-        # Distance approximative entre le voisin et le point estimé
-        d = math.sqrt((n_lat - est_lat)**2 + (n_lon - est_lon)**2)
-        uncertainty_score += d
-    
-    # Conversion degrés -> mètres (approx pour la France : 111km par degré)
-    accuracy_meters = (uncertainty_score / K_NEIGHBORS) * 111000 
+def search_candidates(index, live_aps, k, region=None):
+    """
+    Distances du scan aux empreintes candidates.
+    Avec une position prédite (region = lat, lon, rayon en m : suivi, ou position des routeurs), on ne cherche d'abord
+    que les empreintes de cette zone, et on l'agrandit (x SEARCH_WIDEN_FACTOR) si la correspondance
+    est mauvaise : moins de k candidats, ou meilleur écart RSSI moyen par routeur > POOR_MATCH_RMS.
+    Au-delà de SEARCH_MAX_RADIUS, recherche dans toute la base.
+    Renvoie (candidats, distances, rayon retenu ou None pour toute la base)
+    """
+    if region is not None:
+        lat, lon, radius = region
+        while radius <= SEARCH_MAX_RADIUS:
+            candidates, dist = compute_distances(index, live_aps, region=(lat, lon, radius))
+            if len(candidates) >= k and dist.min() / math.sqrt(len(live_aps)) <= POOR_MATCH_RMS:
+                SEARCH_RADIUS_METERS.observe(radius)
+                return candidates, dist, radius
+            SEARCH_WIDENED.inc()
+            radius *= SEARCH_WIDEN_FACTOR
+
+    SEARCH_FULL.inc()
+    candidates, dist = compute_distances(index, live_aps)
+    return candidates, dist, None
+
+def algorithm_wknn_batch(scans, k=K_NEIGHBORS, timestamps=None, workers=1):
+    """
+    Version par lots d'algorithm_wknn, sans état : pour relocaliser des archives d'uplinks.
+    scans : liste de dictionnaires {mac: rssi}, timestamps : heure de chaque scan (optionnel).
+    Renvoie une liste de positions (mêmes champs qu'algorithm_wknn) ou None.
+    """
+    index = fingerprint_index
+    locator = ap_locator
+    if CLEAN_DATABASE:
+        scans = [clean_scan(live_aps) for live_aps in scans]
+    results = locate_batch(index, scans, k, workers)
+    for i, estimated_pos in enumerate(results):
+        engine = "wknn"
+        # Aucune empreinte candidate (comme algorithm_wknn) : position déduite des routeurs connus
+        if AP_FALLBACK and locator is not None and scans[i] and (index is None or len(index) == 0 or not has_candidates(index, scans[i])):
+            ap_pos = locator.locate(scans[i])
+            if ap_pos is not None:
+                estimated_pos = results[i] = ap_pos
+                engine = "ap_fallback"
+        if estimated_pos is not None:
+            estimated_pos["engine"] = engine
+            timestamp = timestamps[i] if timestamps and timestamps[i] is not None else time.time()
+            estimated_pos["timestamp"] = int(timestamp)
+    return results
+
+def begin_scan(session, timestamp):
+    """
+    Le buffer de la session contient un scan complet (dans update_session) : renvoie ce qu'il faut à update_position
+    (numéro du scan, copie du buffer, heure du scan, zone de recherche).
+    """
+    session.scan_seq += 1
+    session.scan_pending = False
+    return session.scan_seq, dict(session.wifi_buffer), timestamp, search_region(session, timestamp)
+
+def finish_scan(session):
+    """
+    Mode HTTP réseau par réseau (dans update_session) : le scan du buffer est complet (scan suivant commencé,
+    ou plus de réseau depuis RAW_SCAN_SETTLE secondes). Renvoie begin_scan, ou None s'il n'y a rien de nouveau à calculer.
+    """
+    if not session.scan_pending or not session.wifi_buffer:
+        return None
+    return begin_scan(session, session.buffer_timestamp)
+
+async def update_position(device_id, scan):
+    """
+    Appelé quand un scan est complet (ou complété), scan : résultat de begin_scan. Calcule la position une seule fois
+    avec l'heure du scan (dans le pool de calcul, hors de la boucle asyncio), puis l'enregistre
+    si le buffer n'a pas changé entre-temps.
+    """
+    scan_seq, networks, timestamp, region = scan
+    estimated_pos = await asyncio.get_running_loop().run_in_executor(
+        compute_executor, algorithm_wknn, networks, K_NEIGHBORS, timestamp, region)
 
+    def record(session):
+        if session.scan_seq != scan_seq:
+            return None # Le buffer a changé pendant le calcul
+        return record_position(session, estimated_pos, timestamp, networks)
+
+    recorded_pos = await update_session(device_id, record)
+    position_recorded(device_id, recorded_pos)
+    return recorded_pos
+
+def record_position(session, estimated_pos, timestamp, networks):
+    """
+    Met en cache la position calculée pour le dernier scan (réseaux networks, à appeler dans update_session).
+    Les pages web ne font ensuite que lire ce cache.
+    Avec TRACKING_FILTER, la position enregistrée est la position filtrée (la position WKNN est dans "raw").
+    Renvoie la position enregistrée, à passer ensuite à position_recorded.
+    """
+    POSITIONS_TOTAL.inc()
+    if estimated_pos is not None:
+        session.last_search_radius = estimated_pos.get("search_radius")
+        if TRACKING_FILTER:
+            estimated_pos = apply_tracking_filter(session, estimated_pos, timestamp)
+    session.scan_timestamp = timestamp
+    session.scan_networks = networks
+    session.positions = {K_NEIGHBORS: estimated_pos}
+    if estimated_pos is None:
+        CALIBRATING_TOTAL.inc()
+        return None
+
+    session.last_position = estimated_pos
+    return estimated_pos
+
+def position_recorded(device_id, estimated_pos):
+    """
+    Après record_position (dans la boucle asyncio) : ajout à l'historique (pour tracer le chemin),
+    écrit en base par history_writer, et envoi aux pages web abonnées.
+    Même scan (mode HTTP : réseaux reçus un par un) : la position remplace la précédente dans l'historique.
+    """
+    if estimated_pos is None:
+        return
+    if position_store is not None:
+        position_store.append(device_id, estimated_pos)
+    if not session_store.shared:
+        publish_position(device_id, estimated_pos) # En mode partagé : relue par stream_watcher dans chaque processus
+
+def search_region(session, timestamp):
+    """Zone où chercher le scan de l'heure timestamp (prédiction du filtre de suivi), None : toute la base"""
+    return session.tracker.search_region(timestamp) if TRACKING_FILTER else None
+
+def apply_tracking_filter(session, raw_pos, timestamp):
+    """Position filtrée (lat, lon, incertitude) + position WKNN brute dans "raw" """
+    lat, lon, sigma = session.tracker.update(raw_pos["lat"], raw_pos["lon"], raw_pos["accuracy"], timestamp)
+    filtered = dict(raw_pos, lat=lat, lon=lon, accuracy=sigma)
+    filtered["raw"] = {"lat": raw_pos["lat"], "lon": raw_pos["lon"], "floor": raw_pos["floor"], "accuracy": raw_pos["accuracy"]}
+    return filtered
+
+def publish_position(device_id, estimated_pos):
+    """Envoie la nouvelle position à toutes les pages web abonnées à l'appareil"""
+    for queue in stream_subscribers.get(device_id, ()):
+        # Page trop lente : on jette la plus ancienne position en attente
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(estimated_pos)
+
+def session_status(session):
+    """Statut affiché sur la carte : offline, calibrating ou tracking"""
+    if session is None or is_offline(session):
+        return "offline"
+    return "tracking" if current_position(session) else "calibrating"
+
+def session_snapshot(device_id):
+    """
+    État d'un appareil (statut, position actuelle), envoyé une fois à l'abonnement.
+    La page charge la trace avec /api/history (history_size derniers points).
+    """
+    session = get_session(device_id)
     return {
-        "timestamp": int(time.time()), # On ajoute l'heure du calcul
-        "lat": est_lat,
-        "lon": est_lon,
-        "floor": est_floor,
-        "accuracy": accuracy_meters,
-        "details": [round(x['dist'], 1) for x in k_nearest] # Pour debug
+        "status": session_status(session),
+        "device": device_id,
+        "current": current_position(session) if session else None,
+        "history_size": HISTORY_SIZE
     }
 
+def sse_event(event, data):
+    """Formatage d'un message Server-Sent Events"""
+    with SERIALIZE_SECONDS.time():
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def current_position(session):
+    """Position du dernier scan de l'appareil (calculée à sa réception), None si pas encore de position"""
+    return session.positions.get(K_NEIGHBORS)
+
+async def get_cached_position(session, k=K_NEIGHBORS):
+    """
+    Position du dernier scan de l'appareil. Pour un k différent de K_NEIGHBORS,
+    le calcul est fait à la première demande (dans le pool de calcul, hors de la boucle asyncio)
+    puis gardé jusqu'au prochain scan (position WKNN brute, sans filtre de suivi).
+    En mode partagé, la session est une copie : il est refait à chaque demande.
+    """
+    positions = session.positions # un nouveau scan pendant le calcul remplace le cache, pas celui-ci
+    if k not in positions:
+        positions[k] = await asyncio.get_running_loop().run_in_executor(
+            compute_executor, algorithm_wknn, session.scan_networks, k, session.scan_timestamp)
+    return positions[k]
+
+def parse_ttn_time(ttn_data):
+    """
+    Heure de réception de l'uplink par TTN (champ received_at, ex: "2025-12-16T10:15:42.123456789Z"),
+    en secondes. Heure du serveur si absente ou illisible.
+    """
+    received_at = ttn_data.get('received_at') or ttn_data.get('uplink_message', {}).get('received_at')
+    try:
+        # datetime ne gère pas les nanosecondes de TTN : on ne garde que les secondes
+        return datetime.fromisoformat(received_at.split('.')[0].rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+    except (AttributeError, ValueError):
+        return time.time()
+
 # ==========================================
 # 4. HTTP et API
 # ==========================================
 
+# Un seul rechargement de la base à la fois
+reload_lock = asyncio.Lock()
+
+async def reload_database_async():
+    """Rechargement incrémental hors de la boucle asyncio : les requêtes continuent pendant ce temps"""
+    async with reload_lock:
+        return await asyncio.get_running_loop().run_in_executor(None, reload_database)
+
+def db_file_mtime():
+    """Date de dernière modification de DB_FILE (et de son journal WAL en mode SQL)"""
+    paths = [DB_FILE] if MODE_DB == MODE_JSON else [DB_FILE, DB_FILE + "-wal"]
+    return max((os.stat(p).st_mtime_ns for p in paths if os.path.exists(p)), default=0)
+
+async def watch_database():
+    """Surveillance de DB_FILE : rechargement incrémental dès que le fichier change"""
+    last_mtime = db_file_mtime()
+    while True:
+        await asyncio.sleep(DB_WATCH_INTERVAL)
+        mtime = db_file_mtime()
+        if mtime != last_mtime:
+            last_mtime = mtime
+            try:
+                await reload_database_async()
+            except Exception as e:
+                logger.info(f"Erreur lors du rechargement de la BDD : {e}")
+
+async def history_writer():
+    """Écriture groupée de l'historique des positions, et suppression des plus anciennes (hors de la boucle asyncio)"""
+    loop = asyncio.get_running_loop()
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, position_store.flush)
+            if time.time() - last_prune > HISTORY_PRUNE_INTERVAL:
+                last_prune = time.time()
+                deleted = await loop.run_in_executor(
+                    None, position_store.prune, HISTORY_RETENTION, HISTORY_MAX_PER_DEVICE, last_prune)
+                if deleted:
+                    logger.info(f"Historique : {deleted} anciennes positions supprimées")
+        except Exception as e:
+            logger.info(f"Erreur lors de l'écriture de l'historique : {e}")
+
+async def watch_snapshot():
+    """Mode partagé : recharge l'instantané (mmap) quand un autre processus l'a reconstruit"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SNAPSHOT_WATCH_INTERVAL)
+        try:
+            async with reload_lock:
+                if await loop.run_in_executor(None, refresh_from_snapshot):
+                    logger.info("Base rechargée depuis l'instantané d'un autre processus.")
+        except Exception as e:
+            logger.info(f"Erreur lors du rechargement de l'instantané : {e}")
+
+async def stream_watcher():
+    """
+    Mode partagé : les positions peuvent être calculées par un autre processus. Relit toutes les
+    STREAM_POLL_INTERVAL secondes la dernière position des appareils suivis par les pages web de ce processus,
+    et l'envoie si elle a changé (seule la plus récente est envoyée si plusieurs sont arrivées entre deux lectures).
+    """
+    loop = asyncio.get_running_loop()
+    sent = {} # appareil -> position_seq de la dernière position envoyée
+    while True:
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+        for device in [device for device in sent if device not in stream_subscribers]:
+            del sent[device]
+        devices = list(stream_subscribers)
+        if not devices:
+            continue
+        try:
+            rows = await loop.run_in_executor(None, session_store.last_positions, devices)
+        except Exception as e:
+            logger.info(f"Erreur lors de la lecture des positions : {e}")
+            continue
+        for device in devices:
+            position_seq, position = rows.get(device, (0, None))
+            # Premier passage : la page vient de recevoir la position actuelle (snapshot)
+            if device in sent and position_seq != sent[device] and position is not None:
+                estimated_pos = json.loads(position)
+                if estimated_pos is not None:
+                    publish_position(device, estimated_pos)
+            sent[device] = position_seq
+
+# Tâches de fond (workers de la file d'uplinks, surveillance de la base, historique)
+background_tasks = []
+
 @app.on_event("startup")
 async def start_app():
-    if(MODE_DB == MODE_JSON):
-        load_database()
-    else:
-        load_database_sql()
+    global uplink_queue, position_store, session_store
+    load_fingerprints()
+    position_store = PositionStore(HISTORY_DB)
+    session_store = open_session_store()
+    uplink_queue = asyncio.Queue(maxsize=UPLINK_QUEUE_SIZE)
+    for _ in range(UPLINK_WORKERS):
+        background_tasks.append(asyncio.create_task(lora_uplink_worker()))
+    if DB_WATCH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(watch_database()))
+    background_tasks.append(asyncio.create_task(history_writer()))
+    if WORKERS > 1:
+        background_tasks.append(asyncio.create_task(stream_watcher()))
+        if USE_SNAPSHOT:
+            background_tasks.append(asyncio.create_task(watch_snapshot()))
+        logger.info(f"Processus {os.getpid()} ({WORKERS} processus, sessions dans {SESSION_DB})")
     logger.info(f"Serveur démarré en mode : {CURRENT_MODE}")
 
+@app.on_event("shutdown")
+async def stop_app():
+    global position_store, session_store
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    for task in raw_scan_timers.values():
+        task.cancel()
+    raw_scan_timers.clear()
+    if position_store is not None:
+        position_store.close() # écrit les dernières positions
+        position_store = None
+    if session_store is not None:
+        session_store.close()
+        session_store = None
+
 @app.get("/", response_class=HTMLResponse)
 async def get_map_page(request: Request):
-    """Affiche la carte"""
-    return templates.TemplateResponse("map.html", {"request": request})
+    """
+    Affiche la carte. Sans ?device=, elle suit l'appareil le plus récemment actif
+    (ou attend le premier, voir /api/devices) ; un menu permet d'en choisir un autre.
+    """
+    latest = session_store.recent(1)
+    return templates.TemplateResponse(request, "map.html", {"device": latest[0].device_id if latest else None})
+
+# Fin des scans reçus réseau par réseau : { device_id: tâche qui attend RAW_SCAN_SETTLE secondes }
+raw_scan_timers = {}
+
+def schedule_scan_end(device_id):
+    """(Re)lance l'attente de la fin du scan de l'appareil : repoussée à chaque nouveau réseau"""
+    task = raw_scan_timers.pop(device_id, None)
+    if task is not None:
+        task.cancel()
+    raw_scan_timers[device_id] = asyncio.create_task(end_raw_scan(device_id))
+
+async def end_raw_scan(device_id):
+    """Plus de réseau depuis RAW_SCAN_SETTLE secondes : position du scan calculée une seule fois"""
+    await asyncio.sleep(RAW_SCAN_SETTLE)
+    # Calcul lancé : un nouveau réseau ne doit plus l'annuler
+    if raw_scan_timers.get(device_id) is asyncio.current_task():
+        del raw_scan_timers[device_id]
+    try:
+        scan = await update_session(device_id, finish_scan)
+        if scan is not None:
+            await update_position(device_id, scan)
+    except Exception as e:
+        logger.info(f"Erreur lors du calcul du scan de {device_id} : {e}")
 
 # Réception (Mode WiFi HTTP) des données de l'ESP32
 @app.post("/api/raw_scan")
 async def receive_wifi_scan(data: WifiScanData):
     """
-    L'ESP32 envoie les réseaux un par un. On les stocke dans un buffer.
+    L'ESP32 envoie les réseaux un par un (ancien firmware, voir /api/scan). On les stocke dans le buffer de l'appareil.
+    Les réseaux d'un même scan ont le même timestamp : un nouveau timestamp commence un nouveau scan,
+    et termine le précédent. La position est calculée une fois par scan : au début du scan suivant,
+    ou après RAW_SCAN_SETTLE secondes sans nouveau réseau.
     """
-    global current_wifi_buffer, last_buffer_update
-    
     if CURRENT_MODE != MODE_WIFI:
         return {"status": "ignored", "reason": "Server in LoRa mode"}
 
-    # Si le buffer est vieux (> 2s), c'est un nouveau scan, on supprime l'ancien
-    if time.time() - last_buffer_update > 2.0:
-        current_wifi_buffer = {} 
+    try:
+        mac = mac_to_int(data.mac)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"MAC invalide : {data.mac}")
+
+    def add_network(session):
+        if session.buffer_timestamp is not None and data.timestamp < session.buffer_timestamp:
+            return False, None # réseau d'un scan déjà remplacé
+        finished = None
+        if data.timestamp != session.buffer_timestamp:
+            finished = finish_scan(session)
+            session.wifi_buffer = {}
+            session.buffer_timestamp = data.timestamp
+        session.wifi_buffer[mac] = data.rssi
+        session.scan_pending = True
+        return True, finished
 
-    current_wifi_buffer[data.mac] = data.rssi
-    last_buffer_update = time.time()
+    added, finished = await update_session(data.device_id, add_network)
+    if not added:
+        return {"status": "ignored", "reason": "older scan"}
+    WIFI_SCANS_TOTAL.inc()
+    schedule_scan_end(data.device_id)
+    if finished is not None:
+        # Scan précédent complet : estimation avec l'heure du scan envoyée par l'ESP32
+        await update_position(data.device_id, finished)
     
     return {"status": "buffered"}
 
+# Réception d'un scan complet en une requête (Mode WiFi HTTP)
+@app.post("/api/scan")
+async def receive_wifi_scan_batch(request: Request, device_id: str = DEFAULT_DEVICE_ID, timestamp: Optional[int] = None):
+    """
+    Scan complet de l'ESP32 en une seule requête, traité d'un bloc (remplace le buffer de l'appareil).
+    - JSON : {"timestamp": ..., "device_id": ..., "networks": [{"mac": ..., "rssi": ..., "ssid": ...}, ...]}
+    - binaire (Content-Type: application/octet-stream) : blocs de 7 octets [MAC][RSSI] comme en LoRa,
+      appareil et heure du scan dans l'URL (?device_id=...&timestamp=..., heure du serveur par défaut)
+    """
+    if CURRENT_MODE != MODE_WIFI:
+        return {"status": "ignored", "reason": "Server in LoRa mode"}
+
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/octet-stream"):
+        try:
+            networks = decode_ap_blocks(body)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if len(networks) > MAX_SCAN_NETWORKS:
+            raise HTTPException(status_code=422, detail=f"plus de {MAX_SCAN_NETWORKS} réseaux")
+        if timestamp is None:
+            timestamp = int(time.time())
+    else:
+        try:
+            scan = ScanBatch.model_validate_json(body)
+            networks = {mac_to_int(network.mac): network.rssi for network in scan.networks}
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False, include_input=False))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        device_id, timestamp = scan.device_id, scan.timestamp
+
+    HTTP_SCANS_TOTAL.inc()
+    WIFI_SCANS_TOTAL.inc(len(networks))
+
+    def replace_buffer(session):
+        if session.buffer_timestamp is not None and timestamp < session.buffer_timestamp:
+            return None
+        session.wifi_buffer = networks
+        session.buffer_timestamp = timestamp
+        return begin_scan(session, timestamp)
+
+    scan = await update_session(device_id, replace_buffer)
+    if scan is None:
+        return {"status": "ignored", "reason": "older scan"}
+    estimated_pos = await update_position(device_id, scan)
+
+    return {"status": "located" if estimated_pos else "calibrating", "networks": len(networks), "position": estimated_pos}
+
 # Calcul et affichage de la position et de l'historique
 @app.get("/api/get_position")
-async def get_position_api():
+async def get_position_api(device: str = DEFAULT_DEVICE_ID, k: int = Query(K_NEIGHBORS, ge=1, le=MAX_K_NEIGHBORS)):
     """
     Appelé périodiquement par la page web map.html
+    (device : identifiant de l'appareil, k : nombre de voisins optionnel,
+    ex: /api/get_position?device=esp32-1&k=8)
     Vérifie si des données récentes sont là.
-    fais le calcul.
-    màj de l'historique.
-    Renvoie le statut, position, erreur, historique au navigateur
+    Renvoie le statut et la dernière position (calculée à la réception du scan) ; la trace est dans /api/history
     """
-    # Timeout : Si pas de données depuis 10s, on est hors ligne (mode HTTP principalement)
-    if (CURRENT_MODE == MODE_WIFI):
-        if time.time() - last_buffer_update > 10.0:
-            return {"status": "offline"}
-    else: #lora
-        if time.time() - last_buffer_update > 35.0:
-            return {"status": "offline"}
+    session = get_session(device)
 
-    # Calcul de la position
-    estimated_pos = algorithm_wknn(current_wifi_buffer)
+    # Timeout : Si pas de données depuis 10s (HTTP) / 35s (LoRa), on est hors ligne
+    if session is None or is_offline(session):
+        OFFLINE_TOTAL.inc()
+        return {"status": "offline"}
 
-    if estimated_pos:
-        # Ajout à l'historique (pour tracer le chemin)
-        # On évite les doublons si la position n'a pas changé depuis la dernière requête
-        if not position_history or (position_history[-1]['timestamp'] != estimated_pos['timestamp']):
-             position_history.append(estimated_pos)
+    # Position déjà calculée à la réception du scan
+    estimated_pos = await get_cached_position(session, k)
 
+    if estimated_pos:
         return {
             "status": "tracking",
-            "current": estimated_pos,
-            "history": list(position_history) # On renvoie tout l'historique
+            "device": device,
+            "current": estimated_pos
         }
     else:
         return {"status": "calibrating"} # Pas assez de données ou pas de correspondance
 
+# Historique des positions (trace), par pages
+@app.get("/api/history")
+async def get_history(device: str = DEFAULT_DEVICE_ID, since: Optional[int] = None, until: Optional[int] = None,
+                      limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE), cursor: Optional[int] = None,
+                      order: Literal["asc", "desc"] = "asc", simplify: float = Query(0.0, ge=0)):
+    """
+    Positions de l'appareil entre since et until (timestamps en secondes, inclus), limit positions par page.
+    order=desc : des plus récentes aux plus anciennes (ex: ?order=desc&limit=100 pour les 100 dernières).
+    Page suivante : même requête avec cursor = next_cursor de la réponse (null : dernière page).
+    simplify : tolérance en mètres pour alléger la trace (Douglas-Peucker, appliqué à chaque page).
+    """
+    if position_store is None:
+        raise HTTPException(status_code=503, detail="Historique indisponible")
+    positions, next_cursor = await asyncio.get_running_loop().run_in_executor(
+        None, position_store.query, device, since, until, limit, cursor, order == "desc")
+    raw_count = len(positions)
+    if simplify > 0:
+        positions = simplify_track(positions, simplify)
+    return {
+        "device": device,
+        "count": len(positions),
+        "raw_count": raw_count,   # positions de la page avant simplification
+        "next_cursor": next_cursor,
+        "positions": positions
+    }
+
+# Flux temps réel des positions (remplace l'interrogation périodique de /api/get_position)
+@app.get("/api/stream")
+async def stream_positions(request: Request, device: str = DEFAULT_DEVICE_ID):
+    """
+    Server-Sent Events : un message "snapshot" (statut + position actuelle) à la connexion,
+    puis un message "position" par nouvelle position calculée (uniquement le nouveau point),
+    et un message "status" toutes les STREAM_KEEPALIVE secondes sans nouvelle position.
+    """
+    async def event_generator():
+        # Abonnement au premier envoi : une page fermée avant ne laisse pas de file abonnée
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stream_subscribers[device].add(queue)
+        try:
+            yield sse_event("snapshot", session_snapshot(device))
+            while not await request.is_disconnected():
+                try:
+                    estimated_pos = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+                    yield sse_event("position", estimated_pos)
+                except asyncio.TimeoutError:
+                    yield sse_event("status", {"status": session_status(get_session(device))})
+        finally:
+            # Désabonnement (page fermée)
+            stream_subscribers[device].discard(queue)
+            if not stream_subscribers[device]:
+                del stream_subscribers[device]
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Relocalisation par lots (archives d'uplinks TTN)
+@app.post("/api/locate_batch")
+async def locate_batch_api(batch: LocateBatchRequest):
+    """
+    Localise une liste de scans en un seul calcul vectorisé (optionnellement sur plusieurs processus).
+    Chaque scan est soit un payload LoRa brut ("payload", base64), soit un dictionnaire "aps" MAC -> RSSI.
+    Ne touche pas à l'état des appareils (ni buffer, ni historique).
+    """
+    scans = []
+    for i, scan in enumerate(batch.scans):
+        if scan.payload is not None:
+            try:
+                scans.append(decode_ap_blocks(base64.b64decode(scan.payload)))
+            except Exception as e:
+                raise HTTPException(status_code=422, detail=f"scan {i}: payload illisible ({e})")
+        else:
+            try:
+                scans.append({mac_to_int(mac): rssi for mac, rssi in (scan.aps or {}).items()})
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=f"scan {i}: MAC invalide ({e})")
+    timestamps = [scan.timestamp for scan in batch.scans]
+
+    # Calcul hors de la boucle asyncio (CPU) pour ne pas bloquer les autres requêtes
+    start = time.perf_counter()
+    results = await asyncio.get_running_loop().run_in_executor(
+        None, algorithm_wknn_batch, scans, batch.k, timestamps, batch.workers)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "status": "success",
+        "count": len(results),
+        "located": sum(1 for r in results if r is not None),
+        "elapsed": elapsed,
+        "scans_per_second": len(results) / elapsed if elapsed > 0 else None,
+        "results": results
+    }
+
+# Rechargement de la base d'empreintes sans redémarrer le serveur
+@app.post("/api/admin/reload")
+async def reload_database_api(x_admin_token: str = Header("")):
+    """
+    Applique les empreintes ajoutées dans DB_FILE depuis le dernier chargement.
+    Les requêtes de position en cours ne sont pas bloquées.
+    Avec plusieurs processus, l'instantané est complété dans un processus à part puis rechargé
+    par celui qui reçoit la requête, et par les autres dans les SNAPSHOT_WATCH_INTERVAL secondes.
+    """
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Jeton admin invalide")
+
+    start = time.perf_counter()
+    try:
+        added_rows = await reload_database_async()
+    except Exception as e:
+        logger.info(f"Erreur lors du rechargement de la BDD : {e}")
+        return {"status": "error", "details": str(e)}
+
+    return {
+        "status": "success",
+        "added_rows": added_rows,
+        "fingerprints": len(fingerprint_index) if fingerprint_index is not None else 0,
+        "macs": len(fingerprint_index.mac_index) if fingerprint_index is not None else 0,
+        "elapsed": time.perf_counter() - start
+    }
+
+# Liste des appareils suivis
+@app.get("/api/devices")
+async def list_devices():
+    """
+    Renvoie les appareils actifs (ceux qui ont envoyé des données depuis moins de DEVICE_IDLE_TIMEOUT),
+    du plus récent au plus ancien.
+    """
+    devices = []
+    for session in session_store.recent():
+        devices.append({
+            "device": session.device_id,
+            "status": "offline" if is_offline(session) else "online",
+            "last_update": int(session.last_buffer_update),
+            "networks": len(session.wifi_buffer),
+            "search_radius": session.last_search_radius, # zone de recherche du dernier scan (m), None : toute la base
+            "last_position": session.last_position
+        })
+    return {"count": len(devices), "devices": devices}
+
 # --- Route Réception (Mode LoRaWAN - RAW Decoding) ---
 @app.post("/api/lora_uplink")
 async def receive_lora_uplink(request: Request):
     """
     Reçoit le webhook brut de TTN.
-    Décodage du payload Base64 -> Hex -> Parsing (MAC + RSSI)
+    Le message est seulement mis en file d'attente (réponse immédiate),
+    le décodage et le calcul sont faits par lora_uplink_worker.
+    Si la file est pleine, l'uplink est refusé (503) pour ne pas saturer le serveur.
     """
-    global current_wifi_buffer, last_buffer_update
-    
     if CURRENT_MODE != MODE_LORA:
         # On log mais on ne crash pas, au cas où
         logger.info("Erreur : Reçu LoRa mais le serveur est en mode WIFI")
         return {"status": "ignored"}
-    
+
+    body = await request.body()
+    UPLINKS_TOTAL.inc()
     try:
+        uplink_queue.put_nowait((body, time.time()))
+    except asyncio.QueueFull:
+        UPLINKS_DROPPED.inc()
+        logger.info("Erreur : file des uplinks pleine, uplink ignoré")
+        return JSONResponse(status_code=503, content={"status": "dropped", "reason": "queue full"})
+
+    return JSONResponse(status_code=202, content={"status": "queued", "queue_depth": uplink_queue.qsize()})
+
+def process_lora_uplink(body):
+    """
+    Décodage d'un webhook TTN (dans le pool de calcul, hors de la boucle asyncio) :
+    Base64 -> Bytes -> trame (en-tête éventuel + blocs MAC/RSSI).
+    L'appareil est identifié par end_device_ids.device_id.
+    Renvoie (device_id, trame)
+    """
+    with DECODE_SECONDS.time():
         # 1. Récupération du JSON TTN
-        ttn_data = await request.json()
+        ttn_data = json.loads(body)
         
         # 2. Extraction du payload brut (encodé en Base64 par TTN)
         # Le champ s'appelle 'frm_payload' dans 'uplink_message'
-        if 'uplink_message' not in ttn_data or 'frm_payload' not in ttn_data['uplink_message']:
-            logger.info("Erreur: Pas de payload dans le message TTN")
-            return {"status": "error", "reason": "no payload"}
+        uplink = ttn_data.get('uplink_message', {})
+        if 'frm_payload' not in uplink:
+            raise ValueError("no payload")
 
-        b64_payload = ttn_data['uplink_message']['frm_payload']
-        
-        # 3. Décodage Base64 -> Bytes
-        raw_bytes = base64.b64decode(b64_payload)
+        device_id = ttn_data.get('end_device_ids', {}).get('device_id', DEFAULT_DEVICE_ID)
         
-        # 4. Parsing des blocs de 7 octets (6 MAC + 1 RSSI)
-        # Ton code Arduino envoie: [MAC1][RSSI1][MAC2][RSSI2]...
-        networks_found = {}
-        
-        total_len = len(raw_bytes)
-        # On boucle par pas de 7
-        for i in range(0, total_len, 7):            
-            # A. Extraction MAC (6 octets)
-            mac_bytes = raw_bytes[i : i+6]
-            # Formatage "AA:BB:CC:DD:EE:FF"
-            mac_str = ":".join("{:02X}".format(b) for b in mac_bytes)
-            
-            # B. Extraction RSSI (1 octet signé)
-            rssi_byte = raw_bytes[i+6]
-            # Conversion unsigned (0-255) vers signed (-128 à 127)
-            rssi = rssi_byte if rssi_byte < 128 else rssi_byte - 256
-            
-            networks_found[mac_str] = rssi
-            
-        logger.info(f"Reçu LoRa: {len(networks_found)} réseaux décodés.")
-        
-        # 5. Mise à jour du buffer global pour le calcul de position
-        # En LoRa, on reçoit tout d'un coup, donc on remplace le buffer direct
-        current_wifi_buffer = networks_found
-        last_buffer_update = time.time()
-        
-        return {"status": "success", "count": len(networks_found)}
+        # 3. Décodage Base64 -> Bytes -> trame (le FPort indique s'il y a un en-tête multi-trames)
+        frame = decode_frame(base64.b64decode(uplink['frm_payload']), uplink.get('f_port'),
+                             uplink.get('f_cnt'), parse_ttn_time(ttn_data))
+    logger.info(f"Reçu LoRa ({device_id}): trame {frame.index + 1}/{frame.count}, {len(frame.networks)} réseaux décodés.")
+    return device_id, frame
 
-    except Exception as e:
-        logger.info(f"Erreur décodage LoRa: {e}")
-        return {"status": "error", "details": str(e)}
+def apply_lora_uplink(session, networks, timestamp, estimated_pos):
+    """
+    5. Mise à jour du buffer de l'appareil (dans update_session)
+    En LoRa, on reçoit tout le scan (éventuellement regroupé sur plusieurs trames), donc on remplace le buffer direct.
+    Un scan plus ancien que le dernier (traité en parallèle et fini après) ne remplace rien.
+    """
+    if timestamp < session.scan_timestamp:
+        return None
+    session.wifi_buffer = networks
+    session.buffer_timestamp = timestamp
+    session.scan_seq += 1
+    return record_position(session, estimated_pos, timestamp, networks)
+
+async def lora_uplink_worker():
+    """
+    Vide la file des uplinks : décodage dans le pool de threads, regroupement des trames
+    par appareil ici, puis calcul d'une position par scan complet.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        body, received_at = await uplink_queue.get()
+        try:
+            try:
+                device_id, frame = await loop.run_in_executor(compute_executor, process_lora_uplink, body)
+            except ValueError as e: # JSON, Base64 ou trame invalide
+                DECODE_ERRORS.inc()
+                logger.info(f"Erreur décodage LoRa: {e}")
+                continue
+            scans = await update_session(device_id, lambda session: list(session.reassembler.add(frame)))
+            for networks, timestamp, nb_frames, nb_expected in scans:
+                if nb_frames < nb_expected:
+                    logger.info(f"Scan LoRa incomplet ({device_id}): {nb_frames}/{nb_expected} trames reçues")
+                session = get_session(device_id)
+                region = search_region(session, timestamp) if session is not None else None
+                estimated_pos = await loop.run_in_executor(compute_executor, algorithm_wknn, networks, K_NEIGHBORS,
+                                                           timestamp, region)
+                recorded_pos = await update_session(
+                    device_id, lambda session: apply_lora_uplink(session, networks, timestamp, estimated_pos))
+                position_recorded(device_id, recorded_pos)
+            UPLINKS_PROCESSED.inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Trame lue correctement : l'erreur vient du traitement (session, WKNN), pas du webhook
+            PROCESSING_ERRORS.inc()
+            logger.info(f"Erreur traitement LoRa ({device_id}): {e}")
+        finally:
+            # Retard = temps entre la réception du webhook et la fin du traitement
+            lag = time.time() - received_at
+            ingest_stats["lag_last"] = lag
+            ingest_stats["lag_max"] = max(ingest_stats["lag_max"], lag)
+            ingest_stats["lag_total"] += lag
+            UPLINK_LAG_SECONDS.observe(lag)
+            uplink_queue.task_done()
+
+# Statistiques de la file d'attente des uplinks
+@app.get("/api/ingest_stats")
+async def get_ingest_stats():
+    """Profondeur de la file, uplinks refusés, erreurs (décodage / traitement) et retard de traitement (secondes)"""
+    done = UPLINKS_PROCESSED.value + DECODE_ERRORS.value + PROCESSING_ERRORS.value
+    return {
+        "queue_depth": uplink_queue.qsize() if uplink_queue is not None else 0,
+        "queue_size": UPLINK_QUEUE_SIZE,
+        "workers": UPLINK_WORKERS,
+        "received": UPLINKS_TOTAL.value,
+        "dropped": UPLINKS_DROPPED.value,
+        "processed": UPLINKS_PROCESSED.value,
+        "errors": DECODE_ERRORS.value,
+        "processing_errors": PROCESSING_ERRORS.value,
+        "lag_last": ingest_stats["lag_last"],
+        "lag_max": ingest_stats["lag_max"],
+        "lag_avg": ingest_stats["lag_total"] / done if done else 0.0
+    }
+
+# Métriques au format Prometheus
+@app.get("/metrics")
+async def get_metrics():
+    """Compteurs, jauges et histogrammes de durée (format texte Prometheus)"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# Profilage d'une requête à la demande (uniquement si GEOLOC_PROFILING=1)
+if PROFILING:
+    profiling_busy = False # cProfile : un seul profil à la fois
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        """
+        Profile la requête avec cProfile si elle le demande (?profile=1 ou en-tête X-Profile: 1).
+        Le profil est écrit dans PROFILE_DIR (nom renvoyé dans l'en-tête X-Profile-File) et résumé dans le log.
+        Attention : mesure le thread de la boucle asyncio (les calculs faits dans le pool n'y sont pas détaillés).
+        """
+        global profiling_busy
+        wanted = request.query_params.get("profile") == "1" or request.headers.get("x-profile") == "1"
+        if not wanted or profiling_busy:
+            return await call_next(request)
+
+        profiling_busy = True
+        try:
+            with RequestProfile() as profile:
+                response = await call_next(request)
+        finally:
+            profiling_busy = False
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = request.url.path.strip("/").replace("/", "_") or "root"
+        path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}_{name}.prof")
+        profile.dump(path)
+        logger.info(f"Profil de {request.url.path} ({path}) :\n{profile.report()}")
+        response.headers["X-Profile-File"] = path
+        return response
 
 if __name__ == "__main__":
-    uvicorn.run("server_geoloc:app", host=HOST_IP, port=PORT, reload=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Serveur de géolocalisation WiFi")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="processus (production, sans rechargement du code) ; 1 : développement avec rechargement")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # Lu par chaque processus à l'import du module
+        os.environ["GEOLOC_WORKERS"] = str(args.workers)
+        prepare_snapshot()
+        uvicorn.run("server_geoloc:app", host=HOST_IP, port=PORT, workers=args.workers)
+    else:
+        uvicorn.run("server_geoloc:app", host=HOST_IP, port=PORT, reload=True)
\ No newline at end of file
@@ -1,20 +1,24 @@
 import uvicorn
-from fastapi import FastAPI, Request, Form
+from fastapi import FastAPI, Request, Form, HTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse
-from pydantic import BaseModel
-import json
-import os
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional
 from datetime import datetime
+import time
+import fingerprint_store #base sqlite
+from lora_payload import decode_ap_blocks, mac_to_str, mac_to_int #scan binaire (blocs de 7 octets)
+from fingerprint_cleaning import is_locally_administered #partages de connexion
 
-#Récupère tous les wifis à une position pour la base de données,
-# en incluant ceux qui proviennent d'un partage de connexion
-# (supprimés plus tard)
+#Récupère tous les wifis à une position pour la base de données
+# Les partages de connexion (MAC "locally administered") ne sont pas enregistrés (DROP_HOTSPOTS),
+# le reste du nettoyage est fait au chargement par server_geoloc.py (voir fingerprint_cleaning.py)
 
 # === CONFIGURATION ===
 HOST_IP = "0.0.0.0"
 PORT = 8004 #port associé pour le serveur ovh / le même pour en local
-DB_FILE = "database_test_yvelines.json" # fichier pour sauvegarder la database
+DB_FILE = "database_wifi.db" # base SQLite pour sauvegarder la database (même schéma que server_geoloc.py)
+DROP_HOTSPOTS = True # False : tout enregistrer (les partages de connexion sont de toute façon ignorés au chargement)
 
 app = FastAPI()
 # Dossier où se trouvent les fichiers HTML
@@ -30,21 +34,32 @@ class WifiData(BaseModel):
     mac: str
     rssi: int
 
+# Un scan complet en une requête (/api/scan)
+class ScanNetwork(BaseModel):
+    mac: str
+    rssi: int
+    ssid: str = ""
+
+class WifiScan(BaseModel):
+    timestamp: int
+    networks: List[ScanNetwork]
+
 # === FONCTIONS ===
+def is_hotspot(mac):
+    """Partage de connexion / MAC aléatoire (bit locally administered), False si la MAC est illisible"""
+    try:
+        return is_locally_administered(mac_to_int(mac))
+    except ValueError:
+        return False
+
 # Pour sauvegarder les données dans la database
-def save_to_json_db(data_list):
-    current_db = []
-    if os.path.exists(DB_FILE):
-        try:
-            with open(DB_FILE, 'r') as f:
-                current_db = json.load(f)
-        except:
-            current_db = []
-    
-    current_db.extend(data_list)
-    
-    with open(DB_FILE, 'w') as f:
-        json.dump(current_db, f, indent=4)
+# Ajout uniquement des nouvelles lignes, en une transaction par scan tagué
+def save_to_sql_db(data_list):
+    conn = fingerprint_store.connect(DB_FILE)
+    try:
+        return fingerprint_store.insert_fingerprints(conn, data_list)
+    finally:
+        conn.close()
 
 # === ROUTES ===
 #page principale
@@ -67,6 +82,10 @@ async def home(request: Request):
 # pour reçevoir les données de l'esp32
 @app.post("/api/raw_scan")
 async def receive_raw(data: WifiData):
+    try:
+        mac_to_int(data.mac)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"MAC invalide : {data.mac}")
     ts = data.timestamp
     if ts not in pending_scans: #scan différent
         pending_scans[ts] = []
@@ -75,6 +94,36 @@ async def receive_raw(data: WifiData):
     print(f"Reçu: {data.ssid} ({data.rssi}) - Attente des coordonnées sur le web")
     return {"status": "stored_temporarily"}
 
+# pour reçevoir un scan complet de l'esp32 en une seule requête
+# JSON {"timestamp": ..., "networks": [{"mac", "rssi", "ssid"}, ...]}
+# ou binaire (application/octet-stream) : blocs de 7 octets [MAC][RSSI], heure dans l'URL (?timestamp=...)
+@app.post("/api/scan")
+async def receive_scan(request: Request, timestamp: Optional[int] = None):
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/octet-stream"):
+        try:
+            networks = [{"ssid": "", "mac": mac_to_str(mac), "rssi": rssi} for mac, rssi in decode_ap_blocks(body).items()]
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        ts = timestamp if timestamp is not None else int(time.time())
+    else:
+        try:
+            scan = WifiScan.model_validate_json(body)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False, include_input=False))
+        try:
+            for network in scan.networks:
+                mac_to_int(network.mac)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        networks = [network.model_dump() for network in scan.networks]
+        ts = scan.timestamp
+
+    # le scan entier remplace un éventuel envoi partiel avec le même timestamp
+    pending_scans[ts] = [dict(network, timestamp=ts) for network in networks]
+    print(f"Reçu: scan {ts} ({len(networks)} réseaux) - Attente des coordonnées sur le web")
+    return {"status": "stored_temporarily", "networks": len(networks)}
+
 # Pour sauvegarder un scan une fois les coordonnées renseignées
 @app.post("/tag_scan")
 async def tag_scan(
@@ -85,6 +134,8 @@ async def tag_scan(
 ):
     if timestamp in pending_scans:
         wifi_list = pending_scans[timestamp]
+        if DROP_HOTSPOTS:
+            wifi_list = [wifi for wifi in wifi_list if not is_hotspot(wifi["mac"])]
         
         geolocated_data = []
         for wifi in wifi_list:
@@ -94,7 +145,7 @@ async def tag_scan(
             enriched_wifi["floor"] = floor
             geolocated_data.append(enriched_wifi)
         
-        save_to_json_db(geolocated_data)
+        save_to_sql_db(geolocated_data)
         
         del pending_scans[timestamp]
         print(f"Scan {timestamp} validé et sauvegardé !")
@@ -0,0 +1,186 @@
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+# État des appareils suivis par server_geoloc.py (buffer du dernier scan, trames LoRa en attente, filtre de suivi...)
+# - MemorySessionStore : dans le processus (un seul processus uvicorn), sessions modifiées sur place
+# - SqliteSessionStore : partagé entre les processus (python server_geoloc.py --workers N), base SQLite WAL,
+#   une ligne par appareil (session picklée) : n'importe quel processus peut traiter n'importe quel appareil.
+# Toute modification passe par update(appareil, change) : change(session) est appelé sur la session
+# (créée si besoin, marquée comme la plus récente) puis la session est enregistrée, en une transaction
+# pour SqliteSessionStore (les autres processus attendent). Les calculs longs (WKNN) se font entre deux
+# update() : voir scan_seq dans server_geoloc.py.
+
+logger = logging.getLogger(__name__)
+
+class MemorySessionStore:
+    """Sessions dans un OrderedDict : du moins récemment mis à jour au plus récent, pour supprimer facilement les inactifs"""
+    shared = False
+
+    def __init__(self, factory, idle_timeout, max_devices):
+        self.factory = factory # factory(device_id) -> nouvelle session
+        self.idle_timeout = idle_timeout
+        self.max_devices = max_devices
+        self.sessions = OrderedDict()
+
+    def get(self, device_id):
+        """Session de l'appareil (None si inconnu)"""
+        return self.sessions.get(device_id)
+
+    def update(self, device_id, change):
+        session = self.sessions.get(device_id)
+        if session is None:
+            session = self.factory(device_id)
+            self.sessions[device_id] = session
+        else:
+            self.sessions.move_to_end(device_id)
+        session.last_buffer_update = time.time()
+        self.evict()
+        return change(session)
+
+    def evict(self):
+        """
+        Supprime les appareils inactifs depuis plus de idle_timeout,
+        et les plus anciens si on dépasse max_devices : la mémoire reste bornée.
+        """
+        now = time.time()
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if now - oldest.last_buffer_update > self.idle_timeout or len(self.sessions) > self.max_devices:
+                del self.sessions[oldest.device_id]
+                logger.info(f"Appareil {oldest.device_id} oublié (inactif)")
+            else:
+                break
+
+    def recent(self, limit=None):
+        """Sessions actives, de la plus récente à la plus ancienne (les limit premières)"""
+        self.evict()
+        return list(islice(reversed(self.sessions.values()), limit))
+
+    def count_updated_since(self, since):
+        return sum(1 for session in self.sessions.values() if session.last_buffer_update >= since)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def close(self):
+        pass
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        device TEXT PRIMARY KEY,
+        updated REAL NOT NULL,                   -- last_buffer_update de la session
+        position_seq INTEGER NOT NULL DEFAULT 0, -- incrémenté à chaque nouvelle position (flux temps réel)
+        position TEXT,                           -- dernière position (JSON), lue sans dépickler la session
+        state BLOB NOT NULL                      -- session picklée
+    );
+    -- Suppression des inactifs, liste des appareils
+    CREATE INDEX IF NOT EXISTS idx_updated ON sessions (updated);
+"""
+
+EVICT_INTERVAL = 60.0 # Secondes entre deux suppressions des inactifs (faites pendant un update)
+
+class SqliteSessionStore:
+    """
+    Sessions dans une base SQLite WAL partagée entre processus.
+    Deux connexions : une pour les écritures (update, un seul thread à la fois, transaction BEGIN IMMEDIATE)
+    et une pour les lectures, qui ne sont jamais bloquées par les écritures (WAL).
+    get() et recent() renvoient des copies : les modifier ne change rien en base.
+    """
+    shared = True
+
+    def __init__(self, db_file, factory, idle_timeout, max_devices):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_devices = max_devices
+        # isolation_level=None : transactions gérées à la main (BEGIN IMMEDIATE)
+        self.writer = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.executescript(SCHEMA)
+        self.reader = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.last_evict = 0.0
+
+    def get(self, device_id):
+        with self.read_lock:
+            row = self.reader.execute("SELECT state FROM sessions WHERE device = ?", (device_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def update(self, device_id, change):
+        with self.write_lock:
+            conn = self.writer
+            # Verrou d'écriture pris tout de suite : personne ne modifie la session entre la lecture et l'écriture
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT state, position_seq FROM sessions WHERE device = ?", (device_id,)).fetchone()
+                session = pickle.loads(row[0]) if row else self.factory(device_id)
+                position_seq = row[1] if row else 0
+                last_position = session.last_position
+                now = time.time()
+                session.last_buffer_update = now
+                result = change(session)
+                if session.last_position is not last_position:
+                    position_seq += 1
+                conn.execute(
+                    "INSERT INTO sessions (device, updated, position_seq, position, state) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(device) DO UPDATE SET updated = excluded.updated, position_seq = excluded.position_seq, "
+                    "position = excluded.position, state = excluded.state",
+                    (device_id, now, position_seq, json.dumps(session.last_position),
+                     pickle.dumps(session, pickle.HIGHEST_PROTOCOL))
+                )
+                if now - self.last_evict > EVICT_INTERVAL:
+                    self.last_evict = now
+                    self._evict(conn, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _evict(self, conn, now):
+        """Même règle que MemorySessionStore.evict (dans la transaction d'update)"""
+        deleted = conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.idle_timeout,)).rowcount
+        deleted += conn.execute(
+            "DELETE FROM sessions WHERE device IN (SELECT device FROM sessions ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+            (self.max_devices,)
+        ).rowcount
+        if deleted:
+            logger.info(f"{deleted} appareil(s) oublié(s) (inactifs)")
+
+    def recent(self, limit=None):
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT state FROM sessions WHERE updated >= ? ORDER BY updated DESC LIMIT ?",
+                (time.time() - self.idle_timeout, self.max_devices if limit is None else min(limit, self.max_devices))
+            ).fetchall()
+        return [pickle.loads(state) for state, in rows]
+
+    def count_updated_since(self, since):
+        with self.read_lock:
+            return self.reader.execute("SELECT count(*) FROM sessions WHERE updated >= ?", (since,)).fetchone()[0]
+
+    def last_positions(self, device_ids):
+        """{appareil: (position_seq, dernière position en JSON)} pour les appareils connus de la liste"""
+        placeholders = ",".join("?" * len(device_ids))
+        with self.read_lock:
+            rows = self.reader.execute(
+                f"SELECT device, position_seq, position FROM sessions WHERE device IN ({placeholders})", list(device_ids)
+            ).fetchall()
+        return {device: (position_seq, position) for device, position_seq, position in rows}
+
+    def __len__(self):
+        with self.read_lock:
+            return self.reader.execute("SELECT count(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+        with self.read_lock:
+            self.reader.close()
@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+# Modules du serveur à la racine du dépôt (lancés avec python server_geoloc.py, pas de paquet)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture
+def geoloc(tmp_path, monkeypatch):
+    """Module server_geoloc en mode WiFi, sur des bases vides dans tmp_path (la base du dépôt n'est pas lue)"""
+    import server_geoloc
+    monkeypatch.chdir(ROOT) # templates/
+    monkeypatch.setattr(server_geoloc, "CURRENT_MODE", server_geoloc.MODE_WIFI)
+    monkeypatch.setattr(server_geoloc, "DB_FILE", str(tmp_path / "fingerprints.db"))
+    monkeypatch.setattr(server_geoloc, "AP_PRIORS_DB", "")
+    monkeypatch.setattr(server_geoloc, "HISTORY_DB", str(tmp_path / "positions.db"))
+    monkeypatch.setattr(server_geoloc, "WORKERS", 1)
+    # Base chargée remise à zéro après chaque test
+    for name in ("fingerprint_index", "ap_locator", "db_last_rowid", "db_last_timestamp", "scan_cleaner", "spread_dropped_macs"):
+        monkeypatch.setattr(server_geoloc, name, getattr(server_geoloc, name))
+    return server_geoloc
+
+@pytest.fixture
+def geoloc_client(geoloc):
+    from fastapi.testclient import TestClient
+    with TestClient(geoloc.app) as client:
+        yield client
+
+@pytest.fixture
+def capture_client(tmp_path, monkeypatch):
+    import server_wifi_capture
+    from fastapi.testclient import TestClient
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(server_wifi_capture, "DB_FILE", str(tmp_path / "fingerprints.db"))
+    monkeypatch.setattr(server_wifi_capture, "pending_scans", {})
+    with TestClient(server_wifi_capture.app) as client:
+        yield client
@@ -0,0 +1,38 @@
+import pytest
+from ap_locator import APLocator
+from fingerprint_cleaning import drop_spread_aps
+from wknn_engine import IndexBuilder
+
+# Routeurs (MAC "globally administered" : gardées par le nettoyage)
+MOBILE = 0x001122334455  # vu à deux endroits distants de ~1 km : retiré par drop_spread_aps
+AP_A = 0x001122334466
+AP_B = 0x001122334477
+
+@pytest.fixture
+def cleaned(geoloc, monkeypatch):
+    """Base de deux empreintes dont le routeur MOBILE est retiré (colonne gardée, sans empreinte)"""
+    builder = IndexBuilder()
+    for key, lat, ap in ((1, 48.80, AP_A), (2, 48.81, AP_B)):
+        builder.add(key, MOBILE, -40, lat, 1.90, 0)
+        builder.add(key, ap, -50, lat, 1.90, 0)
+    index, dropped = drop_spread_aps(builder.build())
+    assert dropped == {MOBILE} and MOBILE in index.mac_index
+    # Position WiGLE du routeur retiré : seule source pour un scan qui ne voit que lui
+    locator = APLocator.build(index, [(MOBILE, 48.805, 1.905)])
+    monkeypatch.setattr(geoloc, "fingerprint_index", index)
+    monkeypatch.setattr(geoloc, "ap_locator", locator)
+    monkeypatch.setattr(geoloc, "AP_PREFILTER", False)
+    return geoloc
+
+FIELDS = ("lat", "lon", "floor", "accuracy", "engine", "timestamp")
+
+@pytest.mark.parametrize("scan, engine", [
+    ({MOBILE: -45}, "ap_fallback"),           # seulement le routeur retiré : aucune empreinte candidate
+    ({MOBILE: -45, AP_A: -55}, "wknn"),
+    ({0x001122339999: -60}, "wknn"),          # routeur sans position connue : pas de repli possible
+])
+def test_batch_matches_single(cleaned, scan, engine):
+    single = cleaned.algorithm_wknn(scan, timestamp=100)
+    batch, = cleaned.algorithm_wknn_batch([scan], timestamps=[100])
+    assert single["engine"] == engine
+    assert {field: batch[field] for field in FIELDS} == {field: single[field] for field in FIELDS}
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+import import_wigle
+from import_wigle import Checkpoint, Importer, RateLimiter, WigleClient, WigleError
+
+BBOX = (48.80, 48.82, 1.90, 1.92)
+
+def make_networks(count):
+    """Réseaux répartis sur une grille qui couvre BBOX"""
+    side = int(count ** 0.5) + 1
+    return [{"netid": f"00:11:22:33:{i // 256:02x}:{i % 256:02x}", "ssid": f"net{i}",
+             "trilat": BBOX[0] + (i // side + 0.5) * (BBOX[1] - BBOX[0]) / side,
+             "trilong": BBOX[2] + (i % side + 0.5) * (BBOX[3] - BBOX[2]) / side,
+             "lastupdt": "2025-01-01"} for i in range(count)]
+
+class StubWigle(BaseHTTPRequestHandler):
+    """
+    /api/v2/network/search comme WiGLE : réseaux de la tuile triés par netid, resultsPerPage par page,
+    curseur searchAfter = netid du dernier résultat. self.server.reply(n) peut imposer une autre réponse
+    à la n-ième requête : (code, en-têtes).
+    """
+    def do_GET(self):
+        server = self.server
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        with server.lock:
+            server.requests.append(params)
+            forced = server.reply(len(server.requests))
+        if forced is not None:
+            code, headers = forced
+            self.send_response(code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        lat1, lat2, lon1, lon2 = (float(params[key]) for key in ("latrange1", "latrange2", "longrange1", "longrange2"))
+        # Bornes min incluses, max exclues (sauf au bord de la zone) : chaque réseau est dans une seule tuile
+        inside = [net for net in server.networks
+                  if lat1 <= net["trilat"] < lat2 + (1e-9 if lat2 >= BBOX[1] else 0)
+                  and lon1 <= net["trilong"] < lon2 + (1e-9 if lon2 >= BBOX[3] else 0)]
+        inside.sort(key=lambda net: net["netid"])
+        after = params.get("searchAfter")
+        page = [net for net in inside if after is None or net["netid"] > after][:int(params["resultsPerPage"])]
+        more = page and page[-1]["netid"] != inside[-1]["netid"]
+        body = json.dumps({"success": True, "totalResults": len(inside), "results": page,
+                           "searchAfter": page[-1]["netid"] if more else None}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def wigle():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubWigle)
+    server.networks = make_networks(250)
+    server.requests = []
+    server.lock = threading.Lock()
+    server.reply = lambda n: None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(import_wigle, "RESULTS_PER_PAGE", 20)
+    monkeypatch.setattr(import_wigle, "MAX_RESULTS_PER_TILE", 1000)
+
+def run_import(server, tmp_path, workers=1):
+    db = tmp_path / "wigle.db"
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), BBOX)
+    client = WigleClient(f"http://127.0.0.1:{server.server_address[1]}", "token", RateLimiter(0))
+    importer = Importer(client, str(db), checkpoint)
+    return importer, importer.run(workers), checkpoint
+
+def imported_macs(tmp_path):
+    conn = sqlite3.connect(tmp_path / "wigle.db")
+    try:
+        return {mac for mac, in conn.execute("SELECT mac FROM ap_priors")}
+    finally:
+        conn.close()
+
+def all_macs(server):
+    return {net["netid"].upper() for net in server.networks}
+
+def test_follows_search_after(wigle, tmp_path):
+    _, imported, _ = run_import(wigle, tmp_path)
+    assert imported == 250
+    assert imported_macs(tmp_path) == all_macs(wigle)
+    # 250 réseaux, 20 par page : 13 pages, chacune après le curseur de la précédente
+    assert len(wigle.requests) == 13
+    assert "searchAfter" not in wigle.requests[0]
+    assert all("searchAfter" in params for params in wigle.requests[1:])
+
+def test_splits_tiles_over_result_cap(wigle, tmp_path, monkeypatch):
+    monkeypatch.setattr(import_wigle, "MAX_RESULTS_PER_TILE", 100)
+    _, imported, _ = run_import(wigle, tmp_path, workers=4)
+    assert imported == 250
+    assert imported_macs(tmp_path) == all_macs(wigle)
+    tiles = {(params["latrange1"], params["latrange2"], params["longrange1"], params["longrange2"]) for params in wigle.requests}
+    assert len(tiles) >= 5 # la zone, puis ses 4 sous-tuiles (au moins)
+
+@pytest.mark.parametrize("retry_after", [lambda: "1", lambda: formatdate(time.time() + 2, usegmt=True)])
+def test_backs_off_on_429(wigle, tmp_path, retry_after):
+    # Retry-After en secondes ou en date HTTP (arrondie à la seconde : pause entre 1 et 2 s)
+    wigle.reply = lambda n: (429, {"Retry-After": retry_after()}) if n == 2 else None
+    start = time.monotonic()
+    _, imported, _ = run_import(wigle, tmp_path)
+    assert imported == 250
+    assert time.monotonic() - start >= 1.0
+    # La page refusée est redemandée avec le même curseur
+    assert wigle.requests[2] == wigle.requests[1]
+
+def test_does_not_split_below_min_tile_size(wigle, tmp_path, monkeypatch):
+    # Tuile haute mais étroite : la découper descendrait sous MIN_TILE_SIZE en longitude
+    monkeypatch.setattr(import_wigle, "MAX_RESULTS_PER_TILE", 10)
+    monkeypatch.setattr(import_wigle, "MIN_TILE_SIZE", 0.01)
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), (48.80, 48.82, 1.90, 1.905))
+    client = WigleClient(f"http://127.0.0.1:{wigle.server_address[1]}", "token", RateLimiter(0))
+    Importer(client, str(tmp_path / "wigle.db"), checkpoint).run(1)
+    assert {params["longrange2"] for params in wigle.requests} == {"1.905"}
+
+def test_requires_wigle_auth(monkeypatch):
+    monkeypatch.setattr(import_wigle, "WIGLE_AUTH", "")
+    monkeypatch.setattr("sys.argv", ["import_wigle.py"])
+    with pytest.raises(SystemExit, match="WIGLE_AUTH"):
+        import_wigle.main()
+
+def test_resumes_from_checkpoint(wigle, tmp_path):
+    wigle.reply = lambda n: (401, {}) if n == 5 else None
+    with pytest.raises(WigleError):
+        run_import(wigle, tmp_path)
+    saved = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert saved["imported"] == 80 # 4 pages de 20 enregistrées avant l'erreur
+    first_run = len(wigle.requests)
+
+    wigle.reply = lambda n: None
+    _, imported, checkpoint = run_import(wigle, tmp_path)
+    assert imported == 250
+    assert imported_macs(tmp_path) == all_macs(wigle)
+    # Reprise au curseur sauvegardé : les 4 premières pages ne sont pas redemandées
+    assert wigle.requests[first_run]["searchAfter"] == wigle.requests[first_run - 1]["searchAfter"]
+    assert len(wigle.requests) - first_run == 13 - 4
+    checkpoint.finish()
+    assert not (tmp_path / "checkpoint.json").exists()
+
+def test_error_stops_other_tiles_and_closes_db(wigle, tmp_path, monkeypatch):
+    monkeypatch.setattr(import_wigle, "MAX_RESULTS_PER_TILE", 100)
+    wigle.reply = lambda n: (401, {}) if n == 3 else None
+    importer = Importer(WigleClient(f"http://127.0.0.1:{wigle.server_address[1]}", "token", RateLimiter(0)),
+                        str(tmp_path / "wigle.db"), Checkpoint(str(tmp_path / "checkpoint.json"), BBOX))
+    with pytest.raises(WigleError):
+        importer.run(4)
+    # Au plus une page de plus par tuile en cours, pas tout l'import
+    assert len(wigle.requests) < 3 + 4
+    with pytest.raises(sqlite3.ProgrammingError):
+        importer.conn.execute("SELECT 1")
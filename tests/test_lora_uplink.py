@@ -0,0 +1,52 @@
+import base64
+import json
+import time
+import pytest
+from lora_payload import FPORT_MULTI_FRAME, ScanReassembler, decode_frame
+
+def uplink(payload, device_id="dev1", f_port=1, f_cnt=1):
+    return json.dumps({"end_device_ids": {"device_id": device_id},
+                       "uplink_message": {"frm_payload": base64.b64encode(payload).decode(), "f_port": f_port, "f_cnt": f_cnt}})
+
+def wait_ingest(client, count):
+    for _ in range(200):
+        stats = client.get("/api/ingest_stats").json()
+        if stats["processed"] + stats["errors"] + stats["processing_errors"] >= count:
+            return stats
+        time.sleep(0.01)
+    pytest.fail("uplinks non traités")
+
+@pytest.fixture
+def lora_client(geoloc, geoloc_client, monkeypatch):
+    monkeypatch.setattr(geoloc, "CURRENT_MODE", geoloc.MODE_LORA)
+    for counter in (geoloc.UPLINKS_PROCESSED, geoloc.DECODE_ERRORS, geoloc.PROCESSING_ERRORS):
+        monkeypatch.setattr(counter, "value", 0)
+    return geoloc_client
+
+def test_decode_and_processing_errors_counted_apart(geoloc, lora_client, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("panne WKNN")
+    monkeypatch.setattr(geoloc, "algorithm_wknn", fail)
+    assert lora_client.post("/api/lora_uplink", content=b"pas du json").status_code == 202
+    assert lora_client.post("/api/lora_uplink", content=uplink(b"\x00" * 5)).status_code == 202 # tronqué
+    assert lora_client.post("/api/lora_uplink", content=uplink(bytes(range(7)))).status_code == 202
+    stats = wait_ingest(lora_client, 3)
+    assert (stats["processed"], stats["errors"], stats["processing_errors"]) == (0, 2, 1)
+
+def frame(index, fcnt, count=3, scan_id=7):
+    return decode_frame(bytes([scan_id, index << 4 | count]) + bytes([0, 0, 0, 0, 0, index, 0xC0]),
+                        FPORT_MULTI_FRAME, fcnt, 100.0 + fcnt)
+
+def test_reassembler_tolerates_out_of_order_frames():
+    # Trames traitées dans le désordre (webhooks concurrents) : pas prises pour un redémarrage
+    reassembler = ScanReassembler()
+    assert reassembler.add(frame(1, 11)) == []
+    assert reassembler.add(frame(0, 10)) == []
+    (networks, timestamp, nb_frames, nb_expected), = reassembler.add(frame(2, 12))
+    assert (len(networks), timestamp, nb_frames, nb_expected) == (3, 110.0, 3, 3)
+
+def test_reassembler_flushes_on_reboot():
+    reassembler = ScanReassembler()
+    assert reassembler.add(frame(0, 50)) == []
+    (_, _, nb_frames, _), = reassembler.add(frame(0, 1, scan_id=0))
+    assert nb_frames == 1
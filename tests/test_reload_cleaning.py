@@ -0,0 +1,52 @@
+import pytest
+import fingerprint_store
+from fingerprint_cleaning import drop_spread_aps
+from lora_payload import mac_to_int
+from wknn_engine import IndexBuilder
+
+MOBILE = "00:11:22:33:44:55" # routeur dans un bus : vu à ~1 km d'écart
+FIXED = "00:11:22:33:44:66"
+
+def scan(timestamp, lat, macs):
+    # RSSI différent à chaque scan : pas retiré comme scan répété
+    return [{"timestamp": timestamp, "ssid": "", "mac": mac, "rssi": -50 - timestamp, "latitude": lat, "longitude": 1.90, "floor": 0}
+            for mac in macs]
+
+def postings(index, mac):
+    col = index.mac_index[mac_to_int(mac)]
+    return int(index.post_ptr[col + 1] - index.post_ptr[col])
+
+@pytest.mark.parametrize("use_snapshot", [False, True])
+def test_dropped_ap_stays_dropped_after_incremental_reload(geoloc, monkeypatch, use_snapshot):
+    monkeypatch.setattr(geoloc, "MODE_DB", geoloc.MODE_SQL)
+    monkeypatch.setattr(geoloc, "USE_SNAPSHOT", use_snapshot)
+    conn = fingerprint_store.connect(geoloc.DB_FILE)
+    fingerprint_store.insert_fingerprints(conn, scan(1, 48.80, [MOBILE, FIXED]) + scan(2, 48.81, [MOBILE]))
+    geoloc.load_fingerprints()
+    assert postings(geoloc.fingerprint_index, MOBILE) == 0
+    if use_snapshot:
+        # Redémarrage : l'index vient de l'instantané, les routeurs retirés de ses métadonnées
+        monkeypatch.setattr(geoloc, "spread_dropped_macs", set())
+        assert geoloc.load_database_snapshot()
+
+    # Nouvelles mesures du routeur, toutes au même endroit : seules, elles passeraient le seuil d'étendue
+    fingerprint_store.insert_fingerprints(conn, scan(3, 48.80, [MOBILE, FIXED]) + scan(4, 48.8001, [MOBILE, FIXED]))
+    conn.close()
+    assert geoloc.reload_database() > 0
+    assert postings(geoloc.fingerprint_index, MOBILE) == 0
+    assert postings(geoloc.fingerprint_index, FIXED) == 3
+
+def test_invalid_mac_rows_skipped(geoloc, monkeypatch):
+    monkeypatch.setattr(geoloc, "MODE_DB", geoloc.MODE_SQL)
+    conn = fingerprint_store.connect(geoloc.DB_FILE)
+    fingerprint_store.insert_fingerprints(conn, scan(1, 48.80, [FIXED, "N/A"]))
+    conn.close()
+    assert [row[2] for row in geoloc.read_sql_rows()] == [mac_to_int(FIXED)]
+    geoloc.load_fingerprints()
+    assert postings(geoloc.fingerprint_index, FIXED) == 1
+
+def test_dropped_macs_kept_when_nothing_to_check():
+    # Index vide ou seuil désactivé : les routeurs déjà retirés restent connus
+    dropped = {mac_to_int(MOBILE)}
+    assert drop_spread_aps(IndexBuilder().build(), dropped_macs=dropped)[1] == dropped
+    assert drop_spread_aps(None, max_spread=0, dropped_macs=dropped)[1] == dropped
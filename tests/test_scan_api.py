@@ -0,0 +1,38 @@
+import pytest
+
+# Corps invalides de /api/scan : erreur 422 (pas 500), sur le serveur de géolocalisation et sur celui de capture
+INVALID_BODIES = [
+    (b"garbage", {}),
+    (b'{"timestamp": "hier", "networks": [{"mac": "AA:BB:CC:DD:EE:FF", "rssi": "fort"}]}', {"content-type": "application/json"}),
+    (b'{"timestamp": 1, "networks": "aucun"}', {"content-type": "application/json"}),
+]
+
+@pytest.mark.parametrize("body, headers", INVALID_BODIES)
+def test_geoloc_scan_rejects_invalid_body(geoloc_client, body, headers):
+    response = geoloc_client.post("/api/scan", content=body, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"]
+
+@pytest.mark.parametrize("body, headers", INVALID_BODIES)
+def test_capture_scan_rejects_invalid_body(capture_client, body, headers):
+    response = capture_client.post("/api/scan", content=body, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"]
+
+def test_geoloc_scan_rejects_invalid_mac(geoloc_client):
+    response = geoloc_client.post("/api/scan", json={"timestamp": 1, "networks": [{"mac": "zz", "rssi": -50}]})
+    assert response.status_code == 422
+
+def test_geoloc_scan_accepts_valid_body(geoloc_client):
+    response = geoloc_client.post("/api/scan", json={"timestamp": 1, "device_id": "a",
+                                                     "networks": [{"mac": "AA:BB:CC:DD:EE:FF", "rssi": -50}]})
+    assert response.status_code == 200
+    assert response.json()["networks"] == 1
+
+def test_capture_rejects_invalid_mac(capture_client):
+    response = capture_client.post("/api/scan", json={"timestamp": 1, "networks": [{"mac": "N/A", "rssi": -50}]})
+    assert response.status_code == 422
+    response = capture_client.post("/api/raw_scan", json={"timestamp": 1, "ssid": "", "mac": "N/A", "rssi": -50})
+    assert response.status_code == 422
+    response = capture_client.post("/api/raw_scan", json={"timestamp": 1, "ssid": "", "mac": "AA:BB:CC:DD:EE:FF", "rssi": -50})
+    assert response.status_code == 200
@@ -0,0 +1,27 @@
+import fingerprint_store
+
+def scan(timestamp, lat, macs):
+    return [{"timestamp": timestamp, "ssid": "", "mac": mac, "rssi": -50 - timestamp, "latitude": lat, "longitude": 1.90, "floor": 0}
+            for mac in macs]
+
+def test_snapshot_rejected_after_row_update(geoloc, monkeypatch):
+    monkeypatch.setattr(geoloc, "MODE_DB", geoloc.MODE_SQL)
+    monkeypatch.setattr(geoloc, "USE_SNAPSHOT", True)
+    conn = fingerprint_store.connect(geoloc.DB_FILE)
+    fingerprint_store.insert_fingerprints(conn, scan(1, 48.80, ["00:11:22:33:44:55", "00:11:22:33:44:66"]))
+    geoloc.load_fingerprints()
+    assert geoloc.load_database_snapshot()
+
+    # Position corrigée sur place : même nombre de lignes, même dernier id
+    conn.execute("UPDATE fingerprints SET latitude = 48.90 WHERE id = 1")
+    conn.commit()
+    assert not geoloc.load_database_snapshot()
+    # Une mise à jour --update ne peut pas la rattraper (seules les nouvelles lignes sont relues)
+    assert not geoloc.load_database_snapshot(stale=True)
+
+    # Ajout seul : instantané périmé mais complétable
+    geoloc.load_fingerprints()
+    fingerprint_store.insert_fingerprints(conn, scan(2, 48.80, ["00:11:22:33:44:55"]))
+    conn.close()
+    assert not geoloc.load_database_snapshot()
+    assert geoloc.load_database_snapshot(stale=True)
@@ -0,0 +1,140 @@
+import math
+import numpy as np
+
+# Filtre de suivi par appareil (utilisé par server_geoloc.py)
+# Filtre de Kalman à vitesse constante : les positions WKNN successives (bruitées, indépendantes)
+# sont fusionnées avec un modèle de mouvement (piéton). Donne aussi la zone où chercher
+# le prochain scan (position prédite + rayon), pour limiter la recherche WKNN aux empreintes proches.
+# Calculs en mètres dans un repère local centré sur la première position.
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+ACCEL_NOISE = 0.05         # Accélération "aléatoire" du modèle (m/s²) : plus grand = suit plus vite, lisse moins
+INITIAL_SPEED_SIGMA = 2.0  # Incertitude sur la vitesse au premier scan (m/s)
+MIN_MEASURE_SIGMA = 5.0    # Incertitude minimum d'une position WKNN (m) (son "accuracy" peut valoir 0)
+GATE_CHI2 = 13.8           # Seuil (chi², 2 degrés, 99.9 %) au-delà duquel une position est jugée aberrante
+MAX_OUTLIERS = 2           # Positions aberrantes ignorées d'affilée avant de réinitialiser le filtre
+RESET_AFTER = 600.0        # Secondes sans scan avant de repartir de zéro
+
+SEARCH_SIGMAS = 3.0        # Rayon de recherche = SEARCH_SIGMAS * incertitude de la prédiction
+SEARCH_MIN_RADIUS = 25.0   # Rayon de recherche minimum (m)
+SEARCH_MAX_RADIUS = 2000.0 # Au-delà : recherche dans toute la base
+
+METERS_PER_DEGREE = 111320
+
+class KalmanTracker:
+    """
+    État : [x, y, vx, vy] (m, m/s), covariance P.
+    update() renvoie la position filtrée, search_region() la zone de recherche du prochain scan.
+    """
+    def __init__(self):
+        self.origin = None     # (lat, lon) du repère local
+        self.x = None
+        self.P = None
+        self.t = None          # heure de la dernière mise à jour
+        self.prior = None      # état avant la dernière mise à jour (pour la refaire, même scan), voir _state_for
+        self.outliers = 0
+
+    # --- Repère local ---
+    def _to_local(self, lat, lon):
+        return ((lon - self.origin[1]) * METERS_PER_DEGREE * math.cos(math.radians(self.origin[0])),
+                (lat - self.origin[0]) * METERS_PER_DEGREE)
+
+    def _to_geo(self, x, y, origin=None):
+        origin = origin or self.origin
+        return (origin[0] + y / METERS_PER_DEGREE,
+                origin[1] + x / (METERS_PER_DEGREE * math.cos(math.radians(origin[0]))))
+
+    # --- Filtre ---
+    def _state(self):
+        return self.origin, self.x, self.P, self.t, self.outliers
+
+    def _state_for(self, t):
+        """
+        État à partir duquel traiter le scan de l'heure t : celui d'avant la dernière mise à jour
+        si elle concernait déjà ce scan (position recalculée avec plus de réseaux), sinon l'état actuel.
+        """
+        if self.x is not None and t == self.t and self.prior is not None:
+            return self.prior
+        return self._state()
+
+    def _reset(self, lat, lon, sigma, t):
+        self.prior = self._state() # état d'avant ce scan (vide au premier scan)
+        self.origin = (lat, lon)
+        self.x = np.zeros(4)
+        self.P = np.diag([sigma ** 2, sigma ** 2, INITIAL_SPEED_SIGMA ** 2, INITIAL_SPEED_SIGMA ** 2])
+        self.t = t
+        self.outliers = 0
+
+    def _predict(self, t, x, P, t0):
+        """État (x, P) de l'heure t0 prédit à l'heure t (sans modifier le filtre)"""
+        dt = max(0.0, t - t0)
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # Bruit d'accélération blanc (modèle discret classique)
+        q = ACCEL_NOISE ** 2
+        Q = np.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = q * dt ** 4 / 4
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = q * dt ** 3 / 2
+        Q[2, 2] = Q[3, 3] = q * dt ** 2
+        return F @ x, F @ P @ F.T + Q
+
+    def active(self, t):
+        return self.x is not None and t - self.t <= RESET_AFTER
+
+    def search_region(self, t):
+        """
+        (lat, lon, rayon en m) où chercher le scan de l'heure t, None si pas de prédiction.
+        Scan déjà fusionné (même t) : prédiction faite sans lui, comme pour sa première position.
+        """
+        origin, x, P, t0, _ = self._state_for(t)
+        if x is None or t - t0 > RESET_AFTER:
+            return None
+        x, P = self._predict(t, x, P, t0)
+        radius = SEARCH_SIGMAS * math.sqrt(P[0, 0] + P[1, 1])
+        if radius > SEARCH_MAX_RADIUS:
+            return None
+        lat, lon = self._to_geo(x[0], x[1], origin)
+        return lat, lon, max(radius, SEARCH_MIN_RADIUS)
+
+    def update(self, lat, lon, accuracy, t):
+        """
+        Fusionne une position WKNN (accuracy en m) de l'heure t.
+        Une nouvelle position pour le même t (scan complété) remplace la précédente.
+        Renvoie (lat, lon, incertitude en m) filtrés.
+        """
+        self.origin, self.x, self.P, self.t, self.outliers = self._state_for(t)
+        sigma = max(accuracy or 0.0, MIN_MEASURE_SIGMA)
+        if self.x is not None and t < self.t:
+            return lat, lon, sigma # scan plus ancien que le dernier : pas de retour en arrière du filtre
+        if not self.active(t):
+            self._reset(lat, lon, sigma, t)
+            return lat, lon, sigma
+
+        self.prior = self._state()
+        x, P = self._predict(t, self.x, self.P, self.t)
+        z = np.array(self._to_local(lat, lon))
+        R = np.eye(2) * sigma ** 2
+        innovation = z - x[:2]
+        S = P[:2, :2] + R
+        d2 = float(innovation @ np.linalg.solve(S, innovation))
+
+        if d2 > GATE_CHI2:
+            if self.outliers >= MAX_OUTLIERS:
+                # Plusieurs positions d'affilée loin de la prédiction : l'appareil a vraiment bougé
+                self._reset(lat, lon, sigma, t)
+                return lat, lon, sigma
+            # Position aberrante : on garde la prédiction
+            self.outliers += 1
+            self.x, self.P, self.t = x, P, t
+        else:
+            H = np.eye(2, 4) # on n'observe que la position
+            K = P @ H.T @ np.linalg.inv(S)
+            self.x = x + K @ innovation
+            self.P = (np.eye(4) - K @ H) @ P
+            self.t = t
+            self.outliers = 0
+
+        f_lat, f_lon = self._to_geo(self.x[0], self.x[1])
+        return f_lat, f_lon, math.sqrt((self.P[0, 0] + self.P[1, 1]) / 2)
@@ -0,0 +1,532 @@
+import numpy as np
+import os
+import json
+import mmap
+import tempfile
+from array import array
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+# Moteur de calcul WKNN vectorisé (utilisé par server_geoloc.py)
+# Les empreintes sont compilées une seule fois au chargement en matrice creuse (format CSR) :
+# une ligne par point de référence, une colonne par adresse MAC connue.
+# Les MAC sont des entiers 48 bits (0xAABBCCDDEEFF, voir lora_payload.mac_to_int) :
+# la forme texte "AA:BB:CC:DD:EE:FF" ne sert qu'aux entrées/sorties du serveur.
+# Une requête devient alors un seul calcul numpy sur les colonnes touchées par le scan live,
+# au lieu d'une boucle Python sur chaque empreinte.
+
+# ==========================================
+# 1. CONSTANTES
+# ==========================================
+
+MISSING_AP_PENALTY = 10000   # Pénalité si le routeur est manquant dans l'empreinte (100 dBm de différence = 100**2)
+NO_MATCH_DIST = 1e9          # Distance "infinie" si aucun routeur en commun
+METERS_PER_DEGREE = 111320   # Pour les recherches par rayon (rows_near)
+
+# ==========================================
+# 2. STRUCTURE COMPILÉE
+# ==========================================
+
+class FingerprintIndex:
+    """
+    Base d'empreintes compilée (lecture seule).
+    - mac_index : dictionnaire MAC (entier) -> numéro de colonne (ou SortedMacIndex pour un instantané)
+    - indptr, cols, rssi : matrice creuse CSR (ligne i = cols[indptr[i]:indptr[i+1]]), RSSI en int8
+    - coords : tableau (N, 3) lat, lon, étage de chaque empreinte
+    - keys : identifiant de chaque empreinte (timestamp du scan), pour les mises à jour incrémentales
+    - post_ptr, post_rows, post_rssi : index inversé MAC -> empreintes
+      (colonne c = post_rows[post_ptr[c]:post_ptr[c+1]], triées par numéro d'empreinte)
+    """
+    def __init__(self, mac_index, indptr, cols, rssi, coords, keys=None, postings=None):
+        self.mac_index = mac_index
+        self.indptr = indptr
+        self.cols = cols
+        self.rssi = rssi
+        self.coords = coords
+        self.keys = np.arange(len(coords), dtype=np.int64) if keys is None else keys
+        # Empreintes triées par latitude (calculé à la première recherche par rayon)
+        self._lat_order = None
+
+        # Index inversé déjà calculé (chargement d'un instantané)
+        if postings is not None:
+            self.post_ptr, self.post_rows, self.post_rssi = postings
+            return
+
+        # Index inversé (transposée de la matrice) : pour chaque MAC, les empreintes qui la contiennent
+        rows = np.repeat(np.arange(len(coords), dtype=np.int32), np.diff(indptr))
+        order = np.argsort(cols, kind="stable")
+        self.post_rows = rows[order]
+        self.post_rssi = rssi[order]
+        self.post_ptr = np.zeros(len(mac_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=len(mac_index)), out=self.post_ptr[1:])
+
+    def __len__(self):
+        return len(self.coords)
+
+    def rows_near(self, lat, lon, radius_m):
+        """
+        Masque (booléen, une case par empreinte) des empreintes à moins de radius_m mètres de (lat, lon) :
+        bande de latitude par dichotomie, puis distance exacte dans la bande.
+        """
+        if self._lat_order is None:
+            order = np.argsort(self.coords[:, 0], kind="stable")
+            self._lat_order = (order, self.coords[order, 0])
+        order, sorted_lat = self._lat_order
+        d_lat = radius_m / METERS_PER_DEGREE
+        a = np.searchsorted(sorted_lat, lat - d_lat, side="left")
+        b = np.searchsorted(sorted_lat, lat + d_lat, side="right")
+        band = order[a:b]
+        dy = (self.coords[band, 0] - lat) * METERS_PER_DEGREE
+        dx = (self.coords[band, 1] - lon) * METERS_PER_DEGREE * np.cos(np.radians(lat))
+        mask = np.zeros(len(self.coords), dtype=bool)
+        mask[band[dx * dx + dy * dy <= radius_m * radius_m]] = True
+        return mask
+
+class SortedMacIndex(Mapping):
+    """
+    Dictionnaire MAC -> colonne en lecture seule, stocké dans deux tableaux numpy
+    (MAC triées en uint64 + colonne de chacune) : utilisable directement depuis un fichier mmap,
+    sans reconstruire un dictionnaire Python au démarrage. Recherche par dichotomie.
+    """
+    def __init__(self, sorted_macs, sorted_cols):
+        self.sorted_macs = sorted_macs
+        self.sorted_cols = sorted_cols
+
+    def __getitem__(self, mac):
+        if not isinstance(mac, (int, np.integer)) or not 0 <= mac < 1 << 48:
+            raise KeyError(mac)
+        i = np.searchsorted(self.sorted_macs, mac)
+        if i < len(self.sorted_macs) and self.sorted_macs[i] == mac:
+            return int(self.sorted_cols[i])
+        raise KeyError(mac)
+
+    def columns(self, macs):
+        """Colonnes d'un tableau de MAC (uint64) en une seule recherche, -1 pour les MAC inconnues"""
+        if len(self.sorted_macs) == 0:
+            return np.full(len(macs), -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.sorted_macs, macs), len(self.sorted_macs) - 1)
+        return np.where(self.sorted_macs[i] == macs, self.sorted_cols[i], -1).astype(np.int64)
+
+    def __iter__(self):
+        # Dans l'ordre des colonnes
+        for i in np.argsort(self.sorted_cols):
+            yield int(self.sorted_macs[i])
+
+    def __len__(self):
+        return len(self.sorted_macs)
+
+class IndexBuilder:
+    """
+    Construction d'un FingerprintIndex ligne par ligne, sans dictionnaire par empreinte :
+    les MAC sont internées (MAC -> numéro de colonne) et chaque mesure coûte
+    9 octets (ligne int32, colonne int32, RSSI int8). Les lignes d'un même scan
+    (même clé = timestamp) n'ont pas besoin d'être consécutives.
+    base : index existant à compléter. Il n'est pas modifié (copie à l'écriture) :
+    les requêtes en cours continuent de l'utiliser pendant la construction.
+    """
+    def __init__(self, base=None):
+        self.base = base
+        self.n_base = len(base) if base is not None else 0
+        self.mac_index = dict(base.mac_index) if base is not None else {}
+        self.key_rows = {int(key): row for row, key in enumerate(base.keys)} if base is not None else {}
+        # Mesures ajoutées (format COO)
+        self.rows = array('i'); self.cols = array('i'); self.rssi = array('b')
+        # Nouvelles empreintes : clé et position
+        self.keys = array('q'); self.coords = array('d')
+        # Empreintes de la base dont la position est remplacée : ligne -> (lat, lon, floor)
+        self.moved = {}
+
+    def fingerprint(self, key, lat, lon, floor):
+        """Crée (ou met à jour la position de) l'empreinte key, renvoie son numéro de ligne"""
+        row = self.key_rows.get(key)
+        if row is None:
+            row = self.n_base + len(self.keys)
+            self.key_rows[key] = row
+            self.keys.append(key)
+            self.coords.extend((lat, lon, floor))
+        elif row >= self.n_base:
+            i = 3 * (row - self.n_base)
+            self.coords[i:i + 3] = array('d', (lat, lon, floor))
+        else:
+            self.moved[row] = (lat, lon, floor)
+        return row
+
+    def signal(self, row, mac, rssi):
+        """Ajoute (ou remplace) la mesure mac:rssi de l'empreinte row"""
+        col = self.mac_index.get(mac)
+        if col is None:
+            # Attribution d'une colonne à chaque nouvelle MAC
+            col = len(self.mac_index)
+            self.mac_index[mac] = col
+        self.rows.append(row)
+        self.cols.append(col)
+        self.rssi.append(max(-128, min(127, rssi)))
+
+    def add(self, key, mac, rssi, lat, lon, floor):
+        """Une ligne de la base (format de la table fingerprints)"""
+        # Cas le plus courant (nouvelle ligne du dernier scan créé) traité sans appel de méthode
+        row = self.key_rows.get(key)
+        if row is None or row < self.n_base or row != self.n_base + len(self.keys) - 1:
+            row = self.fingerprint(key, lat, lon, floor)
+        else:
+            self.coords[-3] = lat; self.coords[-2] = lon; self.coords[-1] = floor
+        col = self.mac_index.get(mac)
+        if col is None:
+            col = len(self.mac_index)
+            self.mac_index[mac] = col
+        self.rows.append(row)
+        self.cols.append(col)
+        self.rssi.append(rssi if -128 <= rssi <= 127 else max(-128, min(127, rssi)))
+
+    def build(self):
+        base = self.base
+        n = self.n_base + len(self.keys)
+        new_coords = np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 3)
+        new_keys = np.frombuffer(self.keys, dtype=np.int64)
+        new_rows = np.frombuffer(self.rows, dtype=np.int32).astype(np.int64)
+        new_cols = np.frombuffer(self.cols, dtype=np.int32)
+        new_rssi = np.frombuffer(self.rssi, dtype=np.int8)
+
+        if base is None:
+            coords, keys, rows, cols, rssi = new_coords.copy(), new_keys.copy(), new_rows, new_cols, new_rssi
+        else:
+            coords = np.concatenate([base.coords, new_coords])
+            keys = np.concatenate([base.keys, new_keys])
+            rows = np.concatenate([np.repeat(np.arange(self.n_base, dtype=np.int64), np.diff(base.indptr)), new_rows])
+            cols = np.concatenate([base.cols, new_cols])
+            rssi = np.concatenate([base.rssi, new_rssi])
+        for row, position in self.moved.items():
+            coords[row] = position
+
+        # Pour un même (ligne, colonne), on garde la dernière mesure (comme un dictionnaire)
+        cell = rows * max(len(self.mac_index), 1) + cols
+        _, last = np.unique(cell[::-1], return_index=True)
+        keep = np.sort(len(cell) - 1 - last)
+        # Format CSR : mesures triées par ligne, ordre d'arrivée conservé dans chaque ligne
+        keep = keep[np.argsort(rows[keep], kind="stable")]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=n), out=indptr[1:])
+        return FingerprintIndex(self.mac_index, indptr, cols[keep], rssi[keep], coords, keys)
+
+def build_index(fingerprints, keys=None):
+    """
+    Compile la liste d'empreintes ({'lat', 'lon', 'floor', 'aps': {mac: rssi}})
+    en FingerprintIndex. L'ordre des empreintes est conservé.
+    keys : identifiant de chaque empreinte (timestamp), par défaut son numéro.
+    """
+    builder = IndexBuilder()
+    for i, fp in enumerate(fingerprints):
+        row = builder.fingerprint(keys[i] if keys is not None else i, fp['lat'], fp['lon'], fp['floor'])
+        for mac, value in fp['aps'].items():
+            builder.signal(row, mac, value)
+    return builder.build()
+
+# ==========================================
+# 3. CALCUL DES DISTANCES
+# ==========================================
+
+def compute_distances(index, live_aps, exclude=None, region=None):
+    """
+    Distance RSSI entre le scan live ({mac: rssi}) et les empreintes candidates,
+    c'est-à-dire celles qui partagent au moins un routeur avec le scan (via l'index inversé).
+    Même règle que la version boucle : somme des écarts au carré sur les routeurs communs,
+    MISSING_AP_PENALTY par routeur live absent de l'empreinte.
+    Renvoie (candidats triés par numéro d'empreinte, distances).
+    Les empreintes non candidates sont toutes à NO_MATCH_DIST.
+    exclude : numéro d'une empreinte à ignorer (validation "leave-one-out"), None sinon.
+    region : (lat, lon, rayon en m) pour ne garder que les candidats proches (suivi), None sinon.
+    """
+    row_mask = None if region is None else index.rows_near(*region)
+    return compute_distances_batch(index, [live_aps], None if exclude is None else [exclude], row_mask)[0]
+
+def has_candidates(index, live_aps):
+    """
+    Au moins une empreinte partage un routeur avec le scan (compute_distances sans zone renvoie des candidats).
+    Une MAC connue peut ne plus avoir d'empreinte (routeur retiré par fingerprint_cleaning.drop_spread_aps).
+    """
+    for mac in live_aps:
+        col = index.mac_index.get(mac)
+        if col is not None and index.post_ptr[col + 1] > index.post_ptr[col]:
+            return True
+    return False
+
+def compute_distances_batch(index, scans, exclude=None, row_mask=None):
+    """
+    Même calcul que compute_distances pour une liste de scans, en une seule passe numpy :
+    les couples (scan, empreinte candidate) de tous les scans sont traités ensemble.
+    exclude : numéro d'empreinte à ignorer pour chaque scan (-1 : aucune), None sinon.
+    row_mask : masque des empreintes autorisées (voir FingerprintIndex.rows_near), None : toutes.
+    Renvoie une liste de (candidats, distances), une par scan.
+    """
+    # Colonnes connues de chaque scan (les MAC inconnues ne comptent que pour la pénalité)
+    if isinstance(index.mac_index, SortedMacIndex):
+        # Instantané : toutes les MAC des scans cherchées d'un coup dans le tableau trié
+        sizes = [len(live_aps) for live_aps in scans]
+        total = sum(sizes)
+        macs = np.fromiter((mac for live_aps in scans for mac in live_aps), dtype=np.uint64, count=total)
+        live_rssi = np.fromiter((rssi for live_aps in scans for rssi in live_aps.values()), dtype=np.float64, count=total)
+        live_cols = index.mac_index.columns(macs)
+        known = live_cols >= 0
+        scan_ids = np.repeat(np.arange(len(scans), dtype=np.int64), sizes)[known]
+        live_cols = live_cols[known]
+        live_rssi = live_rssi[known]
+    else:
+        scan_ids = []; live_cols = []; live_rssi = []
+        for i, live_aps in enumerate(scans):
+            for mac, rssi in live_aps.items():
+                col = index.mac_index.get(mac)
+                if col is not None:
+                    scan_ids.append(i); live_cols.append(col); live_rssi.append(rssi)
+        scan_ids = np.array(scan_ids, dtype=np.int64)
+        live_cols = np.array(live_cols, dtype=np.int64)
+        live_rssi = np.array(live_rssi, dtype=np.float64)
+
+    # Concaténation des listes d'empreintes de chaque MAC live (sans boucle Python)
+    starts = index.post_ptr[live_cols]
+    counts = index.post_ptr[live_cols + 1] - starts
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    pair_rows = index.post_rows[positions]
+    pair_scan_ids = np.repeat(scan_ids, counts)
+    delta = np.repeat(live_rssi, counts) - index.post_rssi[positions]
+    if row_mask is not None:
+        # Recherche limitée à une zone : les empreintes hors zone ne sont pas candidates
+        keep = row_mask[pair_rows]
+        pair_rows, pair_scan_ids, delta = pair_rows[keep], pair_scan_ids[keep], delta[keep]
+
+    # Clé unique par couple (scan, empreinte) : triée par scan puis par numéro d'empreinte
+    n = len(index)
+    pair_keys, inverse = np.unique(pair_scan_ids * n + pair_rows, return_inverse=True)
+    pair_scans = pair_keys // n
+
+    # Au départ, tous les routeurs live sont considérés absents, puis on remplace
+    # la pénalité par l'écart au carré pour ceux qui sont présents dans l'empreinte
+    n_live = np.array([len(live_aps) for live_aps in scans], dtype=np.float64)
+    dist_sq = MISSING_AP_PENALTY * n_live[pair_scans]
+    dist_sq += np.bincount(inverse, weights=delta * delta - MISSING_AP_PENALTY, minlength=len(pair_keys))
+    dist = np.sqrt(dist_sq)
+    candidates = (pair_keys % n).astype(np.int32)
+
+    if exclude is not None:
+        keep = candidates != np.asarray(exclude, dtype=np.int64)[pair_scans]
+        candidates, dist, pair_scans = candidates[keep], dist[keep], pair_scans[keep]
+
+    # Découpage par scan
+    bounds = np.searchsorted(pair_scans, np.arange(len(scans) + 1))
+    return [(candidates[a:b], dist[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def select_top_k(dist, k):
+    """
+    Indices des k plus petites distances, triés du plus proche au plus loin.
+    Sélection partielle (argpartition) : seuls les k voisins (et les ex-aequo du k-ième) sont triés.
+    À distance égale, on garde l'ordre de la base (comme un tri stable).
+    """
+    if len(dist) > k:
+        threshold = np.partition(dist, k - 1)[k - 1]
+        selected = np.flatnonzero(dist <= threshold)
+    else:
+        selected = np.arange(len(dist))
+    return selected[np.argsort(dist[selected], kind="stable")[:k]]
+
+# ==========================================
+# 4. ESTIMATION DE LA POSITION
+# ==========================================
+
+def wknn_estimate(index, live_aps, k, exclude=None):
+    """
+    Sélectionne les k empreintes les plus proches et renvoie la moyenne pondérée
+    (poids = 1 / distance) des coordonnées, avec l'incertitude en mètres.
+    exclude : empreinte à ignorer (même résultat qu'une base compilée sans elle).
+    """
+    if index is None or len(index) == 0 or not live_aps:
+        return None
+
+    candidates, dist = compute_distances(index, live_aps, exclude)
+    return estimate_from_distances(index, candidates, dist, k, exclude)
+
+def wknn_estimate_batch(index, scans, k, exclude=None):
+    """
+    wknn_estimate pour une liste de scans (distances calculées en une seule passe).
+    exclude : empreinte à ignorer pour chaque scan (-1 : aucune), None sinon.
+    Renvoie une liste de résultats (None pour un scan vide ou une base vide).
+    """
+    if index is None or len(index) == 0:
+        return [None] * len(scans)
+
+    results = []
+    for i, (live_aps, (candidates, dist)) in enumerate(zip(scans, compute_distances_batch(index, scans, exclude))):
+        row = None if exclude is None or exclude[i] < 0 else exclude[i]
+        results.append(estimate_from_distances(index, candidates, dist, k, row) if live_aps else None)
+    return results
+
+def estimate_from_distances(index, candidates, dist, k, exclude=None):
+    """Moyenne pondérée des k plus proches parmi les candidats (voir wknn_estimate)"""
+    order = select_top_k(dist, k)
+    nearest = candidates[order]
+    k_dist = dist[order]
+
+    # Moins de k candidats (ou aucun) : on complète avec les premières empreintes sans routeur
+    # commun, à distance NO_MATCH_DIST, exactement comme le faisait le tri de toute la base
+    if len(nearest) < k:
+        ignored = candidates if exclude is None else np.append(candidates, exclude)
+        others = np.setdiff1d(np.arange(min(len(index), len(ignored) + k)), ignored)[:k - len(nearest)]
+        nearest = np.concatenate([nearest, others])
+        k_dist = np.concatenate([k_dist, np.full(len(others), NO_MATCH_DIST)])
+
+    k_coords = index.coords[nearest]
+
+    # Poids = Inverse de la distance ( +0.001 pour éviter division par zéro)
+    weights = 1 / (k_dist + 0.001)
+    weight_sum = weights.sum()
+    if weight_sum == 0: return None
+
+    est_lat = float((k_coords[:, 0] * weights).sum() / weight_sum)
+    est_lon = float((k_coords[:, 1] * weights).sum() / weight_sum)
+    est_floor = round(float((k_coords[:, 2] * weights).sum() / weight_sum))
+
+    # Incertitude : écart moyen entre les voisins et le point estimé
+    # Conversion degrés -> mètres (approx pour la France : 111km par degré)
+    uncertainty_score = np.sqrt((k_coords[:, 0] - est_lat)**2 + (k_coords[:, 1] - est_lon)**2).sum()
+    accuracy_meters = float(uncertainty_score / k) * 111000
+
+    return {
+        "lat": est_lat,
+        "lon": est_lon,
+        "floor": est_floor,
+        "accuracy": accuracy_meters,
+        "details": [round(float(d), 1) for d in k_dist] # Pour debug
+    }
+
+# ==========================================
+# 5. TRAITEMENT PAR LOTS (archives d'uplinks)
+# ==========================================
+
+# Base compilée de chaque processus du pool (envoyée une seule fois, à la création du processus)
+_worker_index = None
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+def _worker_estimate(args):
+    scans, k = args
+    return wknn_estimate_batch(_worker_index, scans, k)
+
+def locate_batch(index, scans, k, workers=1, chunk_size=1000):
+    """
+    Localise une liste de scans. Avec workers > 1, les scans sont découpés en paquets
+    de chunk_size répartis sur un pool de processus (utile pour des semaines d'archives).
+    Les résultats sont dans le même ordre que les scans.
+    """
+    workers = max(1, min(workers, os.cpu_count() or 1))
+    if workers == 1 or len(scans) <= chunk_size:
+        return wknn_estimate_batch(index, scans, k)
+
+    chunks = [(scans[i:i + chunk_size], k) for i in range(0, len(scans), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index,)) as pool:
+        results = []
+        for chunk_results in pool.map(_worker_estimate, chunks):
+            results.extend(chunk_results)
+    return results
+
+# ==========================================
+# 6. INSTANTANÉ BINAIRE (démarrage instantané)
+# ==========================================
+# Fichier : SNAPSHOT_MAGIC, taille de l'en-tête (8 octets), en-tête JSON (description des tableaux
+# + métadonnées libres, ex: source), puis les tableaux bruts alignés sur 64 octets.
+# Au chargement, les tableaux sont des vues sur le fichier projeté en mémoire (mmap) : aucune copie,
+# et plusieurs processus qui lisent le même fichier partagent les mêmes pages.
+
+SNAPSHOT_MAGIC = b"WKNNSNP2" # v2 : MAC en uint64 (v1 : texte), les anciens instantanés sont reconstruits
+SNAPSHOT_ALIGN = 64
+
+def save_snapshot(index, path, meta=None):
+    """
+    Écrit l'index dans path (fichier temporaire puis renommage : jamais d'instantané à moitié écrit).
+    Fichier temporaire propre à chaque appel : deux constructions en même temps (plusieurs processus du serveur,
+    build_snapshot.py) écrivent chacune un instantané complet, le dernier renommé l'emporte.
+    """
+    # MAC triées (uint64) + colonne de chacune, pour SortedMacIndex
+    macs = np.fromiter(index.mac_index, dtype=np.uint64, count=len(index.mac_index))
+    order = np.argsort(macs, kind="stable")
+    arrays = {
+        "sorted_macs": macs[order],
+        "sorted_cols": order.astype(np.int32),
+        "indptr": index.indptr,
+        "cols": index.cols,
+        "rssi": index.rssi,
+        "coords": index.coords,
+        "keys": index.keys,
+        "post_ptr": index.post_ptr,
+        "post_rows": index.post_rows,
+        "post_rssi": index.post_rssi,
+    }
+
+    # Position de chaque tableau, relative à la fin de l'en-tête
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += -(-arr.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header = json.dumps({"arrays": layout, "meta": meta or {}}).encode()
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for name, arr in arrays.items():
+                f.seek(data_start + layout[name]["offset"])
+                f.write(arr.tobytes())
+            f.truncate(data_start + offset)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.chmod(tmp_path, 0o644) # NamedTemporaryFile crée le fichier en 0600
+    os.replace(tmp_path, path)
+
+def read_snapshot_meta(path):
+    """Métadonnées d'un instantané (sans charger les tableaux), None si fichier absent ou invalide"""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            header_len = int.from_bytes(f.read(8), "little")
+            return json.loads(f.read(header_len))["meta"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def load_snapshot(path):
+    """
+    Charge un instantané en mmap (lecture seule, sans copie).
+    Renvoie (FingerprintIndex, métadonnées).
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} n'est pas un instantané WKNN")
+    header_len = int.from_bytes(buffer[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 8], "little")
+    header_start = len(SNAPSHOT_MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_len])
+    data_start = -(-(header_start + header_len) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    arrays = {}
+    for name, desc in header["arrays"].items():
+        dtype = np.dtype(desc["dtype"])
+        count = int(np.prod(desc["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                     offset=data_start + desc["offset"]).reshape(desc["shape"])
+
+    index = FingerprintIndex(
+        SortedMacIndex(arrays["sorted_macs"], arrays["sorted_cols"]),
+        arrays["indptr"], arrays["cols"], arrays["rssi"], arrays["coords"], arrays["keys"],
+        postings=(arrays["post_ptr"], arrays["post_rows"], arrays["post_rssi"]),
+    )
+    return index, header["meta"]